@@ -2,9 +2,16 @@
 
 #include "Python.h"
 #include "hashtable.h"
+#include "tracemalloc.h"
 #include "frameobject.h"
 #include "pythread.h"
 #include "osdefs.h"
+#ifdef MS_WINDOWS
+#  include <io.h>
+#  include <windows.h>
+#else
+#  include <sys/time.h>
+#endif
 
 #if PY_MAJOR_VERSION >= 3
 #  define PYTHON3
@@ -52,6 +59,22 @@ static struct {
     PyMemAllocator obj;
 } allocators;
 
+/* Implementation of the table of traces */
+typedef enum {
+    /* chained hash table: one memory block is allocated per trace */
+    TRACES_TABLE_CHAINED,
+    /* open addressing: traces are stored inline in a flat array */
+    TRACES_TABLE_OPEN
+} traces_table_kind_t;
+
+/* Traceback of the trace of a resized memory block */
+typedef enum {
+    /* where the memory block was resized (default) */
+    REALLOC_TRACEBACK_RESIZE,
+    /* where the memory block was allocated: the traceback is kept */
+    REALLOC_TRACEBACK_ALLOCATION
+} realloc_traceback_t;
+
 static struct {
     /* Module initialized?
        Variable protected by the GIL */
@@ -68,7 +91,32 @@ static struct {
     /* limit of the number of frames in a traceback, 1 by default.
        Variable protected by the GIL. */
     int max_nframe;
-} tracemalloc_config = {TRACEMALLOC_NOT_INITIALIZED, 0, 1};
+
+    /* implementation of the table of traces, selected by start().
+       Variable protected by the GIL. */
+    traces_table_kind_t traces_table;
+
+    /* Average number of allocated bytes between two sampled memory blocks,
+       0 to trace all memory blocks (default).
+       Variable protected by the GIL. */
+    size_t sample_rate;
+
+    /* Minimum size in bytes of a traced memory block, 0 to trace memory
+       blocks of any size (default).
+       Variable protected by the GIL. */
+    size_t min_size;
+
+    /* traceback of the trace of a resized memory block, selected by start().
+       Variable protected by the GIL. */
+    realloc_traceback_t realloc_traceback;
+
+    /* Compute cumulative allocation statistics per traceback? Tracebacks
+       are kept until clear_traces() or stop() is called.
+       Variable protected by the GIL. */
+    int allocation_stats;
+} tracemalloc_config = {TRACEMALLOC_NOT_INITIALIZED, 0, 1,
+                        TRACES_TABLE_CHAINED, 0, 0,
+                        REALLOC_TRACEBACK_RESIZE, 0};
 
 #if defined(TRACE_RAW_MALLOC) && defined(WITH_THREAD)
 /* This lock is needed because tracemalloc_free() is called without
@@ -83,6 +131,41 @@ static PyThread_type_lock tables_lock;
 #  define TABLES_UNLOCK()
 #endif
 
+/* Prevent the compiler and the CPU from reordering memory accesses around
+   the barrier. On x86 and x86-64, stores are not reordered with other
+   stores and loads are not reordered with other loads, so a compiler
+   barrier is enough. */
+#if defined(__GNUC__) && (defined(__i386__) || defined(__x86_64__))
+#  define MEMORY_BARRIER() __asm__ __volatile__("" ::: "memory")
+#elif defined(__GNUC__) \
+      && (__GNUC__ > 4 || (__GNUC__ == 4 && __GNUC_MINOR__ >= 1))
+#  define MEMORY_BARRIER() __sync_synchronize()
+#elif defined(_MSC_VER) && (defined(_M_IX86) || defined(_M_X64))
+#  include <intrin.h>
+#  pragma intrinsic(_ReadWriteBarrier)
+#  define MEMORY_BARRIER() _ReadWriteBarrier()
+#endif
+
+#if defined(TRACE_RAW_MALLOC) && defined(WITH_THREAD) \
+    && defined(MEMORY_BARRIER)
+   /* get_traced_memory() reads the counters of traced memory without
+      TABLES_LOCK(), see TRACED_MEMORY_WRITE_BEGIN() */
+#  define TRACED_MEMORY_LOCK_FREE
+#endif
+
+/* Interned filename: the hash of the filename is computed once, when the
+   filename is interned, so hashing a traceback does not call PyObject_Hash() */
+typedef struct {
+    /* strong reference to the filename string */
+    PyObject *filename;
+    Py_uhash_t hash;
+    /* Trace filters whose filename pattern matches the filename: bit k is
+       set for tracemalloc_filters.filters[k]. Only valid if filters_generation
+       is equal to tracemalloc_filters.generation. */
+    unsigned long filters_match;
+    unsigned int filters_generation;
+} filename_t;
+
 /* Pack the frame_t structure to reduce the memory footprint on 64-bit
    architectures: 12 bytes instead of 16. This optimization might produce
    SIGBUS on architectures not supporting unaligned memory accesses (64-bit
@@ -94,34 +177,88 @@ __attribute__((packed))
 _declspec(align(4))
 #endif
 {
-    PyObject *filename;
+    /* interned filename, see tracemalloc_filenames */
+    filename_t *filename;
     int lineno;
 } frame_t;
 
-typedef struct {
+/* Tracebacks are stored as a call tree: a traceback is a node storing its
+   most recent frame and a pointer to the traceback of the caller (parent
+   node), so tracebacks sharing their oldest frames share the same nodes. */
+typedef struct traceback_s traceback_t;
+
+struct traceback_s {
+    /* hash of the whole traceback, computed from the hash of the parent */
     Py_uhash_t hash;
+    /* Number of traces and child nodes using the traceback.
+       Protected by TABLES_LOCK(). */
+    size_t refcnt;
+    /* traceback of the caller, NULL for the oldest frame */
+    traceback_t *parent;
+    /* number of frames: depth of the node in the call tree */
     int nframe;
-    frame_t frames[1];
-} traceback_t;
+    /* most recent frame */
+    frame_t frame;
+};
 
-#define TRACEBACK_SIZE(NFRAME) \
-        (sizeof(traceback_t) + sizeof(frame_t) * (NFRAME - 1))
+/* Cumulative number of memory blocks allocated and released with a
+   traceback and total size in bytes of allocated memory blocks */
+typedef struct {
+    unsigned PY_LONG_LONG alloc_count;
+    unsigned PY_LONG_LONG alloc_size;
+    unsigned PY_LONG_LONG free_count;
+} alloc_statistic_t;
 
 #define MAX_NFRAME \
-        ((INT_MAX - sizeof(traceback_t)) / sizeof(frame_t) + 1)
+        (INT_MAX / (sizeof(frame_t) + sizeof(traceback_t *)))
 
-static PyObject *unknown_filename = NULL;
+static filename_t tracemalloc_unknown_filename = {NULL, 0, 0, 0};
 static traceback_t tracemalloc_empty_traceback;
 
+/* Number of domains of memory allocators: PYMEM_DOMAIN_RAW,
+   PYMEM_DOMAIN_MEM and PYMEM_DOMAIN_OBJ */
+#define NDOMAIN 3
+
+#if PyTraceMalloc_FIRST_CUSTOM_DOMAIN != NDOMAIN
+#  error "custom domains must start after domains of Python allocators"
+#endif
+
+/* Bits of trace_t.traceback storing the domain of the memory block */
+#define DOMAIN_MASK ((Py_uintptr_t)3)
+
+/* Value of the DOMAIN_MASK bits of traces of custom domains: the domain is
+   stored in custom_trace_t, see trace_domain() */
+#define DOMAIN_CUSTOM 3
+
 /* Trace of a memory block */
 typedef struct {
     /* Size of the memory block in bytes */
     size_t size;
 
-    /* Traceback where the memory block was allocated */
-    traceback_t *traceback;
+    /* Traceback where the memory block was allocated, and domain of the
+       memory block in the DOMAIN_MASK bits: tracebacks are aligned on at
+       least 4 bytes, and there is no padding to store the domain in
+       trace_t. Use TRACE_TRACEBACK() and TRACE_DOMAIN(). */
+    Py_uintptr_t traceback;
 } trace_t;
 
+#define TRACE_TRACEBACK(TRACE) \
+        ((traceback_t *)((TRACE)->traceback & ~DOMAIN_MASK))
+#define TRACE_DOMAIN(TRACE) \
+        ((int)((TRACE)->traceback & DOMAIN_MASK))
+#define TRACE_SET_TRACEBACK(TRACE, TRACEBACK, DOMAIN) \
+        do { (TRACE)->traceback = (Py_uintptr_t)(TRACEBACK) \
+                                  | (Py_uintptr_t)(DOMAIN); } while (0)
+
+/* Trace of a memory block of a custom domain registered by a C extension
+   with the C API, see tracemalloc_track() */
+typedef struct {
+    /* Domain bits of trace are DOMAIN_CUSTOM. trace must be the first
+       member: functions iterating on traces get a pointer to it. */
+    trace_t trace;
+    unsigned int domain;
+} custom_trace_t;
+
 /* Size in bytes of currently traced memory.
    Protected by TABLES_LOCK(). */
 static size_t tracemalloc_traced_memory = 0;
@@ -130,23 +267,200 @@ static size_t tracemalloc_traced_memory = 0;
    Protected by TABLES_LOCK(). */
 static size_t tracemalloc_peak_traced_memory = 0;
 
-/* Hash table used as a set to to intern filenames:
-   PyObject* => PyObject*.
+/* Size and peak size in bytes of currently traced memory per domain.
+   Protected by TABLES_LOCK(). */
+static size_t tracemalloc_domain_traced_memory[NDOMAIN];
+static size_t tracemalloc_domain_peak_traced_memory[NDOMAIN];
+
+#ifdef TRACED_MEMORY_LOCK_FREE
+/* Generation of the counters of traced memory, a sequence lock: writers
+   hold TABLES_LOCK() and make it odd while they modify the counters.
+   A reader retries if the generation was odd or has changed while it read
+   the counters, so it never waits for the lock. */
+static volatile unsigned long tracemalloc_traced_memory_gen = 0;
+
+#  define TRACED_MEMORY_WRITE_BEGIN() \
+        do { \
+            tracemalloc_traced_memory_gen++; \
+            MEMORY_BARRIER(); \
+        } while (0)
+#  define TRACED_MEMORY_WRITE_END() \
+        do { \
+            MEMORY_BARRIER(); \
+            tracemalloc_traced_memory_gen++; \
+        } while (0)
+#else
+#  define TRACED_MEMORY_WRITE_BEGIN()
+#  define TRACED_MEMORY_WRITE_END()
+#endif
+
+/* Total size in bytes of memory blocks smaller than
+   tracemalloc_config.min_size allocated since traces were cleared: they are not
+   traced, so their size cannot be subtracted when they are released.
+   Protected by the GIL. */
+static unsigned PY_LONG_LONG tracemalloc_untraced_memory = 0;
+
+/* Number of bytes which can still be allocated before the next memory block
+   is sampled. Only used if tracemalloc_config.sample_rate is non-zero.
+   Protected by the GIL. */
+static size_t tracemalloc_sample_countdown = 0;
+
+/* State of the pseudo-random number generator used to compute intervals
+   between sampled memory blocks. Protected by the GIL. */
+static unsigned long tracemalloc_sample_seed = 1;
+
+/* Hash table used to intern filenames:
+   PyObject* => filename_t*.
    Protected by the GIL */
 static _Py_hashtable_t *tracemalloc_filenames = NULL;
 
-/* Buffer to store a new traceback in traceback_new().
+/* Direct-mapped cache of interned filenames indexed by code objects, to
+   not lookup the filename of a code object in tracemalloc_filenames at each
+   memory allocation. Code objects are not referenced: an entry is only used
+   if the filename of the code object is the filename of the record, and
+   tracemalloc_filenames keeps a reference to the filename.
    Protected by the GIL. */
-static traceback_t *tracemalloc_traceback = NULL;
+#define FILENAME_CACHE_SIZE 1024
 
-/* Hash table used as a set to intern tracebacks:
-   traceback_t* => traceback_t*
-   Protected by the GIL */
+typedef struct {
+    PyCodeObject *code;
+    filename_t *filename;
+} filename_cache_entry_t;
+
+static filename_cache_entry_t tracemalloc_filename_cache[FILENAME_CACHE_SIZE];
+
+/* memory blocks are aligned: ignore the lowest bits of the address */
+#define FILENAME_CACHE_INDEX(CODE) \
+        (((Py_uintptr_t)(CODE) >> 4) & (FILENAME_CACHE_SIZE - 1))
+
+/* Filters evaluated when a memory block is allocated: the memory block is not
+   traced if its traceback is filtered out. Filters are evaluated as
+   Snapshot.filter_traces() evaluates Filter objects. */
+#define MAX_TRACE_FILTERS 32
+
+typedef struct {
+    int inclusive;
+    int all_frames;
+    /* line number, or -1 to match any line number */
+    int lineno;
+    /* normalized filename pattern (see Filter.filename_pattern), strong
+       reference */
+    PyObject *pattern;
+} trace_filter_t;
+
+static struct {
+    int nfilter;
+    trace_filter_t filters[MAX_TRACE_FILTERS];
+
+    /* masks of filters: bit k is set for filters[k] */
+    unsigned long include_first;
+    unsigned long include_all;
+    unsigned long exclude_first;
+    unsigned long exclude_all;
+    unsigned long lineno;
+
+    /* Incremented when filters are set to invalidate the filters_match field
+       of filename records. New records use the generation 0, which is
+       skipped when the counter wraps around. */
+    unsigned int generation;
+} tracemalloc_filters = {0};
+
+/* Buffer to store frames of a new traceback in traceback_new(), the most
+   recent frame first.
+   Protected by the GIL. */
+static frame_t *tracemalloc_frames = NULL;
+
+/* Nodes of the last traceback created by traceback_new(), the oldest frame
+   first: tracemalloc_traceback_path[k] is the node of depth k+1. The next
+   traceback reuses the nodes of the frames shared with the last traceback,
+   without looking them up in tracemalloc_tracebacks.
+   Protected by TABLES_LOCK(). */
+static traceback_t **tracemalloc_traceback_path = NULL;
+
+/* Number of valid nodes in tracemalloc_traceback_path.
+   Protected by TABLES_LOCK(). */
+static int tracemalloc_traceback_path_len = 0;
+
+/* Reference to the last traceback created by traceback_new(): it keeps
+   the nodes of tracemalloc_traceback_path alive.
+   Protected by TABLES_LOCK(). */
+static traceback_t *tracemalloc_last_traceback = NULL;
+
+/* Hash table used as a set to intern nodes of tracebacks:
+   traceback_t* => traceback_t*. A node is identified by its parent node
+   and its frame.
+   Protected by TABLES_LOCK(). */
 static _Py_hashtable_t *tracemalloc_tracebacks = NULL;
 
-/* pointer (void*) => trace (trace_t).
+/* Number of interned tracebacks which are not used by any trace.
+   Protected by TABLES_LOCK(). */
+static size_t tracemalloc_unused_tracebacks = 0;
+
+/* If non-zero, unused tracebacks must not be released: traceback_t pointers
+   are used without holding TABLES_LOCK().
+   Protected by TABLES_LOCK(). */
+static int tracemalloc_keep_tracebacks = 0;
+
+/* Operations of the events of the event log */
+#define EVENT_ALLOC 1
+#define EVENT_FREE 2
+
+/* Event of the event log: 40 bytes in the native byte order, the format is
+   decoded by the EventLog class of tracemalloc.py */
+typedef struct {
+    /* time of the event in microseconds since the Epoch */
+    unsigned PY_LONG_LONG timestamp;
+    unsigned PY_LONG_LONG ptr;
+    unsigned PY_LONG_LONG size;
+    /* identifier of the traceback: address of the traceback_t structure */
+    unsigned PY_LONG_LONG traceback;
+    unsigned int op;
+    unsigned int reserved;
+} event_t;
+
+#define EVENT_TRACEBACK(EVENT) \
+    ((traceback_t *)(Py_uintptr_t)(EVENT)->traceback)
+
+/* Ring buffer of events of traced memory blocks, disabled if capacity is 0.
+   Events keep a reference to their traceback, so a traceback identifier
+   cannot be reused while an event uses it. Protected by TABLES_LOCK(). */
+static struct {
+    event_t *events;
+    size_t capacity;
+    /* index of the oldest event */
+    size_t start;
+    size_t len;
+    /* number of events overwritten since the last drain */
+    size_t lost;
+} tracemalloc_event_log = {NULL, 0, 0, 0, 0};
+
+/* Unused tracebacks are kept in tracemalloc_tracebacks to be reused by new
+   traces, and released when there are more than MIN_UNUSED_TRACEBACKS unused
+   tracebacks and more unused tracebacks than traces. Nodes used by unused
+   tracebacks are not counted as unused, but they are released with them. */
+#define MIN_UNUSED_TRACEBACKS 1024
+
+/* Table of traces: pointer (void*) => trace (trace_t). Only one table is
+   used, depending on tracemalloc_config.traces_table.
+   Protected by TABLES_LOCK(). */
+typedef struct {
+    _Py_ptrtable_t *open;
+    _Py_hashtable_t *chained;
+} traces_table_t;
+
+static traces_table_t tracemalloc_traces = {NULL, NULL};
+
+/* Table of traces of custom domains: pointer (void*) => trace
+   (custom_trace_t). A pointer can only be tracked in one custom domain.
+   Protected by TABLES_LOCK(). */
+static _Py_hashtable_t *tracemalloc_custom_traces = NULL;
+
+/* Allocation statistics of tracebacks: traceback_t* => alloc_statistic_t.
+   Only filled if allocation statistics are enabled, see start(), so
+   tracebacks don't pay for the counters otherwise. Tracebacks are not
+   released while allocation statistics are enabled.
    Protected by TABLES_LOCK(). */
-static _Py_hashtable_t *tracemalloc_traces = NULL;
+static _Py_hashtable_t *tracemalloc_allocation_stats = NULL;
 
 #ifdef TRACE_DEBUG
 static void
@@ -244,6 +558,218 @@ hashtable_new(size_t data_size,
                                   NULL, NULL, NULL, &hashtable_alloc);
 }
 
+static int
+traces_table_new(traces_table_t *traces, traces_table_kind_t kind)
+{
+    traces->open = NULL;
+    traces->chained = NULL;
+    if (kind == TRACES_TABLE_OPEN) {
+        traces->open = _Py_ptrtable_new(sizeof(trace_t), 0, &hashtable_alloc);
+        if (traces->open == NULL)
+            return -1;
+    }
+    else {
+        traces->chained = hashtable_new(sizeof(trace_t),
+                                        _Py_hashtable_hash_ptr,
+                                        _Py_hashtable_compare_direct);
+        if (traces->chained == NULL)
+            return -1;
+    }
+    return 0;
+}
+
+static void
+traces_table_destroy(traces_table_t *traces)
+{
+    if (traces->open != NULL)
+        _Py_ptrtable_destroy(traces->open);
+    if (traces->chained != NULL)
+        _Py_hashtable_destroy(traces->chained);
+    traces->open = NULL;
+    traces->chained = NULL;
+}
+
+static int
+traces_table_copy(traces_table_t *dst, traces_table_t *src)
+{
+    dst->open = NULL;
+    dst->chained = NULL;
+    if (src->open != NULL) {
+        dst->open = _Py_ptrtable_copy(src->open);
+        if (dst->open == NULL)
+            return -1;
+    }
+    else {
+        dst->chained = _Py_hashtable_copy(src->chained);
+        if (dst->chained == NULL)
+            return -1;
+    }
+    return 0;
+}
+
+static int
+traces_table_set(traces_table_t *traces, void *ptr, trace_t *trace)
+{
+    if (traces->open != NULL)
+        return _Py_PTRTABLE_SET(traces->open, ptr, *trace);
+    else
+        return _Py_HASHTABLE_SET(traces->chained, ptr, *trace);
+}
+
+static int
+traces_table_get(traces_table_t *traces, void *ptr, trace_t *trace)
+{
+    if (traces->open != NULL)
+        return _Py_PTRTABLE_GET(traces->open, ptr, *trace);
+    else
+        return _Py_HASHTABLE_GET(traces->chained, ptr, *trace);
+}
+
+/* Get the trace of ptr to update it in place, or NULL if ptr is not traced.
+   The pointer is only valid until the table is modified. */
+static trace_t*
+traces_table_get_trace(traces_table_t *traces, void *ptr)
+{
+    _Py_hashtable_entry_t *entry;
+
+    if (traces->open != NULL)
+        return (trace_t *)_Py_ptrtable_get_data(traces->open, ptr);
+
+    entry = _Py_hashtable_get_entry(traces->chained, ptr);
+    if (entry == NULL)
+        return NULL;
+    return (trace_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+}
+
+static int
+traces_table_pop(traces_table_t *traces, void *ptr, trace_t *trace)
+{
+    if (traces->open != NULL)
+        return _Py_ptrtable_pop(traces->open, ptr, trace, sizeof(*trace));
+    else
+        return _Py_hashtable_pop(traces->chained, ptr, trace, sizeof(*trace));
+}
+
+static void
+traces_table_clear(traces_table_t *traces)
+{
+    if (traces->open != NULL)
+        _Py_ptrtable_clear(traces->open);
+    else
+        _Py_hashtable_clear(traces->chained);
+}
+
+static size_t
+traces_table_len(traces_table_t *traces)
+{
+    if (traces->open != NULL)
+        return traces->open->entries;
+    else
+        return traces->chained->entries;
+}
+
+static size_t
+traces_table_size(traces_table_t *traces)
+{
+    if (traces->open != NULL)
+        return _Py_ptrtable_size(traces->open);
+    else
+        return _Py_hashtable_size(traces->chained);
+}
+
+typedef int (*traces_table_foreach_func) (const void *ptr, trace_t *trace,
+                                          void *arg);
+
+typedef struct {
+    traces_table_foreach_func func;
+    void *arg;
+} traces_table_foreach_t;
+
+static int
+traces_table_foreach_open(const void *key, void *data, void *user_data)
+{
+    traces_table_foreach_t *foreach = user_data;
+    return foreach->func(key, (trace_t *)data, foreach->arg);
+}
+
+static int
+traces_table_foreach_chained(_Py_hashtable_entry_t *entry, void *user_data)
+{
+    traces_table_foreach_t *foreach = user_data;
+    return foreach->func(entry->key,
+                         (trace_t *)_PY_HASHTABLE_ENTRY_DATA(entry),
+                         foreach->arg);
+}
+
+/* Call func(ptr, trace, arg) for each trace. Iteration stops if func returns
+   a non-zero value. */
+static int
+traces_table_foreach(traces_table_t *traces,
+                     traces_table_foreach_func func, void *arg)
+{
+    traces_table_foreach_t foreach;
+
+    foreach.func = func;
+    foreach.arg = arg;
+    if (traces->open != NULL)
+        return _Py_ptrtable_foreach(traces->open,
+                                    traces_table_foreach_open, &foreach);
+    else
+        return _Py_hashtable_foreach(traces->chained,
+                                     traces_table_foreach_chained, &foreach);
+}
+
+/* Call func(ptr, trace, arg) for each trace of a table of traces of custom
+   domains */
+static int
+custom_traces_foreach(_Py_hashtable_t *custom_traces,
+                      traces_table_foreach_func func, void *arg)
+{
+    traces_table_foreach_t foreach;
+
+    foreach.func = func;
+    foreach.arg = arg;
+    /* the trace is the first member of custom_trace_t */
+    return _Py_hashtable_foreach(custom_traces,
+                                 traces_table_foreach_chained, &foreach);
+}
+
+/* Call func(ptr, trace, arg) for each trace of all domains.
+   TABLES_LOCK() must be held. */
+static int
+tracemalloc_foreach_trace(traces_table_foreach_func func, void *arg)
+{
+    int res;
+
+    res = traces_table_foreach(&tracemalloc_traces, func, arg);
+    if (res)
+        return res;
+    return custom_traces_foreach(tracemalloc_custom_traces, func, arg);
+}
+
+/* Get the trace of ptr in the table of traces of custom domains, or NULL if
+   ptr is not tracked. The pointer is only valid until the table is
+   modified. */
+static custom_trace_t*
+custom_traces_get(void *ptr)
+{
+    _Py_hashtable_entry_t *entry;
+
+    entry = _Py_hashtable_get_entry(tracemalloc_custom_traces, ptr);
+    if (entry == NULL)
+        return NULL;
+    return (custom_trace_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+}
+
+/* Get the domain of a trace. trace must be stored in a table of traces. */
+static unsigned int
+trace_domain(trace_t *trace)
+{
+    if (TRACE_DOMAIN(trace) == DOMAIN_CUSTOM)
+        return ((custom_trace_t *)trace)->domain;
+    return TRACE_DOMAIN(trace);
+}
+
 static void*
 raw_malloc(size_t size)
 {
@@ -268,23 +794,18 @@ hashtable_compare_traceback(const traceback_t *traceback1,
                             const _Py_hashtable_entry_t *he)
 {
     const traceback_t *traceback2 = he->key;
-    const frame_t *frame1, *frame2;
-    int i;
 
-    if (traceback1->nframe != traceback2->nframe)
+    /* parent nodes are interned: compare pointers */
+    if (traceback1->parent != traceback2->parent)
         return 0;
 
-    for (i=0; i < traceback1->nframe; i++) {
-        frame1 = &traceback1->frames[i];
-        frame2 = &traceback2->frames[i];
-
-        if (frame1->lineno != frame2->lineno)
-            return 0;
+    if (traceback1->frame.lineno != traceback2->frame.lineno)
+        return 0;
 
-        if (frame1->filename != frame2->filename) {
-            assert(STRING_COMPARE(frame1->filename, frame2->filename) != 0);
-            return 0;
-        }
+    if (traceback1->frame.filename != traceback2->frame.filename) {
+        assert(STRING_COMPARE(traceback1->frame.filename->filename,
+                              traceback2->frame.filename->filename) != 0);
+        return 0;
     }
     return 1;
 }
@@ -294,9 +815,10 @@ tracemalloc_get_frame(PyFrameObject *pyframe, frame_t *frame)
 {
     PyCodeObject *code;
     PyObject *filename;
-    _Py_hashtable_entry_t *entry;
+    filename_t *record;
+    filename_cache_entry_t *cache_entry;
 
-    frame->filename = unknown_filename;
+    frame->filename = &tracemalloc_unknown_filename;
 #if PY_MAJOR_VERSION == 2 && PY_MINOR_VERSION <= 6
     /* Python 2.6 and older */
     if (pyframe->f_trace)
@@ -330,6 +852,13 @@ tracemalloc_get_frame(PyFrameObject *pyframe, frame_t *frame)
     if (filename == NULL)
         return;
 
+    cache_entry = &tracemalloc_filename_cache[FILENAME_CACHE_INDEX(code)];
+    if (cache_entry->code == code
+        && cache_entry->filename->filename == filename) {
+        frame->filename = cache_entry->filename;
+        return;
+    }
+
     if (!STRING_CHECK(filename)) {
 #ifdef TRACE_DEBUG
         tracemalloc_error("filename is not an unicode string");
@@ -349,16 +878,29 @@ tracemalloc_get_frame(PyFrameObject *pyframe, frame_t *frame)
 #endif
 
     /* intern the filename */
-    entry = _Py_hashtable_get_entry(tracemalloc_filenames, filename);
-    if (entry != NULL) {
-        filename = (PyObject *)entry->key;
-    }
-    else {
-        /* tracemalloc_filenames is responsible to keep a reference
+    if (!_Py_HASHTABLE_GET(tracemalloc_filenames, filename, record)) {
+        record = raw_malloc(sizeof(filename_t));
+        if (record == NULL) {
+#ifdef TRACE_DEBUG
+            tracemalloc_error("failed to intern the filename: malloc failed");
+#endif
+            return;
+        }
+        /* the hash of a string is cached: it was already computed by the
+           lookup in tracemalloc_filenames */
+        record->hash = PyObject_Hash(filename);
+        /* trace filters are matched on demand */
+        record->filters_match = 0;
+        record->filters_generation = 0;
+
+        /* the filename record is responsible to keep a reference
            to the filename */
         Py_INCREF(filename);
-        if (_Py_hashtable_set(tracemalloc_filenames, filename, NULL, 0) < 0) {
+        record->filename = filename;
+
+        if (_Py_HASHTABLE_SET(tracemalloc_filenames, filename, record) < 0) {
             Py_DECREF(filename);
+            raw_free(record);
 #ifdef TRACE_DEBUG
             tracemalloc_error("failed to intern the filename");
 #endif
@@ -366,38 +908,37 @@ tracemalloc_get_frame(PyFrameObject *pyframe, frame_t *frame)
         }
     }
 
-    /* the tracemalloc_filenames table keeps a reference to the filename */
-    frame->filename = filename;
+    cache_entry->code = code;
+    cache_entry->filename = record;
+
+    /* the tracemalloc_filenames table keeps the record alive */
+    frame->filename = record;
 }
 
 static Py_uhash_t
 traceback_hash(traceback_t *traceback)
 {
-    /* code based on tuplehash() of Objects/tupleobject.c */
+    /* the hash of the parent node is the hash of all older frames */
     Py_uhash_t x;  /* Unsigned for defined overflow behavior. */
     Py_uhash_t y;
-    int len = traceback->nframe;
-    Py_uhash_t mult = _PyHASH_MULTIPLIER;
-    frame_t *frame;
-
-    x = 0x345678UL;
-    frame = traceback->frames;
-    while (--len >= 0) {
-        y = PyObject_Hash(frame->filename);
-        y ^= frame->lineno;
-        frame++;
 
-        x = (x ^ y) * mult;
-        /* the cast might truncate len; that doesn't change hash stability */
-        mult += (Py_uhash_t)(82520UL + len + len);
-    }
+    if (traceback->parent != NULL)
+        x = traceback->parent->hash;
+    else
+        x = 0x345678UL;
+    y = traceback->frame.filename->hash;
+    y ^= (Py_uhash_t)traceback->frame.lineno;
+    x = (x ^ y) * _PyHASH_MULTIPLIER;
     x += 97531UL;
     return x;
 }
 
-static void
-traceback_get_frames(traceback_t *traceback)
+/* Fill frames with the frames of the current thread, the most recent frame
+   first. Return the number of frames. */
+static int
+traceback_get_frames(frame_t *frames)
 {
+    int nframe = 0;
     PyThreadState *tstate;
     PyFrameObject *pyframe;
 
@@ -410,113 +951,829 @@ traceback_get_frames(traceback_t *traceback)
 #ifdef TRACE_DEBUG
         tracemalloc_error("failed to get the current thread state");
 #endif
-        return;
+        return 0;
     }
 
     for (pyframe = tstate->frame; pyframe != NULL; pyframe = pyframe->f_back) {
-        tracemalloc_get_frame(pyframe, &traceback->frames[traceback->nframe]);
-        assert(traceback->frames[traceback->nframe].filename != NULL);
-        assert(traceback->frames[traceback->nframe].lineno >= 0);
-        traceback->nframe++;
-        if (traceback->nframe == tracemalloc_config.max_nframe)
+        tracemalloc_get_frame(pyframe, &frames[nframe]);
+        assert(frames[nframe].filename != NULL);
+        assert(frames[nframe].lineno >= 0);
+        nframe++;
+        if (nframe == tracemalloc_config.max_nframe)
             break;
     }
+    return nframe;
+}
+
+/* TABLES_LOCK() must be held */
+static void
+traceback_incref(traceback_t *traceback)
+{
+    if (traceback->refcnt == 0)
+        tracemalloc_unused_tracebacks--;
+    traceback->refcnt++;
 }
 
+/* Get the interned node of frame called by parent.
+   TABLES_LOCK() must be held. */
 static traceback_t *
-traceback_new(void)
+traceback_intern(traceback_t *parent, frame_t *frame)
 {
+    traceback_t key;
     traceback_t *traceback;
     _Py_hashtable_entry_t *entry;
 
-    /* get frames */
-    traceback = tracemalloc_traceback;
-    traceback->nframe = 0;
-    traceback_get_frames(traceback);
-    if (traceback->nframe == 0)
-        return &tracemalloc_empty_traceback;
-    traceback->hash = traceback_hash(traceback);
-
-    /* intern the traceback */
-    entry = _Py_hashtable_get_entry(tracemalloc_tracebacks, traceback);
-    if (entry != NULL) {
-        traceback = (traceback_t *)entry->key;
-    }
-    else {
-        traceback_t *copy;
-        size_t traceback_size;
+    key.parent = parent;
+    key.frame = *frame;
+    key.hash = traceback_hash(&key);
 
-        traceback_size = TRACEBACK_SIZE(traceback->nframe);
+    entry = _Py_hashtable_get_entry(tracemalloc_tracebacks, &key);
+    if (entry != NULL)
+        return (traceback_t *)entry->key;
 
-        copy = raw_malloc(traceback_size);
-        if (copy == NULL) {
+    traceback = raw_malloc(sizeof(traceback_t));
+    if (traceback == NULL) {
 #ifdef TRACE_DEBUG
-            tracemalloc_error("failed to intern the traceback: malloc failed");
+        tracemalloc_error("failed to intern the traceback: malloc failed");
 #endif
-            return NULL;
-        }
-        memcpy(copy, traceback, traceback_size);
+        return NULL;
+    }
+    *traceback = key;
+    traceback->refcnt = 0;
+    traceback->nframe = (parent != NULL) ? parent->nframe + 1 : 1;
 
-        if (_Py_hashtable_set(tracemalloc_tracebacks, copy, NULL, 0) < 0) {
-            raw_free(copy);
+    if (_Py_hashtable_set(tracemalloc_tracebacks, traceback, NULL, 0) < 0) {
+        raw_free(traceback);
 #ifdef TRACE_DEBUG
-            tracemalloc_error("failed to intern the traceback: putdata failed");
+        tracemalloc_error("failed to intern the traceback: putdata failed");
 #endif
+        return NULL;
+    }
+    tracemalloc_unused_tracebacks++;
+
+    /* the node keeps a reference to its parent */
+    if (parent != NULL)
+        traceback_incref(parent);
+    return traceback;
+}
+
+static void traceback_decref(traceback_t *traceback);
+
+/* Get the traceback of the nframe frames of tracemalloc_frames.
+   TABLES_LOCK() must be held. */
+static traceback_t *
+traceback_new(int nframe)
+{
+    frame_t *frames = tracemalloc_frames;
+    traceback_t **path = tracemalloc_traceback_path;
+    traceback_t *traceback, *parent;
+    int depth, shared;
+
+    if (nframe == 0)
+        return &tracemalloc_empty_traceback;
+
+    /* reuse the oldest frames shared with the last traceback */
+    parent = NULL;
+    depth = 0;
+    while (depth < nframe && depth < tracemalloc_traceback_path_len) {
+        traceback = path[depth];
+        if (traceback->frame.filename != frames[nframe - 1 - depth].filename
+            || traceback->frame.lineno != frames[nframe - 1 - depth].lineno)
+            break;
+        parent = traceback;
+        depth++;
+    }
+    shared = depth;
+
+    /* intern the other frames */
+    for (; depth < nframe; depth++) {
+        traceback = traceback_intern(parent, &frames[nframe - 1 - depth]);
+        if (traceback == NULL) {
+            /* only the shared nodes are kept alive by the last traceback */
+            tracemalloc_traceback_path_len = shared;
             return NULL;
         }
-        traceback = copy;
+        path[depth] = traceback;
+        parent = traceback;
     }
+    traceback = parent;
+    tracemalloc_traceback_path_len = nframe;
+
+    /* keep the nodes of the path alive */
+    traceback_incref(traceback);
+    if (tracemalloc_last_traceback != NULL)
+        traceback_decref(tracemalloc_last_traceback);
+    tracemalloc_last_traceback = traceback;
     return traceback;
 }
 
 static int
-tracemalloc_add_trace(void *ptr, size_t size)
+traceback_free_unused(_Py_hashtable_entry_t *entry, void *user_data)
 {
-    traceback_t *traceback;
-    trace_t trace;
-    int res;
-
-    traceback = traceback_new();
-    if (traceback == NULL)
-        return -1;
+    traceback_t *traceback = (traceback_t *)entry->key;
+    size_t *unused_parents = (size_t *)user_data;
+    traceback_t *parent;
 
-    trace.size = size;
-    trace.traceback = traceback;
+    if (traceback->refcnt != 0)
+        return 0;
 
-    res = _Py_HASHTABLE_SET(tracemalloc_traces, ptr, trace);
-    if (res == 0) {
-        assert(tracemalloc_traced_memory <= PY_SIZE_MAX - size);
-        tracemalloc_traced_memory += size;
-        if (tracemalloc_traced_memory > tracemalloc_peak_traced_memory)
-            tracemalloc_peak_traced_memory = tracemalloc_traced_memory;
+    /* the parent is released by this pass if it was not visited yet,
+       or by the next pass */
+    parent = traceback->parent;
+    if (parent != NULL) {
+        assert(parent->refcnt > 0);
+        parent->refcnt--;
+        if (parent->refcnt == 0) {
+            tracemalloc_unused_tracebacks++;
+            (*unused_parents)++;
+        }
     }
 
-    return res;
+    raw_free(traceback);
+    tracemalloc_unused_tracebacks--;
+    return 1;
 }
 
+/* Release unused tracebacks if there are too many of them.
+   TABLES_LOCK() must be held. */
 static void
-tracemalloc_remove_trace(void *ptr)
+traceback_release_unused(void)
 {
-    trace_t trace;
+    size_t unused_parents;
 
-    if (_Py_hashtable_pop(tracemalloc_traces, ptr, &trace, sizeof(trace))) {
-        assert(tracemalloc_traced_memory >= trace.size);
-        tracemalloc_traced_memory -= trace.size;
-    }
+    if (tracemalloc_keep_tracebacks)
+        return;
+    /* unused tracebacks store allocation statistics */
+    if (tracemalloc_config.allocation_stats)
+        return;
+    if (tracemalloc_unused_tracebacks <= MIN_UNUSED_TRACEBACKS)
+        return;
+    if (tracemalloc_unused_tracebacks
+        <= traces_table_len(&tracemalloc_traces)
+           + tracemalloc_custom_traces->entries)
+        return;
+
+    /* releasing a node can make its parent unused: repeat until all nodes
+       of unused branches are released */
+    do {
+        unused_parents = 0;
+        _Py_hashtable_foreach_delete(tracemalloc_tracebacks,
+                                     traceback_free_unused, &unused_parents);
+    } while (unused_parents != 0);
 }
 
-static void*
-tracemalloc_malloc(void *ctx, size_t size)
+/* TABLES_LOCK() must be held */
+static void
+traceback_decref(traceback_t *traceback)
 {
-    PyMemAllocator *alloc = (PyMemAllocator *)ctx;
+    assert(traceback->refcnt > 0);
+    traceback->refcnt--;
+    if (traceback->refcnt == 0) {
+        tracemalloc_unused_tracebacks++;
+        traceback_release_unused();
+    }
+}
+
+/* Get the number of bytes until the next sampled memory block: an
+   exponentially distributed random number with the mean sample_rate, so
+   sampled memory blocks form a Poisson process on allocated bytes */
+static size_t
+tracemalloc_sample_interval(void)
+{
+    unsigned long x;
+    double u, interval;
+
+    /* xorshift pseudo-random number generator (32-bit) */
+    x = tracemalloc_sample_seed;
+    x ^= (x << 13) & 0xFFFFFFFFUL;
+    x ^= x >> 17;
+    x ^= (x << 5) & 0xFFFFFFFFUL;
+    tracemalloc_sample_seed = x;
+
+    /* u is in the range ]0; 1[ */
+    u = ((double)(x >> 8) + 1.0) / 16777218.0;
+    interval = -log(u) * (double)tracemalloc_config.sample_rate;
+    if (interval >= (double)PY_SIZE_MAX)
+        return PY_SIZE_MAX;
+    return (size_t)interval + 1;
+}
+
+/* Decide if a new memory block of size bytes must be traced.
+   The GIL must be held. */
+static int
+tracemalloc_sample(size_t size)
+{
+    if (size < tracemalloc_config.min_size) {
+        /* don't get the traceback of small memory blocks,
+           only account their size */
+        tracemalloc_untraced_memory += size;
+        return 0;
+    }
+
+    if (tracemalloc_config.sample_rate == 0)
+        return 1;
+
+    if (size < tracemalloc_sample_countdown) {
+        tracemalloc_sample_countdown -= size;
+        return 0;
+    }
+
+    tracemalloc_sample_countdown = tracemalloc_sample_interval();
+    return 1;
+}
+
+#ifdef PYTHON3
+typedef Py_UCS4 filter_char_t;
+#  define FILTER_STRING_LENGTH(STR) PyUnicode_GET_LENGTH(STR)
+#  define FILTER_STRING_READ(STR, INDEX) PyUnicode_READ_CHAR(STR, INDEX)
+#else
+typedef unsigned char filter_char_t;
+#  define FILTER_STRING_LENGTH(STR) PyString_GET_SIZE(STR)
+#  define FILTER_STRING_READ(STR, INDEX) \
+        ((filter_char_t)PyString_AS_STRING(STR)[INDEX])
+#endif
+
+/* Normalize a character of a filename as os.path.normcase() */
+static filter_char_t
+filter_normcase(filter_char_t ch)
+{
+#ifdef MS_WINDOWS
+    if (ch == '/')
+        return '\\';
+#  ifdef PYTHON3
+    return Py_UNICODE_TOLOWER(ch);
+#  else
+    return Py_TOLOWER(ch);
+#  endif
+#else
+    return ch;
+#endif
+}
+
+/* Match the character ch with the character set starting at pattern[pos]
+   ('['). Return the index following the character set if ch is part of the
+   set, -1 if it is not part of the set, or 0 if pattern[pos] does not start
+   a character set. Same syntax as fnmatch.translate(). */
+static Py_ssize_t
+filter_match_set(PyObject *pattern, Py_ssize_t pos, filter_char_t ch)
+{
+    Py_ssize_t len = FILTER_STRING_LENGTH(pattern);
+    Py_ssize_t start, end, i;
+    int negate, found;
+    filter_char_t first, last;
+
+    start = pos + 1;
+    end = start;
+    if (end < len && FILTER_STRING_READ(pattern, end) == '!')
+        end++;
+    if (end < len && FILTER_STRING_READ(pattern, end) == ']')
+        end++;
+    while (end < len && FILTER_STRING_READ(pattern, end) != ']')
+        end++;
+    if (end >= len) {
+        /* no closing bracket: '[' is a literal character */
+        return 0;
+    }
+
+    negate = (FILTER_STRING_READ(pattern, start) == '!');
+    i = negate ? start + 1 : start;
+    found = 0;
+    while (i < end) {
+        first = FILTER_STRING_READ(pattern, i);
+        if (i + 2 < end && FILTER_STRING_READ(pattern, i + 1) == '-') {
+            last = FILTER_STRING_READ(pattern, i + 2);
+            i += 3;
+        }
+        else {
+            last = first;
+            i++;
+        }
+        if (first <= ch && ch <= last) {
+            found = 1;
+            break;
+        }
+    }
+    if (found == negate)
+        return -1;
+    return end + 1;
+}
+
+/* Check if the normalized filename matches the filename pattern of a filter,
+   same result as fnmatch.fnmatch(_normalize_filename(filename), pattern):
+   compare the len first characters of filename normalized by
+   filter_normcase() with the pattern. */
+static int
+filter_match_pattern(PyObject *pattern, PyObject *filename, Py_ssize_t len)
+{
+    Py_ssize_t pattern_len = FILTER_STRING_LENGTH(pattern);
+    Py_ssize_t pos = 0, index = 0;
+    /* position of the last '*' in the pattern and the index in the filename
+       where it started to match, to backtrack on mismatch */
+    Py_ssize_t star = -1, star_index = 0;
+    Py_ssize_t next;
+    filter_char_t pch, ch;
+
+    while (index < len) {
+        if (pos < pattern_len) {
+            pch = FILTER_STRING_READ(pattern, pos);
+            ch = filter_normcase(FILTER_STRING_READ(filename, index));
+            if (pch == '*') {
+                star = pos;
+                star_index = index;
+                pos++;
+                continue;
+            }
+            if (pch == '?') {
+                pos++;
+                index++;
+                continue;
+            }
+            next = 0;
+            if (pch == '[')
+                next = filter_match_set(pattern, pos, ch);
+            if (next > 0) {
+                pos = next;
+                index++;
+                continue;
+            }
+            if (next == 0 && pch == ch) {
+                pos++;
+                index++;
+                continue;
+            }
+        }
+        if (star < 0)
+            return 0;
+        /* let the last '*' match one more character */
+        pos = star + 1;
+        star_index++;
+        index = star_index;
+    }
+
+    while (pos < pattern_len && FILTER_STRING_READ(pattern, pos) == '*')
+        pos++;
+    return (pos == pattern_len);
+}
+
+/* Get the mask of trace filters whose pattern matches the filename.
+   The GIL must be held. */
+static unsigned long
+filter_match_filename(filename_t *record)
+{
+    PyObject *filename = record->filename;
+    Py_ssize_t len;
+    unsigned long match;
+    int i;
+
+    if (record->filters_generation == tracemalloc_filters.generation)
+        return record->filters_match;
+
+    len = FILTER_STRING_LENGTH(filename);
+    /* replace .pyc and .pyo suffix with .py */
+    if (len >= 4
+        && filter_normcase(FILTER_STRING_READ(filename, len - 4)) == '.'
+        && filter_normcase(FILTER_STRING_READ(filename, len - 3)) == 'p'
+        && filter_normcase(FILTER_STRING_READ(filename, len - 2)) == 'y'
+        && (filter_normcase(FILTER_STRING_READ(filename, len - 1)) == 'c'
+            || filter_normcase(FILTER_STRING_READ(filename, len - 1)) == 'o'))
+        len--;
+
+    match = 0;
+    for (i=0; i < tracemalloc_filters.nfilter; i++) {
+        if (filter_match_pattern(tracemalloc_filters.filters[i].pattern,
+                                 filename, len))
+            match |= 1UL << i;
+    }
+
+    record->filters_match = match;
+    record->filters_generation = tracemalloc_filters.generation;
+    return match;
+}
+
+/* Get the mask of trace filters matching the frame */
+static unsigned long
+filter_match_frame(frame_t *frame)
+{
+    unsigned long match;
+    int i;
+
+    match = filter_match_filename(frame->filename);
+    if (match & tracemalloc_filters.lineno) {
+        for (i=0; i < tracemalloc_filters.nfilter; i++) {
+            if (tracemalloc_filters.filters[i].lineno >= 0
+                && tracemalloc_filters.filters[i].lineno != frame->lineno)
+                match &= ~(1UL << i);
+        }
+    }
+    return match;
+}
+
+/* Check if a memory block allocated in frames (the most recent frame first)
+   must be traced: same result as _FilterSet.match() in tracemalloc.py.
+   The GIL must be held. */
+static int
+tracemalloc_filter_frames(frame_t *frames, int nframe)
+{
+    unsigned long first, all;
+    int i;
+
+    if (nframe == 0) {
+        frames = &tracemalloc_empty_traceback.frame;
+        nframe = 1;
+    }
+
+    first = filter_match_frame(&frames[0]);
+    all = first;
+    if (tracemalloc_filters.include_all | tracemalloc_filters.exclude_all) {
+        for (i=1; i < nframe; i++)
+            all |= filter_match_frame(&frames[i]);
+    }
+
+    if (tracemalloc_filters.include_first | tracemalloc_filters.include_all) {
+        if (!(first & tracemalloc_filters.include_first)
+            && !(all & tracemalloc_filters.include_all))
+            return 0;
+    }
+    if ((first & tracemalloc_filters.exclude_first)
+        || (all & tracemalloc_filters.exclude_all))
+        return 0;
+    return 1;
+}
+
+/* Get the current time in microseconds since the Epoch */
+static unsigned PY_LONG_LONG
+event_log_time(void)
+{
+#ifdef MS_WINDOWS
+    FILETIME system_time;
+    ULARGE_INTEGER large;
+
+    GetSystemTimeAsFileTime(&system_time);
+    large.u.LowPart = system_time.dwLowDateTime;
+    large.u.HighPart = system_time.dwHighDateTime;
+    /* FILETIME is in units of 100 ns since the 1st January 1601 */
+    return (large.QuadPart / 10
+            - (unsigned PY_LONG_LONG)116444736 * 100000000);
+#else
+    struct timeval tv;
+
+#ifdef GETTIMEOFDAY_NO_TZ
+    gettimeofday(&tv);
+#else
+    gettimeofday(&tv, (struct timezone *)NULL);
+#endif
+    return ((unsigned PY_LONG_LONG)tv.tv_sec * 1000000
+            + (unsigned PY_LONG_LONG)tv.tv_usec);
+#endif
+}
+
+/* Append an event to the event log, overwrite the oldest event if the log
+   is full. TABLES_LOCK() must be held. */
+static void
+event_log_add(unsigned int op, void *ptr, size_t size, traceback_t *traceback)
+{
+    event_t *event;
+
+    if (tracemalloc_event_log.capacity == 0)
+        return;
+
+    traceback_incref(traceback);
+
+    if (tracemalloc_event_log.len == tracemalloc_event_log.capacity) {
+        event = &tracemalloc_event_log.events[tracemalloc_event_log.start];
+        traceback_decref(EVENT_TRACEBACK(event));
+        tracemalloc_event_log.start++;
+        if (tracemalloc_event_log.start == tracemalloc_event_log.capacity)
+            tracemalloc_event_log.start = 0;
+        tracemalloc_event_log.len--;
+        tracemalloc_event_log.lost++;
+    }
+
+    event = &tracemalloc_event_log.events[
+        (tracemalloc_event_log.start + tracemalloc_event_log.len)
+        % tracemalloc_event_log.capacity];
+    tracemalloc_event_log.len++;
+
+    event->timestamp = event_log_time();
+    event->ptr = (unsigned PY_LONG_LONG)(Py_uintptr_t)ptr;
+    event->size = size;
+    event->traceback = (unsigned PY_LONG_LONG)(Py_uintptr_t)traceback;
+    event->op = op;
+    event->reserved = 0;
+}
+
+/* Replace the buffer of the event log and drop its events.
+   TABLES_LOCK() must not be held. */
+static void
+event_log_set_buffer(event_t *events, size_t capacity)
+{
+    event_t *old_events;
+    size_t i, index;
+
+    TABLES_LOCK();
+    for (i=0; i < tracemalloc_event_log.len; i++) {
+        index = (tracemalloc_event_log.start + i) % tracemalloc_event_log.capacity;
+        traceback_decref(EVENT_TRACEBACK(&tracemalloc_event_log.events[index]));
+    }
+    old_events = tracemalloc_event_log.events;
+    tracemalloc_event_log.events = events;
+    tracemalloc_event_log.capacity = capacity;
+    tracemalloc_event_log.start = 0;
+    tracemalloc_event_log.len = 0;
+    tracemalloc_event_log.lost = 0;
+    TABLES_UNLOCK();
+
+    if (old_events != NULL)
+        raw_free(old_events);
+}
+
+/* Count an event in the allocation statistics of its traceback and append
+   it to the event log. TABLES_LOCK() must be held. */
+static void
+tracemalloc_add_event(unsigned int op, void *ptr, size_t size,
+                      traceback_t *traceback)
+{
+    _Py_hashtable_entry_t *entry;
+    alloc_statistic_t *stat, new_stat;
+
+    if (tracemalloc_config.allocation_stats) {
+        entry = _Py_hashtable_get_entry(tracemalloc_allocation_stats,
+                                        traceback);
+        if (entry == NULL) {
+            memset(&new_stat, 0, sizeof(new_stat));
+            if (_Py_HASHTABLE_SET(tracemalloc_allocation_stats,
+                                  traceback, new_stat) == 0)
+                entry = _Py_hashtable_get_entry(tracemalloc_allocation_stats,
+                                                traceback);
+#ifdef TRACE_DEBUG
+            else
+                tracemalloc_error("failed to count the event: malloc failed");
+#endif
+        }
+        if (entry != NULL) {
+            stat = (alloc_statistic_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+            if (op == EVENT_ALLOC) {
+                stat->alloc_count++;
+                stat->alloc_size += size;
+            }
+            else {
+                stat->free_count++;
+            }
+        }
+    }
+    event_log_add(op, ptr, size, traceback);
+}
+
+/* Get the domain of the memory allocator of the context of a hook */
+static int
+tracemalloc_domain(void *ctx)
+{
+    if (ctx == &allocators.raw)
+        return PYMEM_DOMAIN_RAW;
+    if (ctx == &allocators.mem)
+        return PYMEM_DOMAIN_MEM;
+    return PYMEM_DOMAIN_OBJ;
+}
+
+/* Custom domains are only counted in the total size: pass DOMAIN_CUSTOM.
+   TABLES_LOCK() must be held */
+static void
+traced_memory_add(int domain, size_t size)
+{
+    size_t *traced;
+
+    TRACED_MEMORY_WRITE_BEGIN();
+    assert(tracemalloc_traced_memory <= PY_SIZE_MAX - size);
+    tracemalloc_traced_memory += size;
+    if (tracemalloc_traced_memory > tracemalloc_peak_traced_memory)
+        tracemalloc_peak_traced_memory = tracemalloc_traced_memory;
+
+    if (domain != DOMAIN_CUSTOM) {
+        traced = &tracemalloc_domain_traced_memory[domain];
+        *traced += size;
+        if (*traced > tracemalloc_domain_peak_traced_memory[domain])
+            tracemalloc_domain_peak_traced_memory[domain] = *traced;
+    }
+    TRACED_MEMORY_WRITE_END();
+}
+
+/* TABLES_LOCK() must be held */
+static void
+traced_memory_sub(int domain, size_t size)
+{
+    TRACED_MEMORY_WRITE_BEGIN();
+    assert(tracemalloc_traced_memory >= size);
+    tracemalloc_traced_memory -= size;
+    if (domain != DOMAIN_CUSTOM) {
+        assert(tracemalloc_domain_traced_memory[domain] >= size);
+        tracemalloc_domain_traced_memory[domain] -= size;
+    }
+    TRACED_MEMORY_WRITE_END();
+}
+
+static int
+tracemalloc_add_trace(void *ptr, size_t size, int domain)
+{
+    traceback_t *traceback;
+    trace_t trace;
+    int nframe;
+    int res;
+
+    nframe = traceback_get_frames(tracemalloc_frames);
+    if (tracemalloc_filters.nfilter != 0
+        && !tracemalloc_filter_frames(tracemalloc_frames, nframe)) {
+        /* the memory block is filtered out: don't trace it */
+        return 0;
+    }
+
+    traceback = traceback_new(nframe);
+    if (traceback == NULL)
+        return -1;
+
+    trace.size = size;
+    TRACE_SET_TRACEBACK(&trace, traceback, domain);
+
+    res = traces_table_set(&tracemalloc_traces, ptr, &trace);
+    if (res == 0) {
+        traceback_incref(traceback);
+        tracemalloc_add_event(EVENT_ALLOC, ptr, size, traceback);
+        traced_memory_add(domain, size);
+    }
+
+    return res;
+}
+
+static void
+tracemalloc_remove_trace(void *ptr)
+{
+    trace_t trace;
+
+    if (traces_table_pop(&tracemalloc_traces, ptr, &trace)) {
+        traced_memory_sub(TRACE_DOMAIN(&trace), trace.size);
+        tracemalloc_add_event(EVENT_FREE, ptr, trace.size,
+                              TRACE_TRACEBACK(&trace));
+        traceback_decref(TRACE_TRACEBACK(&trace));
+    }
+}
+
+/* TABLES_LOCK() must be held */
+static int
+tracemalloc_add_custom_trace(unsigned int domain, void *ptr, size_t size)
+{
+    traceback_t *traceback;
+    custom_trace_t custom;
+    int nframe;
+    int res;
+
+    nframe = traceback_get_frames(tracemalloc_frames);
+    if (tracemalloc_filters.nfilter != 0
+        && !tracemalloc_filter_frames(tracemalloc_frames, nframe)) {
+        /* the memory block is filtered out: don't trace it */
+        return 0;
+    }
+
+    traceback = traceback_new(nframe);
+    if (traceback == NULL)
+        return -1;
+
+    custom.trace.size = size;
+    TRACE_SET_TRACEBACK(&custom.trace, traceback, DOMAIN_CUSTOM);
+    custom.domain = domain;
+
+    res = _Py_HASHTABLE_SET(tracemalloc_custom_traces, ptr, custom);
+    if (res == 0) {
+        traceback_incref(traceback);
+        tracemalloc_add_event(EVENT_ALLOC, ptr, size, traceback);
+        traced_memory_add(DOMAIN_CUSTOM, size);
+    }
+
+    return res;
+}
+
+/* TABLES_LOCK() must be held */
+static void
+tracemalloc_remove_custom_trace(void *ptr)
+{
+    custom_trace_t custom;
+
+    if (_Py_hashtable_pop(tracemalloc_custom_traces, ptr,
+                          &custom, sizeof(custom))) {
+        traced_memory_sub(DOMAIN_CUSTOM, custom.trace.size);
+        tracemalloc_add_event(EVENT_FREE, ptr, custom.trace.size,
+                              TRACE_TRACEBACK(&custom.trace));
+        traceback_decref(TRACE_TRACEBACK(&custom.trace));
+    }
+}
+
+/* Update the trace of the memory block ptr resized to ptr2 without removing
+   and adding it again, when possible: resized in place, or the traceback is
+   kept. Return 1 if the trace has been updated or removed, 0 if ptr is not
+   traced or if the trace must be removed and added again.
+   TABLES_LOCK() must be held. */
+static int
+tracemalloc_resize_trace(void *ptr, void *ptr2, size_t new_size)
+{
+    trace_t *trace;
+    traceback_t *traceback;
+    int nframe;
+
+    if (tracemalloc_config.realloc_traceback == REALLOC_TRACEBACK_ALLOCATION) {
+        trace_t old_trace;
+
+        if (ptr2 == ptr) {
+            trace = traces_table_get_trace(&tracemalloc_traces, ptr);
+            if (trace == NULL)
+                return 0;
+            if (new_size < tracemalloc_config.min_size) {
+                tracemalloc_untraced_memory += new_size;
+                tracemalloc_remove_trace(ptr);
+                return 1;
+            }
+            tracemalloc_add_event(EVENT_FREE, ptr, trace->size,
+                                  TRACE_TRACEBACK(trace));
+        }
+        else {
+            /* the memory block has been moved */
+            if (!traces_table_pop(&tracemalloc_traces, ptr, &old_trace))
+                return 0;
+            traced_memory_sub(TRACE_DOMAIN(&old_trace), old_trace.size);
+            tracemalloc_add_event(EVENT_FREE, ptr, old_trace.size,
+                                  TRACE_TRACEBACK(&old_trace));
+
+            if (new_size < tracemalloc_config.min_size) {
+                tracemalloc_untraced_memory += new_size;
+                traceback_decref(TRACE_TRACEBACK(&old_trace));
+                return 1;
+            }
+
+            old_trace.size = 0;
+            if (traces_table_set(&tracemalloc_traces, ptr2, &old_trace) < 0) {
+                /* the table has just released an entry, so this case is
+                   very unlikely: the trace is lost */
+                traceback_decref(TRACE_TRACEBACK(&old_trace));
+                return 1;
+            }
+            trace = traces_table_get_trace(&tracemalloc_traces, ptr2);
+            assert(trace != NULL);
+        }
+    }
+    else {
+        /* fast path for memory blocks resized in place: don't release and
+           allocate again the entry of the trace */
+        if (ptr2 != ptr)
+            return 0;
+        trace = traces_table_get_trace(&tracemalloc_traces, ptr);
+        if (trace == NULL)
+            return 0;
+
+        if (!tracemalloc_sample(new_size))
+            goto remove;
+
+        nframe = traceback_get_frames(tracemalloc_frames);
+        if (tracemalloc_filters.nfilter != 0
+            && !tracemalloc_filter_frames(tracemalloc_frames, nframe))
+            goto remove;
+
+        traceback = traceback_new(nframe);
+        if (traceback == NULL)
+            goto remove;
+
+        /* increment the new traceback first, the old traceback
+           may share its nodes */
+        traceback_incref(traceback);
+        tracemalloc_add_event(EVENT_FREE, ptr, trace->size,
+                              TRACE_TRACEBACK(trace));
+        traceback_decref(TRACE_TRACEBACK(trace));
+        TRACE_SET_TRACEBACK(trace, traceback, TRACE_DOMAIN(trace));
+    }
+
+    traced_memory_sub(TRACE_DOMAIN(trace), trace->size);
+    traced_memory_add(TRACE_DOMAIN(trace), new_size);
+    trace->size = new_size;
+    tracemalloc_add_event(EVENT_ALLOC, ptr2, new_size,
+                          TRACE_TRACEBACK(trace));
+    return 1;
+
+remove:
+    tracemalloc_remove_trace(ptr);
+    return 1;
+}
+
+static void*
+tracemalloc_malloc(void *ctx, size_t size)
+{
+    PyMemAllocator *alloc = (PyMemAllocator *)ctx;
     void *ptr;
 
     ptr = alloc->malloc(alloc->ctx, size);
     if (ptr == NULL)
         return NULL;
 
+    if (!tracemalloc_sample(size))
+        return ptr;
+
     TABLES_LOCK();
-    if (tracemalloc_add_trace(ptr, size) < 0) {
+    if (tracemalloc_add_trace(ptr, size, tracemalloc_domain(ctx)) < 0) {
         /* Failed to allocate a trace for the new memory block */
         TABLES_UNLOCK();
         alloc->free(alloc->ctx, ptr);
@@ -540,27 +1797,41 @@ tracemalloc_realloc(void *ctx, void *ptr, size_t new_size)
         /* an existing memory block has been resized */
 
         TABLES_LOCK();
+        if (tracemalloc_resize_trace(ptr, ptr2, new_size)) {
+            TABLES_UNLOCK();
+            return ptr2;
+        }
+
         tracemalloc_remove_trace(ptr);
 
-        if (tracemalloc_add_trace(ptr2, new_size) < 0) {
+        if (tracemalloc_sample(new_size)
+            && tracemalloc_add_trace(ptr2, new_size,
+                                     tracemalloc_domain(ctx)) < 0) {
             /* Memory allocation failed. The error cannot be reported to
                the caller, because realloc() may already have shrinked the
                memory block and so removed bytes.
 
                This case is very unlikely: an hash entry has just been
                released, so the hash table should have at least one free entry.
+               When sampling, the old memory block may not have been traced:
+               the trace of the new memory block is lost.
 
                The GIL and the table lock ensures that only one thread is
                allocating memory. */
-            assert(0 && "should never happen");
+            assert(tracemalloc_config.sample_rate != 0
+                   && "should never happen");
         }
         TABLES_UNLOCK();
     }
     else {
         /* new allocation */
 
+        if (!tracemalloc_sample(new_size))
+            return ptr2;
+
         TABLES_LOCK();
-        if (tracemalloc_add_trace(ptr2, new_size) < 0) {
+        if (tracemalloc_add_trace(ptr2, new_size,
+                                  tracemalloc_domain(ctx)) < 0) {
             /* Failed to allocate a trace for the new memory block */
             TABLES_UNLOCK();
             alloc->free(alloc->ctx, ptr2);
@@ -713,24 +1984,102 @@ tracemalloc_raw_realloc(void *ctx, void *ptr, size_t new_size)
 }
 #endif   /* TRACE_RAW_MALLOC */
 
+/* Track a memory block allocated by a custom memory allocator: function of
+   the C API, see tracemalloc.h */
 static int
-tracemalloc_clear_filename(_Py_hashtable_entry_t *entry, void *user_data)
+tracemalloc_track(unsigned int domain, Py_uintptr_t ptr, size_t size)
 {
-    PyObject *filename = (PyObject *)entry->key;
-    Py_DECREF(filename);
-    return 0;
+#ifdef WITH_THREAD
+    PyGILState_STATE gil_state;
+#endif
+    int res;
+
+    if (domain < PyTraceMalloc_FIRST_CUSTOM_DOMAIN)
+        return -1;
+
+    if (!tracemalloc_config.tracing)
+        return -2;
+
+    if (get_reentrant()) {
+        /* called while tracemalloc is allocating memory */
+        return 0;
+    }
+
+    /* Don't trace memory allocated to get the traceback */
+    set_reentrant(1);
+
+#ifdef WITH_THREAD
+    gil_state = PyGILState_Ensure();
+#endif
+
+    if (tracemalloc_config.tracing) {
+        TABLES_LOCK();
+        /* a new memory block replaces the previous memory block tracked at
+           the same address */
+        tracemalloc_remove_custom_trace((void *)ptr);
+        if (tracemalloc_sample(size))
+            res = tracemalloc_add_custom_trace(domain, (void *)ptr, size);
+        else
+            res = 0;
+        TABLES_UNLOCK();
+    }
+    else {
+        /* tracemalloc has been stopped while waiting for the GIL */
+        res = -2;
+    }
+
+#ifdef WITH_THREAD
+    PyGILState_Release(gil_state);
+#endif
+
+    set_reentrant(0);
+    return res;
 }
 
+/* Untrack a memory block allocated by a custom memory allocator: function of
+   the C API, see tracemalloc.h */
 static int
-traceback_free_traceback(_Py_hashtable_entry_t *entry, void *user_data)
+tracemalloc_untrack(unsigned int domain, Py_uintptr_t ptr)
 {
-    traceback_t *traceback = (traceback_t *)entry->key;
-    raw_free(traceback);
+    custom_trace_t *custom;
+
+    if (!tracemalloc_config.tracing)
+        return -2;
+
+    TABLES_LOCK();
+    custom = custom_traces_get((void *)ptr);
+    if (custom != NULL && custom->domain == domain)
+        tracemalloc_remove_custom_trace((void *)ptr);
+    TABLES_UNLOCK();
     return 0;
 }
 
-/* reentrant flag must be set to call this function and GIL must be held */
-static void
+static PyTraceMalloc_CAPI tracemalloc_capi = {
+    tracemalloc_track,
+    tracemalloc_untrack
+};
+
+static int
+tracemalloc_clear_filename(_Py_hashtable_entry_t *entry, void *user_data)
+{
+    filename_t *record;
+
+    record = *(filename_t **)_PY_HASHTABLE_ENTRY_DATA(entry);
+    Py_DECREF(record->filename);
+    raw_free(record);
+    return 0;
+}
+
+static int
+traceback_free_traceback(_Py_hashtable_entry_t *entry, void *user_data)
+{
+    traceback_t *traceback = (traceback_t *)entry->key;
+    raw_free(traceback);
+    return 0;
+}
+
+/* reentrant flag must be set to call this function and GIL must be held */
+static void
 tracemalloc_clear_traces(void)
 {
     /* Disable also reentrant calls to tracemalloc_malloc() to not add a new
@@ -738,18 +2087,53 @@ tracemalloc_clear_traces(void)
     assert(get_reentrant());
 
     TABLES_LOCK();
-    _Py_hashtable_clear(tracemalloc_traces);
+    /* events use tracebacks which are going to be released */
+    tracemalloc_event_log.start = 0;
+    tracemalloc_event_log.len = 0;
+    tracemalloc_event_log.lost = 0;
+
+    traces_table_clear(&tracemalloc_traces);
+    _Py_hashtable_clear(tracemalloc_custom_traces);
+    _Py_hashtable_clear(tracemalloc_allocation_stats);
+    TRACED_MEMORY_WRITE_BEGIN();
     tracemalloc_traced_memory = 0;
     tracemalloc_peak_traced_memory = 0;
-    TABLES_UNLOCK();
+    memset(tracemalloc_domain_traced_memory, 0,
+           sizeof(tracemalloc_domain_traced_memory));
+    memset(tracemalloc_domain_peak_traced_memory, 0,
+           sizeof(tracemalloc_domain_peak_traced_memory));
+    TRACED_MEMORY_WRITE_END();
 
     _Py_hashtable_foreach(tracemalloc_tracebacks, traceback_free_traceback, NULL);
     _Py_hashtable_clear(tracemalloc_tracebacks);
+    tracemalloc_unused_tracebacks = 0;
+    tracemalloc_traceback_path_len = 0;
+    tracemalloc_last_traceback = NULL;
+    tracemalloc_empty_traceback.refcnt = 1;
+    TABLES_UNLOCK();
+
+    tracemalloc_untraced_memory = 0;
 
+    memset(tracemalloc_filename_cache, 0, sizeof(tracemalloc_filename_cache));
     _Py_hashtable_foreach(tracemalloc_filenames, tracemalloc_clear_filename, NULL);
     _Py_hashtable_clear(tracemalloc_filenames);
 }
 
+static void
+tracemalloc_clear_filters(void)
+{
+    int i;
+
+    for (i=0; i < tracemalloc_filters.nfilter; i++)
+        Py_CLEAR(tracemalloc_filters.filters[i].pattern);
+    tracemalloc_filters.nfilter = 0;
+    tracemalloc_filters.include_first = 0;
+    tracemalloc_filters.include_all = 0;
+    tracemalloc_filters.exclude_first = 0;
+    tracemalloc_filters.exclude_all = 0;
+    tracemalloc_filters.lineno = 0;
+}
+
 static int
 tracemalloc_init(void)
 {
@@ -786,7 +2170,7 @@ tracemalloc_init(void)
     }
 #endif
 
-    tracemalloc_filenames = hashtable_new(0,
+    tracemalloc_filenames = hashtable_new(sizeof(filename_t *),
                                           (_Py_hashtable_hash_func)PyObject_Hash,
                                           hashtable_compare_unicode);
 
@@ -794,27 +2178,42 @@ tracemalloc_init(void)
                                            (_Py_hashtable_hash_func)hashtable_hash_traceback,
                                            (_Py_hashtable_compare_func)hashtable_compare_traceback);
 
-    tracemalloc_traces = hashtable_new(sizeof(trace_t),
-                                       _Py_hashtable_hash_ptr,
-                                       _Py_hashtable_compare_direct);
+    tracemalloc_custom_traces = hashtable_new(sizeof(custom_trace_t),
+                                              _Py_hashtable_hash_ptr,
+                                              _Py_hashtable_compare_direct);
+
+    tracemalloc_allocation_stats = hashtable_new(sizeof(alloc_statistic_t),
+                                                 _Py_hashtable_hash_ptr,
+                                                 _Py_hashtable_compare_direct);
 
     if (tracemalloc_filenames == NULL || tracemalloc_tracebacks == NULL
-        || tracemalloc_traces == NULL)
+        || tracemalloc_custom_traces == NULL
+        || tracemalloc_allocation_stats == NULL
+        || traces_table_new(&tracemalloc_traces,
+                            tracemalloc_config.traces_table) < 0)
     {
         PyErr_NoMemory();
         return -1;
     }
 
-    unknown_filename = STRING_FROMSTRING("<unknown>");
-    if (unknown_filename == NULL)
+    tracemalloc_unknown_filename.filename = STRING_FROMSTRING("<unknown>");
+    if (tracemalloc_unknown_filename.filename == NULL)
         return -1;
-    STRING_INTERN_IN_PLACE(&unknown_filename);
+    STRING_INTERN_IN_PLACE(&tracemalloc_unknown_filename.filename);
+    tracemalloc_unknown_filename.hash =
+        PyObject_Hash(tracemalloc_unknown_filename.filename);
 
     tracemalloc_empty_traceback.nframe = 1;
-    /* borrowed reference */
-    tracemalloc_empty_traceback.frames[0].filename = unknown_filename;
-    tracemalloc_empty_traceback.frames[0].lineno = 0;
+    tracemalloc_empty_traceback.parent = NULL;
+    /* the empty traceback is not interned and must never be released */
+    tracemalloc_empty_traceback.refcnt = 1;
+    /* the unknown filename is not interned and must never be released */
+    tracemalloc_empty_traceback.frame.filename =
+        &tracemalloc_unknown_filename;
+    tracemalloc_empty_traceback.frame.lineno = 0;
     tracemalloc_empty_traceback.hash = traceback_hash(&tracemalloc_empty_traceback);
+    /* the domain of a trace is stored in the low bits of its traceback */
+    assert(((Py_uintptr_t)&tracemalloc_empty_traceback & DOMAIN_MASK) == 0);
 
     /* Disable tracing allocations until hooks are installed. Set
        also the reentrant flag to detect bugs: fail with an assertion error
@@ -833,9 +2232,13 @@ tracemalloc_deinit(void)
     tracemalloc_config.initialized = TRACEMALLOC_FINALIZED;
 
     tracemalloc_stop();
+    tracemalloc_clear_filters();
+    event_log_set_buffer(NULL, 0);
 
     /* destroy hash tables */
-    _Py_hashtable_destroy(tracemalloc_traces);
+    traces_table_destroy(&tracemalloc_traces);
+    _Py_hashtable_destroy(tracemalloc_custom_traces);
+    _Py_hashtable_destroy(tracemalloc_allocation_stats);
     _Py_hashtable_destroy(tracemalloc_tracebacks);
     _Py_hashtable_destroy(tracemalloc_filenames);
 
@@ -850,7 +2253,7 @@ tracemalloc_deinit(void)
     PyThread_delete_key(tracemalloc_reentrant_key);
 #endif
 
-    Py_XDECREF(unknown_filename);
+    Py_CLEAR(tracemalloc_unknown_filename.filename);
 }
 
 static PyObject*
@@ -902,10 +2305,12 @@ done:
 }
 
 static int
-tracemalloc_start(int max_nframe)
+tracemalloc_start(int max_nframe, traces_table_kind_t traces_table,
+                  size_t sample_rate, size_t min_size,
+                  realloc_traceback_t realloc_traceback,
+                  int allocation_stats)
 {
     PyMemAllocator alloc;
-    size_t size;
 
     if (tracemalloc_init() < 0)
         return -1;
@@ -918,11 +2323,46 @@ tracemalloc_start(int max_nframe)
     assert(1 <= max_nframe && max_nframe <= MAX_NFRAME);
     tracemalloc_config.max_nframe = max_nframe;
 
-    /* allocate a buffer to store a new traceback */
-    size = TRACEBACK_SIZE(max_nframe);
-    assert(tracemalloc_traceback == NULL);
-    tracemalloc_traceback = raw_malloc(size);
-    if (tracemalloc_traceback == NULL) {
+    tracemalloc_config.sample_rate = sample_rate;
+    if (sample_rate != 0) {
+        /* use the same sequence of intervals at each start() */
+        tracemalloc_sample_seed = 1;
+        tracemalloc_sample_countdown = tracemalloc_sample_interval();
+    }
+    tracemalloc_config.min_size = min_size;
+    tracemalloc_config.realloc_traceback = realloc_traceback;
+    tracemalloc_config.allocation_stats = allocation_stats;
+
+    if (traces_table != tracemalloc_config.traces_table) {
+        /* the table is empty since tracemalloc is not tracing */
+        traces_table_t new_traces, old_traces;
+
+        if (traces_table_new(&new_traces, traces_table) < 0) {
+            PyErr_NoMemory();
+            return -1;
+        }
+
+        TABLES_LOCK();
+        old_traces = tracemalloc_traces;
+        tracemalloc_traces = new_traces;
+        TABLES_UNLOCK();
+
+        traces_table_destroy(&old_traces);
+        tracemalloc_config.traces_table = traces_table;
+    }
+
+    /* allocate buffers to build a new traceback */
+    assert(tracemalloc_frames == NULL);
+    assert(tracemalloc_traceback_path == NULL);
+    tracemalloc_frames = raw_malloc(sizeof(frame_t) * max_nframe);
+    tracemalloc_traceback_path = raw_malloc(sizeof(traceback_t *) * max_nframe);
+    if (tracemalloc_frames == NULL || tracemalloc_traceback_path == NULL) {
+        if (tracemalloc_frames != NULL)
+            raw_free(tracemalloc_frames);
+        if (tracemalloc_traceback_path != NULL)
+            raw_free(tracemalloc_traceback_path);
+        tracemalloc_frames = NULL;
+        tracemalloc_traceback_path = NULL;
         PyErr_NoMemory();
         return -1;
     }
@@ -978,8 +2418,10 @@ tracemalloc_stop(void)
 
     /* release memory */
     tracemalloc_clear_traces();
-    raw_free(tracemalloc_traceback);
-    tracemalloc_traceback = NULL;
+    raw_free(tracemalloc_frames);
+    tracemalloc_frames = NULL;
+    raw_free(tracemalloc_traceback_path);
+    tracemalloc_traceback_path = NULL;
 }
 
 static PyObject*
@@ -1030,10 +2472,9 @@ frame_to_pyobject(frame_t *frame)
     if (frame_obj == NULL)
         return NULL;
 
-    if (frame->filename == NULL)
-        frame->filename = Py_None;
-    Py_INCREF(frame->filename);
-    PyTuple_SET_ITEM(frame_obj, 0, frame->filename);
+    assert(frame->filename != NULL && frame->filename->filename != NULL);
+    Py_INCREF(frame->filename->filename);
+    PyTuple_SET_ITEM(frame_obj, 0, frame->filename->filename);
 
     assert(frame->lineno >= 0);
     lineno_obj = lineno_as_obj(frame->lineno);
@@ -1051,6 +2492,7 @@ traceback_to_pyobject(traceback_t *traceback, _Py_hashtable_t *intern_table)
 {
     int i;
     PyObject *frames, *frame;
+    traceback_t *node;
 
     if (intern_table != NULL) {
         if (_Py_HASHTABLE_GET(intern_table, traceback, frames)) {
@@ -1063,8 +2505,11 @@ traceback_to_pyobject(traceback_t *traceback, _Py_hashtable_t *intern_table)
     if (frames == NULL)
         return NULL;
 
+    node = traceback;
     for (i=0; i < traceback->nframe; i++) {
-        frame = frame_to_pyobject(&traceback->frames[i]);
+        assert(node != NULL);
+        frame = frame_to_pyobject(&node->frame);
+        node = node->parent;
         if (frame == NULL) {
             Py_DECREF(frames);
             return NULL;
@@ -1088,9 +2533,9 @@ static PyObject*
 trace_to_pyobject(trace_t *trace, _Py_hashtable_t *intern_tracebacks)
 {
     PyObject *trace_obj = NULL;
-    PyObject *size, *traceback;
+    PyObject *size, *traceback, *domain;
 
-    trace_obj = PyTuple_New(2);
+    trace_obj = PyTuple_New(3);
     if (trace_obj == NULL)
         return NULL;
 
@@ -1101,36 +2546,137 @@ trace_to_pyobject(trace_t *trace, _Py_hashtable_t *intern_tracebacks)
     }
     PyTuple_SET_ITEM(trace_obj, 0, size);
 
-    traceback = traceback_to_pyobject(trace->traceback, intern_tracebacks);
+    traceback = traceback_to_pyobject(TRACE_TRACEBACK(trace),
+                                      intern_tracebacks);
     if (traceback == NULL) {
         Py_DECREF(trace_obj);
         return NULL;
     }
     PyTuple_SET_ITEM(trace_obj, 1, traceback);
 
+    domain = INT_FROM_LONG((long)trace_domain(trace));
+    if (domain == NULL) {
+        Py_DECREF(trace_obj);
+        return NULL;
+    }
+    PyTuple_SET_ITEM(trace_obj, 2, domain);
+
     return trace_obj;
 }
 
 typedef struct {
-    _Py_hashtable_t *traces;
+    traces_table_t traces;
+    _Py_hashtable_t *custom_traces;
     _Py_hashtable_t *tracebacks;
+    /* known types: PyTypeObject* => type name (PyObject*, NULL until it is
+       used), or NULL if types of objects are not resolved */
+    _Py_hashtable_t *types;
+    /* memory block => type of the object stored in the memory block
+       (PyTypeObject*) */
+    _Py_hashtable_t *object_types;
     PyObject *list;
 } get_traces_t;
 
+/* Get the type of the object stored in the memory block ptr of size bytes,
+   or NULL if the memory block does not store an object of a known type.
+
+   The type is read from the memory block: only bytes of the memory block are
+   read, and the type is only dereferenced if it is a known type. */
+static PyTypeObject*
+tracemalloc_object_type(const void *ptr, size_t size, _Py_hashtable_t *types)
+{
+    PyTypeObject *type;
+
+    /* object not tracked by the garbage collector: the object is stored at
+       the start of the memory block */
+    if (size >= sizeof(PyObject)) {
+        type = Py_TYPE((PyObject *)ptr);
+        if (_Py_hashtable_get_entry(types, type) != NULL
+            && !PyType_IS_GC(type))
+            return type;
+    }
+
+    /* object tracked by the garbage collector: the object is stored after
+       its PyGC_Head header, see py_tracemalloc_get_object_traceback() */
+    if (size >= sizeof(PyGC_Head) + sizeof(PyObject)) {
+        type = Py_TYPE((PyObject *)((char *)ptr + sizeof(PyGC_Head)));
+        if (_Py_hashtable_get_entry(types, type) != NULL
+            && PyType_IS_GC(type))
+            return type;
+    }
+    return NULL;
+}
+
 static int
-tracemalloc_get_traces_fill(_Py_hashtable_entry_t *entry, void *user_data)
+tracemalloc_get_object_types_cb(const void *ptr, trace_t *trace,
+                                void *user_data)
 {
     get_traces_t *get_traces = user_data;
-    trace_t *trace;
-    PyObject *tracemalloc_obj;
-    int res;
+    PyTypeObject *type;
+
+    if (TRACE_DOMAIN(trace) != PYMEM_DOMAIN_OBJ)
+        return 0;
+
+    type = tracemalloc_object_type(ptr, trace->size, get_traces->types);
+    if (type == NULL)
+        return 0;
+    if (_Py_HASHTABLE_SET(get_traces->object_types, ptr, type) < 0)
+        return -1;
+    return 0;
+}
+
+static PyObject*
+tracemalloc_get_type_name(get_traces_t *get_traces, const void *ptr)
+{
+    PyTypeObject *type;
+    _Py_hashtable_entry_t *entry;
+    PyObject *name;
+
+    if (!_Py_HASHTABLE_GET(get_traces->object_types, ptr, type)) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+
+    /* create the name once per type */
+    entry = _Py_hashtable_get_entry(get_traces->types, type);
+    assert(entry != NULL);
+    name = (PyObject *)_Py_HASHTABLE_ENTRY_DATA_AS_VOID_P(entry);
+    if (name == NULL) {
+        name = STRING_FROMSTRING(type->tp_name);
+        if (name == NULL)
+            return NULL;
+        /* the types table keeps a reference to name */
+        _Py_HASHTABLE_ENTRY_DATA_AS_VOID_P(entry) = name;
+    }
+    Py_INCREF(name);
+    return name;
+}
 
-    trace = (trace_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+static int
+tracemalloc_get_traces_fill(const void *ptr, trace_t *trace, void *user_data)
+{
+    get_traces_t *get_traces = user_data;
+    PyObject *tracemalloc_obj, *type_name;
+    int res;
 
     tracemalloc_obj = trace_to_pyobject(trace, get_traces->tracebacks);
     if (tracemalloc_obj == NULL)
         return 1;
 
+    if (get_traces->types != NULL) {
+        /* add the type name to the (size, traceback, domain) tuple */
+        type_name = tracemalloc_get_type_name(get_traces, ptr);
+        if (type_name == NULL) {
+            Py_DECREF(tracemalloc_obj);
+            return 1;
+        }
+        if (_PyTuple_Resize(&tracemalloc_obj, 4) < 0) {
+            Py_DECREF(type_name);
+            return 1;
+        }
+        PyTuple_SET_ITEM(tracemalloc_obj, 3, type_name);
+    }
+
     res = PyList_Append(get_traces->list, tracemalloc_obj);
     Py_DECREF(tracemalloc_obj);
     if (res < 0)
@@ -1147,23 +2693,46 @@ tracemalloc_pyobject_decref_cb(_Py_hashtable_entry_t *entry, void *user_data)
     return 0;
 }
 
+static int
+tracemalloc_pyobject_xdecref_cb(_Py_hashtable_entry_t *entry, void *user_data)
+{
+    PyObject *obj = (PyObject *)_Py_HASHTABLE_ENTRY_DATA_AS_VOID_P(entry);
+    Py_XDECREF(obj);
+    return 0;
+}
+
 PyDoc_STRVAR(tracemalloc_get_traces_doc,
-    "_get_traces() -> list\n"
+    "_get_traces(types=None) -> list\n"
     "\n"
     "Get traces of all memory blocks allocated by Python.\n"
-    "Return a list of (size: int, traceback: tuple) tuples.\n"
+    "Return a list of (size: int, traceback: tuple, domain: int) tuples.\n"
     "traceback is a tuple of (filename: str, lineno: int) tuples.\n"
     "\n"
+    "If types is a sequence of types, resolve the type of objects stored in\n"
+    "memory blocks and add the type name (str, or None if the memory block\n"
+    "does not store an object of one of these types) to each trace tuple.\n"
+    "\n"
     "Return an empty list if the tracemalloc module is disabled.");
 
 static PyObject*
-py_tracemalloc_get_traces(PyObject *self, PyObject *obj)
+py_tracemalloc_get_traces(PyObject *self, PyObject *args)
 {
     get_traces_t get_traces;
+    PyObject *types_obj = Py_None, *types_seq = NULL;
+    PyObject *name = NULL;
+    Py_ssize_t i;
     int err;
+    int keep_tracebacks = 0;
 
-    get_traces.traces = NULL;
+    if (!PyArg_ParseTuple(args, "|O:_get_traces", &types_obj))
+        return NULL;
+
+    get_traces.traces.open = NULL;
+    get_traces.traces.chained = NULL;
+    get_traces.custom_traces = NULL;
     get_traces.tracebacks = NULL;
+    get_traces.types = NULL;
+    get_traces.object_types = NULL;
     get_traces.list = PyList_New(0);
     if (get_traces.list == NULL)
         goto error;
@@ -1171,6 +2740,40 @@ py_tracemalloc_get_traces(PyObject *self, PyObject *obj)
     if (!tracemalloc_config.tracing)
         return get_traces.list;
 
+    if (types_obj != Py_None) {
+        /* types_seq keeps types alive until the trace tuples are created */
+        types_seq = PySequence_Fast(types_obj, "types must be a sequence");
+        if (types_seq == NULL)
+            goto error;
+
+        get_traces.types = hashtable_new(sizeof(PyObject *),
+                                         _Py_hashtable_hash_ptr,
+                                         _Py_hashtable_compare_direct);
+        get_traces.object_types = hashtable_new(sizeof(PyTypeObject *),
+                                                _Py_hashtable_hash_ptr,
+                                                _Py_hashtable_compare_direct);
+        if (get_traces.types == NULL || get_traces.object_types == NULL) {
+            PyErr_NoMemory();
+            goto error;
+        }
+
+        for (i = 0; i < PySequence_Fast_GET_SIZE(types_seq); i++) {
+            PyObject *type = PySequence_Fast_GET_ITEM(types_seq, i);
+            if (!PyType_Check(type)) {
+                PyErr_Format(PyExc_TypeError,
+                             "types must be a sequence of types, "
+                             "not %.200s", Py_TYPE(type)->tp_name);
+                goto error;
+            }
+            if (_Py_hashtable_get_entry(get_traces.types, type) != NULL)
+                continue;
+            if (_Py_HASHTABLE_SET(get_traces.types, type, name) < 0) {
+                PyErr_NoMemory();
+                goto error;
+            }
+        }
+    }
+
     /* the traceback hash table is used temporarily to intern traceback tuple
        of (filename, lineno) tuples */
     get_traces.tracebacks = hashtable_new(sizeof(PyObject *),
@@ -1182,17 +2785,43 @@ py_tracemalloc_get_traces(PyObject *self, PyObject *obj)
     }
 
     TABLES_LOCK();
-    get_traces.traces = _Py_hashtable_copy(tracemalloc_traces);
+    err = traces_table_copy(&get_traces.traces, &tracemalloc_traces);
+    if (!err) {
+        get_traces.custom_traces = _Py_hashtable_copy(tracemalloc_custom_traces);
+        if (get_traces.custom_traces == NULL)
+            err = -1;
+    }
+    if (!err) {
+        /* tracebacks of the copy must not be released by other threads */
+        tracemalloc_keep_tracebacks++;
+    }
     TABLES_UNLOCK();
 
-    if (get_traces.traces == NULL) {
+    if (err) {
         PyErr_NoMemory();
         goto error;
     }
+    keep_tracebacks = 1;
+
+    if (get_traces.types != NULL) {
+        /* Resolve types before creating Python objects: creating objects can
+           run the garbage collector which releases memory blocks. Objects of
+           the object domain cannot be released without holding the GIL. */
+        err = traces_table_foreach(&get_traces.traces,
+                                   tracemalloc_get_object_types_cb,
+                                   &get_traces);
+        if (err) {
+            PyErr_NoMemory();
+            goto error;
+        }
+    }
 
     set_reentrant(1);
-    err = _Py_hashtable_foreach(get_traces.traces,
-                                tracemalloc_get_traces_fill, &get_traces);
+    err = traces_table_foreach(&get_traces.traces,
+                               tracemalloc_get_traces_fill, &get_traces);
+    if (!err)
+        err = custom_traces_foreach(get_traces.custom_traces,
+                                    tracemalloc_get_traces_fill, &get_traces);
     set_reentrant(0);
     if (err)
         goto error;
@@ -1208,8 +2837,23 @@ finally:
                          tracemalloc_pyobject_decref_cb, NULL);
         _Py_hashtable_destroy(get_traces.tracebacks);
     }
-    if (get_traces.traces != NULL)
-        _Py_hashtable_destroy(get_traces.traces);
+    if (get_traces.types != NULL) {
+        _Py_hashtable_foreach(get_traces.types,
+                              tracemalloc_pyobject_xdecref_cb, NULL);
+        _Py_hashtable_destroy(get_traces.types);
+    }
+    if (get_traces.object_types != NULL)
+        _Py_hashtable_destroy(get_traces.object_types);
+    Py_XDECREF(types_seq);
+    traces_table_destroy(&get_traces.traces);
+    if (get_traces.custom_traces != NULL)
+        _Py_hashtable_destroy(get_traces.custom_traces);
+
+    if (keep_tracebacks) {
+        TABLES_LOCK();
+        tracemalloc_keep_tracebacks--;
+        TABLES_UNLOCK();
+    }
 
     return get_traces.list;
 }
@@ -1241,139 +2885,1741 @@ py_tracemalloc_get_object_traceback(PyObject *self, PyObject *obj)
         ptr = (void *)obj;
 
     TABLES_LOCK();
-    found = _Py_HASHTABLE_GET(tracemalloc_traces, ptr, trace);
+    found = traces_table_get(&tracemalloc_traces, ptr, &trace);
     TABLES_UNLOCK();
 
     if (!found)
         Py_RETURN_NONE;
 
-    return traceback_to_pyobject(trace.traceback, NULL);
+    /* obj is alive, so its trace keeps the traceback alive */
+    return traceback_to_pyobject(TRACE_TRACEBACK(&trace), NULL);
 }
 
-PyDoc_STRVAR(tracemalloc_start_doc,
-    "start(nframe: int=1)\n"
-    "\n"
-    "Start tracing Python memory allocations. Set also the maximum number \n"
-    "of frames stored in the traceback of a trace to nframe.");
-
-static PyObject*
-py_tracemalloc_start(PyObject *self, PyObject *args)
-{
-    Py_ssize_t nframe = 1;
-    int nframe_int;
+/* Key of statistics computed by _get_statistics() */
+typedef enum {
+    STATS_KEY_TRACEBACK,
+    STATS_KEY_LINENO,
+    STATS_KEY_FILENAME,
+    STATS_KEY_DOMAIN
+} stats_key_t;
 
-    if (!PyArg_ParseTuple(args, "|n:start", &nframe))
-        return NULL;
+/* Statistic on memory blocks grouped by a key */
+typedef struct {
+    size_t size;
+    size_t count;
+    /* estimated size and number of memory blocks if memory blocks are
+       sampled: see _sampled_estimate() in tracemalloc.py */
+    double estimated_size;
+    double estimated_count;
+} statistic_t;
 
-    if (nframe < 1 || nframe > MAX_NFRAME) {
-        PyErr_Format(PyExc_ValueError,
-                     "the number of frames must be in range [1; %i]",
-                     (int)MAX_NFRAME);
-        return NULL;
-    }
-    nframe_int = Py_SAFE_DOWNCAST(nframe, Py_ssize_t, int);
+typedef struct {
+    stats_key_t key_type;
+    int cumulative;
+    size_t sample_rate;
+    /* key => statistic_t, keys are traceback_t*, frame_t* or filename_t*
+       depending on key_type */
+    _Py_hashtable_t *stats;
+    /* list of (traceback, size, count) tuples */
+    PyObject *list;
+} get_statistics_t;
 
-    if (tracemalloc_start(nframe_int) < 0)
-        return NULL;
+static Py_uhash_t
+hashtable_hash_frame(const void *key)
+{
+    const frame_t *frame = key;
+    Py_uhash_t hash;
 
-    Py_RETURN_NONE;
+    hash = frame->filename->hash;
+    hash ^= (Py_uhash_t)frame->lineno * _PyHASH_MULTIPLIER;
+    return hash;
 }
 
-PyDoc_STRVAR(tracemalloc_stop_doc,
-    "stop()\n"
-    "\n"
-    "Stop tracing Python memory allocations and clear traces\n"
-    "of memory blocks allocated by Python.");
+static int
+hashtable_compare_frame(const void *key, const _Py_hashtable_entry_t *he)
+{
+    const frame_t *frame1 = key;
+    const frame_t *frame2 = he->key;
 
-static PyObject*
-py_tracemalloc_stop(PyObject *self)
+    return (frame1->filename == frame2->filename
+            && frame1->lineno == frame2->lineno);
+}
+
+static int
+statistics_add(get_statistics_t *get_stats, const void *key, size_t size)
 {
-    tracemalloc_stop();
-    Py_RETURN_NONE;
+    _Py_hashtable_entry_t *entry;
+    statistic_t *stat, new_stat;
+    double weight;
+
+    entry = _Py_hashtable_get_entry(get_stats->stats, key);
+    if (entry != NULL) {
+        stat = (statistic_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+    }
+    else {
+        memset(&new_stat, 0, sizeof(new_stat));
+        if (_Py_HASHTABLE_SET(get_stats->stats, key, new_stat) < 0)
+            return -1;
+        entry = _Py_hashtable_get_entry(get_stats->stats, key);
+        assert(entry != NULL);
+        stat = (statistic_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+    }
+
+    stat->size += size;
+    stat->count++;
+    if (get_stats->sample_rate) {
+        /* weight the memory block by the inverse of the probability to
+           sample it */
+        weight = 1.0 / (1.0 - exp(-(double)size
+                                  / (double)get_stats->sample_rate));
+        stat->estimated_size += (double)size * weight;
+        stat->estimated_count += weight;
+    }
+    return 0;
 }
 
-PyDoc_STRVAR(tracemalloc_get_traceback_limit_doc,
-    "get_traceback_limit() -> int\n"
-    "\n"
-    "Get the maximum number of frames stored in the traceback\n"
-    "of a trace.\n"
-    "\n"
-    "By default, a trace of an allocated memory block only stores\n"
-    "the most recent frame: the limit is 1.");
+static int
+statistics_add_trace(const void *ptr, trace_t *trace, void *user_data)
+{
+    get_statistics_t *get_stats = user_data;
+    traceback_t *node = TRACE_TRACEBACK(trace);
+    const void *key;
+
+    if (!get_stats->cumulative) {
+        if (get_stats->key_type == STATS_KEY_TRACEBACK)
+            key = node;
+        else if (get_stats->key_type == STATS_KEY_DOMAIN)
+            key = (const void *)(Py_uintptr_t)trace_domain(trace);
+        else if (get_stats->key_type == STATS_KEY_LINENO)
+            key = &node->frame;
+        else
+            key = node->frame.filename;
+        return statistics_add(get_stats, key, trace->size);
+    }
+
+    /* cumulative statistics: the memory block is counted for each frame */
+    for (; node != NULL; node = node->parent) {
+        if (get_stats->key_type == STATS_KEY_LINENO)
+            key = &node->frame;
+        else
+            key = node->frame.filename;
+        if (statistics_add(get_stats, key, trace->size) < 0)
+            return -1;
+    }
+    return 0;
+}
 
 static PyObject*
-py_tracemalloc_get_traceback_limit(PyObject *self)
+statistic_key_to_pyobject(get_statistics_t *get_stats, const void *key)
 {
-    return INT_FROM_LONG(tracemalloc_config.max_nframe);
-}
+    PyObject *frames, *frame, *filename, *lineno;
+    frame_t frame_data;
 
-PyDoc_STRVAR(tracemalloc_get_tracemalloc_memory_doc,
-    "get_tracemalloc_memory() -> int\n"
-    "\n"
-    "Get the memory usage in bytes of the tracemalloc module\n"
-    "used internally to trace memory allocations.");
+    if (get_stats->key_type == STATS_KEY_TRACEBACK)
+        return traceback_to_pyobject((traceback_t *)key, NULL);
+    if (get_stats->key_type == STATS_KEY_DOMAIN)
+        return INT_FROM_LONG((long)(Py_uintptr_t)key);
 
-static PyObject*
-tracemalloc_get_tracemalloc_memory(PyObject *self)
+    frames = PyTuple_New(1);
+    if (frames == NULL)
+        return NULL;
+
+    if (get_stats->key_type == STATS_KEY_LINENO) {
+        memcpy(&frame_data, key, sizeof(frame_t));
+        frame = frame_to_pyobject(&frame_data);
+    }
+    else {
+        /* group by filename: the line number is 0 */
+        frame = PyTuple_New(2);
+        if (frame != NULL) {
+            filename = ((filename_t *)key)->filename;
+            Py_INCREF(filename);
+            PyTuple_SET_ITEM(frame, 0, filename);
+            lineno = lineno_as_obj(0);
+            if (lineno == NULL) {
+                Py_CLEAR(frame);
+            }
+            else {
+                PyTuple_SET_ITEM(frame, 1, lineno);
+            }
+        }
+    }
+    if (frame == NULL) {
+        Py_DECREF(frames);
+        return NULL;
+    }
+    PyTuple_SET_ITEM(frames, 0, frame);
+    return frames;
+}
+
+static int
+statistic_to_pyobject(_Py_hashtable_entry_t *entry, void *user_data)
 {
-    size_t size;
-    PyObject *size_obj;
+    get_statistics_t *get_stats = user_data;
+    statistic_t *stat = (statistic_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+    PyObject *stat_obj, *key, *size, *count;
+    int res;
 
-    size = _Py_hashtable_size(tracemalloc_tracebacks);
-    size += _Py_hashtable_size(tracemalloc_filenames);
+    key = statistic_key_to_pyobject(get_stats, entry->key);
+    if (key == NULL)
+        return 1;
 
-    TABLES_LOCK();
-    size += _Py_hashtable_size(tracemalloc_traces);
-    TABLES_UNLOCK();
+    if (get_stats->sample_rate) {
+        size = PyFloat_FromDouble(stat->estimated_size);
+        count = PyFloat_FromDouble(stat->estimated_count);
+    }
+    else {
+        size = INT_FROM_SIZE_T(stat->size);
+        count = INT_FROM_SIZE_T(stat->count);
+    }
 
-    size_obj = INT_FROM_SIZE_T(size);
-    return Py_BuildValue("N", size_obj);
+    if (size == NULL || count == NULL)
+        stat_obj = NULL;
+    else
+        stat_obj = PyTuple_Pack(3, key, size, count);
+    Py_DECREF(key);
+    Py_XDECREF(size);
+    Py_XDECREF(count);
+    if (stat_obj == NULL)
+        return 1;
+
+    res = PyList_Append(get_stats->list, stat_obj);
+    Py_DECREF(stat_obj);
+    if (res < 0)
+        return 1;
+    return 0;
 }
 
-PyDoc_STRVAR(tracemalloc_get_traced_memory_doc,
-    "get_traced_memory() -> (int, int)\n"
+PyDoc_STRVAR(tracemalloc_get_statistics_doc,
+    "_get_statistics(key_type: str, cumulative: bool) -> list\n"
     "\n"
-    "Get the current size and peak size of memory blocks traced\n"
-    "by the tracemalloc module as a tuple: (current: int, peak: int).");
+    "Group traces of memory blocks allocated by Python by key_type\n"
+    "('traceback', 'lineno', 'filename' or 'domain') and get statistics.\n"
+    "Return a list of (traceback: tuple, size, count) tuples.\n"
+    "traceback is a tuple of (filename: str, lineno: int) tuples,\n"
+    "or the domain (int) if key_type is 'domain'.\n"
+    "size and count are floats if memory blocks are sampled.\n"
+    "\n"
+    "Return an empty list if the tracemalloc module is disabled.");
 
 static PyObject*
-tracemalloc_get_traced_memory(PyObject *self)
+py_tracemalloc_get_statistics(PyObject *self, PyObject *args)
 {
-    Py_ssize_t size, peak_size;
-    PyObject *size_obj, *peak_size_obj;
+    get_statistics_t get_stats;
+    const char *key_type;
+    int cumulative;
+    int err;
+    int keep_tracebacks = 0;
+
+    if (!PyArg_ParseTuple(args, "si:_get_statistics", &key_type, &cumulative))
+        return NULL;
+
+    if (strcmp(key_type, "traceback") == 0)
+        get_stats.key_type = STATS_KEY_TRACEBACK;
+    else if (strcmp(key_type, "lineno") == 0)
+        get_stats.key_type = STATS_KEY_LINENO;
+    else if (strcmp(key_type, "filename") == 0)
+        get_stats.key_type = STATS_KEY_FILENAME;
+    else if (strcmp(key_type, "domain") == 0)
+        get_stats.key_type = STATS_KEY_DOMAIN;
+    else {
+        PyErr_Format(PyExc_ValueError, "unknown key_type: '%s'", key_type);
+        return NULL;
+    }
+    if (cumulative && (get_stats.key_type == STATS_KEY_TRACEBACK
+                       || get_stats.key_type == STATS_KEY_DOMAIN)) {
+        PyErr_Format(PyExc_ValueError,
+                     "cumulative mode cannot by used with key type %s",
+                     key_type);
+        return NULL;
+    }
+    get_stats.cumulative = cumulative;
+    get_stats.sample_rate = tracemalloc_config.sample_rate;
+    get_stats.stats = NULL;
+    get_stats.list = PyList_New(0);
+    if (get_stats.list == NULL)
+        return NULL;
 
     if (!tracemalloc_config.tracing)
-        return Py_BuildValue("ii", 0, 0);
+        return get_stats.list;
 
+    if (get_stats.key_type == STATS_KEY_LINENO)
+        get_stats.stats = hashtable_new(sizeof(statistic_t),
+                                        hashtable_hash_frame,
+                                        hashtable_compare_frame);
+    else
+        get_stats.stats = hashtable_new(sizeof(statistic_t),
+                                        _Py_hashtable_hash_ptr,
+                                        _Py_hashtable_compare_direct);
+    if (get_stats.stats == NULL) {
+        PyErr_NoMemory();
+        goto error;
+    }
+
+    /* Group traces without creating Python objects: keys are pointers to
+       tracebacks, frames and filenames used by traces */
     TABLES_LOCK();
-    size = tracemalloc_traced_memory;
-    peak_size = tracemalloc_peak_traced_memory;
+    err = tracemalloc_foreach_trace(statistics_add_trace, &get_stats);
+    if (!err) {
+        /* keys must not be released by other threads */
+        tracemalloc_keep_tracebacks++;
+    }
     TABLES_UNLOCK();
 
-    size_obj = INT_FROM_SIZE_T(size);
-    peak_size_obj = INT_FROM_SIZE_T(peak_size);
-    return Py_BuildValue("NN", size_obj, peak_size_obj);
-}
+    if (err) {
+        PyErr_NoMemory();
+        goto error;
+    }
+    keep_tracebacks = 1;
 
-static PyMethodDef module_methods[] = {
-    {"is_tracing", (PyCFunction)py_tracemalloc_is_tracing,
-     METH_NOARGS, tracemalloc_is_tracing_doc},
-    {"clear_traces", (PyCFunction)py_tracemalloc_clear_traces,
-     METH_NOARGS, tracemalloc_clear_traces_doc},
-    {"_get_traces", (PyCFunction)py_tracemalloc_get_traces,
-     METH_NOARGS, tracemalloc_get_traces_doc},
-    {"_get_object_traceback", (PyCFunction)py_tracemalloc_get_object_traceback,
-     METH_O, tracemalloc_get_object_traceback_doc},
-    {"start", (PyCFunction)py_tracemalloc_start,
-      METH_VARARGS, tracemalloc_start_doc},
-    {"stop", (PyCFunction)py_tracemalloc_stop,
-      METH_NOARGS, tracemalloc_stop_doc},
+    set_reentrant(1);
+    err = _Py_hashtable_foreach(get_stats.stats,
+                                statistic_to_pyobject, &get_stats);
+    set_reentrant(0);
+    if (err)
+        goto error;
+
+    goto finally;
+
+error:
+    Py_CLEAR(get_stats.list);
+
+finally:
+    if (get_stats.stats != NULL)
+        _Py_hashtable_destroy(get_stats.stats);
+
+    if (keep_tracebacks) {
+        TABLES_LOCK();
+        tracemalloc_keep_tracebacks--;
+        TABLES_UNLOCK();
+    }
+
+    return get_stats.list;
+}
+
+/* Add the allocation statistic of a traceback to the statistic of a key */
+static int
+alloc_statistics_add(get_statistics_t *get_stats, const void *key,
+                     const alloc_statistic_t *traceback_stat)
+{
+    _Py_hashtable_entry_t *entry;
+    alloc_statistic_t *stat, new_stat;
+
+    entry = _Py_hashtable_get_entry(get_stats->stats, key);
+    if (entry != NULL) {
+        stat = (alloc_statistic_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+    }
+    else {
+        memset(&new_stat, 0, sizeof(new_stat));
+        if (_Py_HASHTABLE_SET(get_stats->stats, key, new_stat) < 0)
+            return -1;
+        entry = _Py_hashtable_get_entry(get_stats->stats, key);
+        assert(entry != NULL);
+        stat = (alloc_statistic_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+    }
+
+    stat->alloc_count += traceback_stat->alloc_count;
+    stat->alloc_size += traceback_stat->alloc_size;
+    stat->free_count += traceback_stat->free_count;
+    return 0;
+}
+
+static int
+alloc_statistics_add_traceback(get_statistics_t *get_stats,
+                               traceback_t *traceback,
+                               const alloc_statistic_t *traceback_stat)
+{
+    traceback_t *node;
+    const void *key;
+
+    if (!get_stats->cumulative) {
+        if (get_stats->key_type == STATS_KEY_TRACEBACK)
+            key = traceback;
+        else if (get_stats->key_type == STATS_KEY_LINENO)
+            key = &traceback->frame;
+        else
+            key = traceback->frame.filename;
+        return alloc_statistics_add(get_stats, key, traceback_stat);
+    }
+
+    /* cumulative statistics: the traceback is counted for each frame */
+    for (node = traceback; node != NULL; node = node->parent) {
+        if (get_stats->key_type == STATS_KEY_LINENO)
+            key = &node->frame;
+        else
+            key = node->frame.filename;
+        if (alloc_statistics_add(get_stats, key, traceback_stat) < 0)
+            return -1;
+    }
+    return 0;
+}
+
+static int
+alloc_statistics_add_entry(_Py_hashtable_entry_t *entry, void *user_data)
+{
+    get_statistics_t *get_stats = user_data;
+    traceback_t *traceback = (traceback_t *)entry->key;
+    alloc_statistic_t *stat;
+
+    stat = (alloc_statistic_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+    if (alloc_statistics_add_traceback(get_stats, traceback, stat) < 0)
+        return 1;
+    return 0;
+}
+
+static int
+alloc_statistic_to_pyobject(_Py_hashtable_entry_t *entry, void *user_data)
+{
+    get_statistics_t *get_stats = user_data;
+    alloc_statistic_t *stat;
+    PyObject *stat_obj, *key;
+    int res;
+
+    stat = (alloc_statistic_t *)_PY_HASHTABLE_ENTRY_DATA(entry);
+    key = statistic_key_to_pyobject(get_stats, entry->key);
+    if (key == NULL)
+        return 1;
+
+    stat_obj = Py_BuildValue("(NKKK)", key,
+                             stat->alloc_size, stat->alloc_count,
+                             stat->free_count);
+    if (stat_obj == NULL)
+        return 1;
+
+    res = PyList_Append(get_stats->list, stat_obj);
+    Py_DECREF(stat_obj);
+    if (res < 0)
+        return 1;
+    return 0;
+}
+
+PyDoc_STRVAR(tracemalloc_get_allocation_statistics_doc,
+    "_get_allocation_statistics(key_type: str, cumulative: bool) -> list\n"
+    "\n"
+    "Group cumulative allocation statistics of tracebacks by key_type\n"
+    "('traceback', 'lineno' or 'filename'). Return a list of\n"
+    "(traceback: tuple, size, count, free_count) tuples.\n"
+    "traceback is a tuple of (filename: str, lineno: int) tuples.\n"
+    "\n"
+    "Return an empty list if the tracemalloc module is disabled.");
+
+static PyObject*
+py_tracemalloc_get_allocation_statistics(PyObject *self, PyObject *args)
+{
+    get_statistics_t get_stats;
+    const char *key_type;
+    int cumulative;
+    int err;
+    int keep_tracebacks = 0;
+
+    if (!PyArg_ParseTuple(args, "si:_get_allocation_statistics",
+                          &key_type, &cumulative))
+        return NULL;
+
+    if (strcmp(key_type, "traceback") == 0)
+        get_stats.key_type = STATS_KEY_TRACEBACK;
+    else if (strcmp(key_type, "lineno") == 0)
+        get_stats.key_type = STATS_KEY_LINENO;
+    else if (strcmp(key_type, "filename") == 0)
+        get_stats.key_type = STATS_KEY_FILENAME;
+    else {
+        PyErr_Format(PyExc_ValueError, "unknown key_type: '%s'", key_type);
+        return NULL;
+    }
+    if (cumulative && get_stats.key_type == STATS_KEY_TRACEBACK) {
+        PyErr_Format(PyExc_ValueError,
+                     "cumulative mode cannot by used with key type %s",
+                     key_type);
+        return NULL;
+    }
+    get_stats.cumulative = cumulative;
+    get_stats.sample_rate = 0;
+    get_stats.stats = NULL;
+    get_stats.list = PyList_New(0);
+    if (get_stats.list == NULL)
+        return NULL;
+
+    if (!tracemalloc_config.tracing)
+        return get_stats.list;
+
+    if (!tracemalloc_config.allocation_stats) {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "allocation statistics are disabled: "
+                        "use start(allocation_stats=True)");
+        goto error;
+    }
+
+    if (get_stats.key_type == STATS_KEY_LINENO)
+        get_stats.stats = hashtable_new(sizeof(alloc_statistic_t),
+                                        hashtable_hash_frame,
+                                        hashtable_compare_frame);
+    else
+        get_stats.stats = hashtable_new(sizeof(alloc_statistic_t),
+                                        _Py_hashtable_hash_ptr,
+                                        _Py_hashtable_compare_direct);
+    if (get_stats.stats == NULL) {
+        PyErr_NoMemory();
+        goto error;
+    }
+
+    TABLES_LOCK();
+    err = _Py_hashtable_foreach(tracemalloc_allocation_stats,
+                                alloc_statistics_add_entry, &get_stats);
+    if (!err) {
+        /* keys must not be released by other threads */
+        tracemalloc_keep_tracebacks++;
+    }
+    TABLES_UNLOCK();
+
+    if (err) {
+        PyErr_NoMemory();
+        goto error;
+    }
+    keep_tracebacks = 1;
+
+    set_reentrant(1);
+    err = _Py_hashtable_foreach(get_stats.stats,
+                                alloc_statistic_to_pyobject, &get_stats);
+    set_reentrant(0);
+    if (err)
+        goto error;
+
+    goto finally;
+
+error:
+    Py_CLEAR(get_stats.list);
+
+finally:
+    if (get_stats.stats != NULL)
+        _Py_hashtable_destroy(get_stats.stats);
+
+    if (keep_tracebacks) {
+        TABLES_LOCK();
+        tracemalloc_keep_tracebacks--;
+        TABLES_UNLOCK();
+    }
+
+    return get_stats.list;
+}
+
+#ifdef WITH_PYMALLOC
+/* Memory layout of pymalloc, the allocator of PyObject_Malloc() for small
+   memory blocks: see Objects/obmalloc.c. Memory blocks of the same size class
+   are stored in pools of POOL_SIZE bytes aligned on POOL_SIZE, pools are
+   stored in arenas of 256 KB.
+
+   The alignment of memory blocks (ALIGNMENT) and the maximum size of memory
+   blocks (SMALL_REQUEST_THRESHOLD) depend on the Python version: the
+   alignment is computed from the header of each pool, and memory blocks up
+   to the largest threshold are checked. */
+#define PYMALLOC_MAX_THRESHOLD 512
+#define PYMALLOC_POOL_SIZE (4 * 1024)
+
+/* Header of a pool: struct pool_header of Objects/obmalloc.c */
+typedef struct pymalloc_pool_s {
+    /* number of allocated blocks */
+    union {
+        unsigned char *_padding;
+        unsigned int count;
+    } ref;
+    unsigned char *freeblock;
+    struct pymalloc_pool_s *nextpool;
+    struct pymalloc_pool_s *prevpool;
+    /* index of the arena of the pool */
+    unsigned int arenaindex;
+    /* size class index: the block size is (szidx + 1) * ALIGNMENT */
+    unsigned int szidx;
+    unsigned int nextoffset;
+    /* POOL_SIZE - block size */
+    unsigned int maxnextoffset;
+} pymalloc_pool_t;
+
+/* Get the pool of the memory block ptr of size bytes allocated by
+   PyObject_Malloc(), or NULL if the memory block was not allocated by
+   pymalloc. Write the maximum number of memory blocks of the pool into
+   *maxnblock. The GIL must be held. */
+static pymalloc_pool_t*
+pymalloc_get_pool(const void *ptr, size_t size, unsigned int *maxnblock)
+{
+    pymalloc_pool_t *pool;
+    size_t block_size, alignment, overhead, offset;
+
+#ifdef PYMALLOC_DEBUG
+    /* debug hooks store the size and pad bytes around the memory block */
+    ptr = (const char *)ptr - 2 * sizeof(size_t);
+    size += 4 * sizeof(size_t);
+#endif
+
+    if (size == 0 || size > PYMALLOC_MAX_THRESHOLD)
+        return NULL;
+
+    /* The pool header is in the memory page of the memory block, so it can
+       be read even if the memory block was not allocated by pymalloc. Check
+       that the header is consistent with the memory block. */
+    pool = (pymalloc_pool_t *)((Py_uintptr_t)ptr
+                               & ~(Py_uintptr_t)(PYMALLOC_POOL_SIZE - 1));
+    if (pool->maxnextoffset >= PYMALLOC_POOL_SIZE)
+        return NULL;
+    block_size = PYMALLOC_POOL_SIZE - pool->maxnextoffset;
+    /* a memory block shrinked by PyObject_Realloc() can be kept in place */
+    if (block_size < size || block_size > PYMALLOC_MAX_THRESHOLD)
+        return NULL;
+
+    alignment = block_size / ((size_t)pool->szidx + 1);
+    if ((alignment != 8 && alignment != 16)
+        || block_size != alignment * ((size_t)pool->szidx + 1))
+        return NULL;
+    overhead = (sizeof(pymalloc_pool_t) + alignment - 1) & ~(alignment - 1);
+
+    offset = (const char *)ptr - (const char *)pool;
+    if (offset < overhead || (offset - overhead) % block_size != 0)
+        return NULL;
+    *maxnblock = (unsigned int)((PYMALLOC_POOL_SIZE - overhead) / block_size);
+    if (pool->ref.count == 0 || pool->ref.count > *maxnblock)
+        return NULL;
+    return pool;
+}
+
+/* Trace of a memory block allocated by pymalloc and its pool */
+typedef struct {
+    trace_t trace;
+    pymalloc_pool_t *pool;
+    unsigned int arenaindex;
+    unsigned int nblock;
+    unsigned int maxnblock;
+    size_t block_size;
+} pymalloc_block_t;
+
+typedef struct {
+    pymalloc_block_t *blocks;
+    size_t len;
+    size_t size;
+} get_pymalloc_blocks_t;
+
+static int
+get_pymalloc_blocks_add(const void *ptr, trace_t *trace, void *user_data)
+{
+    get_pymalloc_blocks_t *get_blocks = user_data;
+    pymalloc_block_t *block;
+    pymalloc_pool_t *pool;
+    unsigned int maxnblock;
+
+    if (TRACE_DOMAIN(trace) != PYMEM_DOMAIN_OBJ)
+        return 0;
+    pool = pymalloc_get_pool(ptr, trace->size, &maxnblock);
+    if (pool == NULL)
+        return 0;
+
+    assert(get_blocks->len < get_blocks->size);
+    block = &get_blocks->blocks[get_blocks->len];
+    block->trace = *trace;
+    block->pool = pool;
+    block->arenaindex = pool->arenaindex;
+    block->nblock = pool->ref.count;
+    block->maxnblock = maxnblock;
+    block->block_size = PYMALLOC_POOL_SIZE - pool->maxnextoffset;
+    get_blocks->len++;
+    return 0;
+}
+
+static PyObject*
+pymalloc_block_to_pyobject(pymalloc_block_t *block,
+                           _Py_hashtable_t *intern_tracebacks)
+{
+    PyObject *trace, *pool, *arena, *block_size, *nblock, *maxnblock;
+    PyObject *result;
+
+    trace = trace_to_pyobject(&block->trace, intern_tracebacks);
+    pool = PyLong_FromVoidPtr(block->pool);
+    arena = INT_FROM_LONG((long)block->arenaindex);
+    block_size = INT_FROM_SIZE_T(block->block_size);
+    nblock = INT_FROM_LONG((long)block->nblock);
+    maxnblock = INT_FROM_LONG((long)block->maxnblock);
+    if (trace == NULL || pool == NULL || arena == NULL
+        || block_size == NULL || nblock == NULL || maxnblock == NULL)
+        result = NULL;
+    else
+        result = PyTuple_Pack(6, trace, pool, arena, block_size,
+                              nblock, maxnblock);
+    Py_XDECREF(trace);
+    Py_XDECREF(pool);
+    Py_XDECREF(arena);
+    Py_XDECREF(block_size);
+    Py_XDECREF(nblock);
+    Py_XDECREF(maxnblock);
+    return result;
+}
+#endif   /* WITH_PYMALLOC */
+
+PyDoc_STRVAR(tracemalloc_get_pymalloc_blocks_doc,
+    "_get_pymalloc_blocks() -> list\n"
+    "\n"
+    "Get traces of memory blocks allocated by pymalloc with their pool.\n"
+    "Return a list of (trace: tuple, pool: int, arena: int,\n"
+    "block_size: int, nblock: int, maxnblock: int) tuples: trace has the\n"
+    "format of _get_traces(), pool is the address of the pool, arena the\n"
+    "index of the arena of the pool, block_size the size of memory blocks\n"
+    "of the pool, nblock the number of allocated memory blocks in the pool\n"
+    "and maxnblock the maximum number of memory blocks of the pool.\n"
+    "\n"
+    "Return an empty list if the tracemalloc module is disabled or if\n"
+    "Python was compiled without pymalloc.");
+
+static PyObject*
+py_tracemalloc_get_pymalloc_blocks(PyObject *self)
+{
+#ifdef WITH_PYMALLOC
+    get_pymalloc_blocks_t get_blocks;
+    _Py_hashtable_t *tracebacks = NULL;
+    PyObject *list, *item;
+    size_t i;
+    int keep_tracebacks = 0;
+
+    get_blocks.blocks = NULL;
+    list = PyList_New(0);
+    if (list == NULL)
+        return NULL;
+
+    if (!tracemalloc_config.tracing)
+        return list;
+
+    tracebacks = hashtable_new(sizeof(PyObject *),
+                               _Py_hashtable_hash_ptr,
+                               _Py_hashtable_compare_direct);
+    if (tracebacks == NULL) {
+        PyErr_NoMemory();
+        goto error;
+    }
+
+    /* Pools are read while the GIL is held: pymalloc is protected by the
+       GIL, so memory blocks of the object domain cannot be allocated or
+       released by other threads. */
+    TABLES_LOCK();
+    get_blocks.len = 0;
+    get_blocks.size = traces_table_len(&tracemalloc_traces);
+    get_blocks.blocks = raw_malloc(get_blocks.size * sizeof(pymalloc_block_t)
+                                   + 1);
+    if (get_blocks.blocks != NULL) {
+        traces_table_foreach(&tracemalloc_traces,
+                             get_pymalloc_blocks_add, &get_blocks);
+        /* tracebacks of the blocks must not be released by other threads */
+        tracemalloc_keep_tracebacks++;
+    }
+    TABLES_UNLOCK();
+
+    if (get_blocks.blocks == NULL) {
+        PyErr_NoMemory();
+        goto error;
+    }
+    keep_tracebacks = 1;
+
+    set_reentrant(1);
+    for (i=0; i < get_blocks.len; i++) {
+        item = pymalloc_block_to_pyobject(&get_blocks.blocks[i], tracebacks);
+        if (item == NULL)
+            break;
+        if (PyList_Append(list, item) < 0) {
+            Py_DECREF(item);
+            break;
+        }
+        Py_DECREF(item);
+    }
+    set_reentrant(0);
+    if (i < get_blocks.len)
+        goto error;
+
+    goto finally;
+
+error:
+    Py_CLEAR(list);
+
+finally:
+    if (tracebacks != NULL) {
+        _Py_hashtable_foreach(tracebacks,
+                              tracemalloc_pyobject_decref_cb, NULL);
+        _Py_hashtable_destroy(tracebacks);
+    }
+    if (get_blocks.blocks != NULL)
+        raw_free(get_blocks.blocks);
+
+    if (keep_tracebacks) {
+        TABLES_LOCK();
+        tracemalloc_keep_tracebacks--;
+        TABLES_UNLOCK();
+    }
+
+    return list;
+#else
+    return PyList_New(0);
+#endif
+}
+
+/* Format of snapshot files: see _SNAPSHOT_MAGIC in tracemalloc.py */
+#define SNAPSHOT_MAGIC "tracemalloc\0"
+#define SNAPSHOT_MAGIC_SIZE 12
+#define SNAPSHOT_VERSION 2
+
+/* Size in bytes of the buffer of snapshot_writer_t */
+#define SNAPSHOT_BUFFER_SIZE (64 * 1024)
+
+/* Buffered writer to a file descriptor. It does not use the Python API, so
+   it can be used while TABLES_LOCK() is held. */
+typedef struct {
+    int fd;
+    char *buffer;
+    size_t len;
+    /* errno of the first write error, 0 if no error occurred */
+    int err;
+} snapshot_writer_t;
+
+static int
+snapshot_writer_flush(snapshot_writer_t *writer)
+{
+    const char *data = writer->buffer;
+    size_t len = writer->len;
+    Py_ssize_t written;
+
+    if (writer->err)
+        return -1;
+
+    while (len != 0) {
+#ifdef MS_WINDOWS
+        written = _write(writer->fd, data, (unsigned int)len);
+#else
+        written = write(writer->fd, data, len);
+#endif
+        if (written < 0) {
+            if (errno == EINTR)
+                continue;
+            writer->err = errno;
+            return -1;
+        }
+        data += written;
+        len -= written;
+    }
+    writer->len = 0;
+    return 0;
+}
+
+static int
+snapshot_writer_write(snapshot_writer_t *writer, const void *data, size_t size)
+{
+    const char *ptr = data;
+    size_t chunk;
+
+    if (writer->err)
+        return -1;
+
+    while (size != 0) {
+        chunk = SNAPSHOT_BUFFER_SIZE - writer->len;
+        if (chunk > size)
+            chunk = size;
+        memcpy(writer->buffer + writer->len, ptr, chunk);
+        writer->len += chunk;
+        ptr += chunk;
+        size -= chunk;
+
+        if (writer->len == SNAPSHOT_BUFFER_SIZE
+            && snapshot_writer_flush(writer) < 0)
+            return -1;
+    }
+    return 0;
+}
+
+/* Write an unsigned integer of size bytes in little endian */
+static int
+snapshot_writer_uint(snapshot_writer_t *writer, unsigned PY_LONG_LONG value,
+                     int size)
+{
+    unsigned char data[8];
+    int i;
+
+    assert(size <= 8);
+    for (i=0; i < size; i++) {
+        data[i] = (unsigned char)(value & 0xff);
+        value >>= 8;
+    }
+    return snapshot_writer_write(writer, data, size);
+}
+
+#define snapshot_writer_uint32(WRITER, VALUE) \
+        snapshot_writer_uint(WRITER, VALUE, 4)
+
+#define snapshot_writer_uint64(WRITER, VALUE) \
+        snapshot_writer_uint(WRITER, VALUE, 8)
+
+typedef struct {
+    snapshot_writer_t writer;
+    /* filename_t* => index (size_t) */
+    _Py_hashtable_t *filenames;
+    /* traceback_t* => index (size_t) */
+    _Py_hashtable_t *tracebacks;
+    size_t index;
+    int error;
+} dump_snapshot_t;
+
+/* Write errors are stored in the writer. Return -1 and raise an exception
+   on other errors. */
+static int
+snapshot_write_filename(dump_snapshot_t *dump, filename_t *record)
+{
+    PyObject *filename = record->filename;
+#ifdef PYTHON3
+    PyObject *encoded;
+#endif
+
+    if (_Py_HASHTABLE_SET(dump->filenames, record, dump->index) < 0) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    dump->index++;
+
+#ifdef PYTHON3
+    encoded = PyUnicode_AsEncodedString(filename, "utf-8", "surrogateescape");
+    if (encoded == NULL)
+        return -1;
+    snapshot_writer_uint32(&dump->writer, PyBytes_GET_SIZE(encoded));
+    snapshot_writer_write(&dump->writer,
+                          PyBytes_AS_STRING(encoded),
+                          PyBytes_GET_SIZE(encoded));
+    Py_DECREF(encoded);
+#else
+    snapshot_writer_uint32(&dump->writer, PyString_GET_SIZE(filename));
+    snapshot_writer_write(&dump->writer,
+                          PyString_AS_STRING(filename),
+                          PyString_GET_SIZE(filename));
+#endif
+    return 0;
+}
+
+static int
+snapshot_write_filename_cb(_Py_hashtable_entry_t *entry, void *user_data)
+{
+    dump_snapshot_t *dump = user_data;
+    filename_t *record;
+
+    record = *(filename_t **)_PY_HASHTABLE_ENTRY_DATA(entry);
+    if (snapshot_write_filename(dump, record) < 0) {
+        dump->error = 1;
+        return 1;
+    }
+    return 0;
+}
+
+static int
+snapshot_add_traceback(const void *ptr, trace_t *trace, void *user_data)
+{
+    dump_snapshot_t *dump = user_data;
+    traceback_t *traceback = TRACE_TRACEBACK(trace);
+    size_t index = 0;
+
+    dump->index++;
+    if (_Py_hashtable_get_entry(dump->tracebacks, traceback) != NULL)
+        return 0;
+    if (_Py_HASHTABLE_SET(dump->tracebacks, traceback, index) < 0) {
+        dump->error = 1;
+        return 1;
+    }
+    return 0;
+}
+
+static int
+snapshot_write_nframe(_Py_hashtable_entry_t *entry, void *user_data)
+{
+    dump_snapshot_t *dump = user_data;
+    traceback_t *traceback = (traceback_t *)entry->key;
+
+    /* tracebacks are numbered in the iteration order */
+    *(size_t *)_PY_HASHTABLE_ENTRY_DATA(entry) = dump->index;
+    dump->index++;
+    snapshot_writer_uint32(&dump->writer, traceback->nframe);
+    return 0;
+}
+
+static int
+snapshot_write_frames(_Py_hashtable_entry_t *entry, void *user_data)
+{
+    dump_snapshot_t *dump = user_data;
+    traceback_t *traceback = (traceback_t *)entry->key;
+    size_t index;
+
+    for (; traceback != NULL; traceback = traceback->parent) {
+        if (!_Py_HASHTABLE_GET(dump->filenames,
+                               traceback->frame.filename, index)) {
+            /* all filenames are interned in tracemalloc_filenames */
+            assert(0);
+            index = 0;
+        }
+        snapshot_writer_uint32(&dump->writer, index);
+        snapshot_writer_uint32(&dump->writer, traceback->frame.lineno);
+    }
+    return (dump->writer.err != 0);
+}
+
+static int
+snapshot_write_size(const void *ptr, trace_t *trace, void *user_data)
+{
+    dump_snapshot_t *dump = user_data;
+
+    return (snapshot_writer_uint64(&dump->writer, trace->size) < 0);
+}
+
+static int
+snapshot_write_traceback_index(const void *ptr, trace_t *trace,
+                               void *user_data)
+{
+    dump_snapshot_t *dump = user_data;
+    size_t index;
+
+    if (!_Py_HASHTABLE_GET(dump->tracebacks, TRACE_TRACEBACK(trace), index)) {
+        assert(0);
+        index = 0;
+    }
+    return (snapshot_writer_uint32(&dump->writer, index) < 0);
+}
+
+static int
+snapshot_write_domain(const void *ptr, trace_t *trace, void *user_data)
+{
+    dump_snapshot_t *dump = user_data;
+
+    return (snapshot_writer_uint32(&dump->writer, trace_domain(trace)) < 0);
+}
+
+PyDoc_STRVAR(tracemalloc_dump_traces_doc,
+    "_dump_traces(fd: int)\n"
+    "\n"
+    "Write a snapshot of the traces of memory blocks allocated by Python\n"
+    "into the file descriptor fd, using the format of Snapshot.dump().");
+
+static PyObject*
+py_tracemalloc_dump_traces(PyObject *self, PyObject *args)
+{
+    dump_snapshot_t dump;
+    PyObject *result = NULL;
+    int fd;
+
+    if (!PyArg_ParseTuple(args, "i:_dump_traces", &fd))
+        return NULL;
+
+    if (!tracemalloc_config.tracing) {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "the tracemalloc module must be tracing memory "
+                        "allocations to dump a snapshot");
+        return NULL;
+    }
+
+    dump.writer.fd = fd;
+    dump.writer.len = 0;
+    dump.writer.err = 0;
+    dump.error = 0;
+    dump.writer.buffer = raw_malloc(SNAPSHOT_BUFFER_SIZE);
+    dump.filenames = hashtable_new(sizeof(size_t),
+                                   _Py_hashtable_hash_ptr,
+                                   _Py_hashtable_compare_direct);
+    dump.tracebacks = hashtable_new(sizeof(size_t),
+                                    _Py_hashtable_hash_ptr,
+                                    _Py_hashtable_compare_direct);
+    if (dump.writer.buffer == NULL
+        || dump.filenames == NULL || dump.tracebacks == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    /* don't trace memory allocated to write the snapshot */
+    set_reentrant(1);
+
+    snapshot_writer_write(&dump.writer, SNAPSHOT_MAGIC, SNAPSHOT_MAGIC_SIZE);
+    snapshot_writer_uint32(&dump.writer, SNAPSHOT_VERSION);
+    snapshot_writer_uint32(&dump.writer, tracemalloc_config.max_nframe);
+    snapshot_writer_uint64(&dump.writer, tracemalloc_config.sample_rate);
+
+    /* Write all interned filenames. tracemalloc_filenames is protected by
+       the GIL, and encoding a filename may call Python memory allocators:
+       TABLES_LOCK() must not be held. */
+    dump.index = 0;
+    snapshot_writer_uint32(&dump.writer,
+                           tracemalloc_filenames->entries + 1);
+    if (snapshot_write_filename(&dump, &tracemalloc_unknown_filename) < 0
+        || _Py_hashtable_foreach(tracemalloc_filenames,
+                                 snapshot_write_filename_cb, &dump)) {
+        set_reentrant(0);
+        goto done;
+    }
+
+    /* Write tracebacks and traces without copying the table of traces.
+       The buffer of the writer is flushed to the file each time it is full,
+       so the memory usage is bounded, but write() is called while the lock
+       is held: allocations and deallocations of other threads are blocked
+       until the snapshot is written. */
+    TABLES_LOCK();
+
+    dump.index = 0;
+    tracemalloc_foreach_trace(snapshot_add_traceback, &dump);
+    if (!dump.error) {
+        size_t ntrace = dump.index;
+
+        snapshot_writer_uint32(&dump.writer, dump.tracebacks->entries);
+        dump.index = 0;
+        _Py_hashtable_foreach(dump.tracebacks, snapshot_write_nframe, &dump);
+        _Py_hashtable_foreach(dump.tracebacks, snapshot_write_frames, &dump);
+
+        snapshot_writer_uint64(&dump.writer, ntrace);
+        tracemalloc_foreach_trace(snapshot_write_size, &dump);
+        tracemalloc_foreach_trace(snapshot_write_traceback_index, &dump);
+        tracemalloc_foreach_trace(snapshot_write_domain, &dump);
+
+        /* no other attribute */
+        snapshot_writer_uint64(&dump.writer, 0);
+        snapshot_writer_flush(&dump.writer);
+    }
+
+    TABLES_UNLOCK();
+    set_reentrant(0);
+
+    if (dump.error) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    if (dump.writer.err) {
+        errno = dump.writer.err;
+        PyErr_SetFromErrno(PyExc_OSError);
+        goto done;
+    }
+
+    Py_INCREF(Py_None);
+    result = Py_None;
+
+done:
+    if (dump.writer.buffer != NULL)
+        raw_free(dump.writer.buffer);
+    if (dump.filenames != NULL)
+        _Py_hashtable_destroy(dump.filenames);
+    if (dump.tracebacks != NULL)
+        _Py_hashtable_destroy(dump.tracebacks);
+    return result;
+}
+
+PyDoc_STRVAR(tracemalloc_start_doc,
+    "start(nframe: int=1, traces_table: str='chained', sample_rate: int=0,\n"
+    "      min_size: int=0, realloc_traceback: str='resize',\n"
+    "      allocation_stats: bool=False)\n"
+    "\n"
+    "Start tracing Python memory allocations. Set also the maximum number \n"
+    "of frames stored in the traceback of a trace to nframe.\n"
+    "\n"
+    "traces_table is the implementation of the table of traces: 'chained'\n"
+    "(chained hash table) or 'open' (open addressing).\n"
+    "\n"
+    "If sample_rate is non-zero, only trace one memory block per\n"
+    "sample_rate allocated bytes on average.\n"
+    "\n"
+    "Memory blocks smaller than min_size bytes are not traced: only their\n"
+    "total size is computed, see get_untraced_memory().\n"
+    "\n"
+    "realloc_traceback is the traceback of a resized memory block: 'resize'\n"
+    "(where it was resized) or 'allocation' (where it was allocated).\n"
+    "\n"
+    "If allocation_stats is true, count allocated and released memory\n"
+    "blocks per traceback, see get_allocation_statistics().");
+
+static PyObject*
+py_tracemalloc_start(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"nframe", "traces_table", "sample_rate",
+                             "min_size", "realloc_traceback",
+                             "allocation_stats", NULL};
+    Py_ssize_t nframe = 1;
+    int nframe_int;
+    const char *table_name = "chained";
+    traces_table_kind_t traces_table;
+    Py_ssize_t sample_rate = 0;
+    Py_ssize_t min_size = 0;
+    const char *realloc_name = "resize";
+    realloc_traceback_t realloc_traceback;
+    int allocation_stats = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|nsnnsi:start", kwlist,
+                                     &nframe, &table_name, &sample_rate,
+                                     &min_size, &realloc_name,
+                                     &allocation_stats))
+        return NULL;
+
+    if (nframe < 1 || nframe > MAX_NFRAME) {
+        PyErr_Format(PyExc_ValueError,
+                     "the number of frames must be in range [1; %i]",
+                     (int)MAX_NFRAME);
+        return NULL;
+    }
+    nframe_int = Py_SAFE_DOWNCAST(nframe, Py_ssize_t, int);
+
+    if (strcmp(table_name, "chained") == 0)
+        traces_table = TRACES_TABLE_CHAINED;
+    else if (strcmp(table_name, "open") == 0)
+        traces_table = TRACES_TABLE_OPEN;
+    else {
+        PyErr_Format(PyExc_ValueError,
+                     "traces_table must be 'chained' or 'open', not '%s'",
+                     table_name);
+        return NULL;
+    }
+
+    if (sample_rate < 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "the sample rate must be greater or equal to 0");
+        return NULL;
+    }
+
+    if (min_size < 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "the minimum size must be greater or equal to 0");
+        return NULL;
+    }
+
+    if (strcmp(realloc_name, "resize") == 0)
+        realloc_traceback = REALLOC_TRACEBACK_RESIZE;
+    else if (strcmp(realloc_name, "allocation") == 0)
+        realloc_traceback = REALLOC_TRACEBACK_ALLOCATION;
+    else {
+        PyErr_Format(PyExc_ValueError,
+                     "realloc_traceback must be 'resize' or 'allocation', "
+                     "not '%s'",
+                     realloc_name);
+        return NULL;
+    }
+
+    if (tracemalloc_start(nframe_int, traces_table, (size_t)sample_rate,
+                          (size_t)min_size, realloc_traceback,
+                          allocation_stats != 0) < 0)
+        return NULL;
+
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(tracemalloc_stop_doc,
+    "stop()\n"
+    "\n"
+    "Stop tracing Python memory allocations and clear traces\n"
+    "of memory blocks allocated by Python.");
+
+static PyObject*
+py_tracemalloc_stop(PyObject *self)
+{
+    tracemalloc_stop();
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(tracemalloc_get_traceback_limit_doc,
+    "get_traceback_limit() -> int\n"
+    "\n"
+    "Get the maximum number of frames stored in the traceback\n"
+    "of a trace.\n"
+    "\n"
+    "By default, a trace of an allocated memory block only stores\n"
+    "the most recent frame: the limit is 1.");
+
+static PyObject*
+py_tracemalloc_get_traceback_limit(PyObject *self)
+{
+    return INT_FROM_LONG(tracemalloc_config.max_nframe);
+}
+
+PyDoc_STRVAR(tracemalloc_get_sample_rate_doc,
+    "get_sample_rate() -> int\n"
+    "\n"
+    "Get the average number of allocated bytes between two sampled\n"
+    "memory blocks, or 0 if all memory blocks are traced.");
+
+static PyObject*
+py_tracemalloc_get_sample_rate(PyObject *self)
+{
+    return INT_FROM_SIZE_T(tracemalloc_config.sample_rate);
+}
+
+PyDoc_STRVAR(tracemalloc_get_min_size_doc,
+    "get_min_size() -> int\n"
+    "\n"
+    "Get the minimum size in bytes of a traced memory block,\n"
+    "or 0 if memory blocks of any size are traced.");
+
+static PyObject*
+py_tracemalloc_get_min_size(PyObject *self)
+{
+    return INT_FROM_SIZE_T(tracemalloc_config.min_size);
+}
+
+PyDoc_STRVAR(tracemalloc_set_trace_filters_doc,
+    "_set_trace_filters(filters: list)\n"
+    "\n"
+    "Set filters evaluated when memory blocks are allocated.\n"
+    "filters is a list of (inclusive: bool, filename_pattern: str,\n"
+    "lineno: int or None, all_frames: bool) tuples.");
+
+static PyObject*
+py_tracemalloc_set_trace_filters(PyObject *self, PyObject *list)
+{
+    trace_filter_t filters[MAX_TRACE_FILTERS];
+    Py_ssize_t nfilter, i;
+    PyObject *lineno_obj;
+    long lineno;
+    trace_filter_t *filter;
+    unsigned long bit;
+
+    if (!PyList_Check(list)) {
+        PyErr_SetString(PyExc_TypeError, "filters must be a list");
+        return NULL;
+    }
+    nfilter = PyList_GET_SIZE(list);
+    if (nfilter > MAX_TRACE_FILTERS) {
+        PyErr_Format(PyExc_ValueError,
+                     "too many trace filters: %i filters at most",
+                     MAX_TRACE_FILTERS);
+        return NULL;
+    }
+
+    for (i=0; i < nfilter; i++) {
+        filter = &filters[i];
+        if (!PyArg_ParseTuple(PyList_GET_ITEM(list, i),
+                              "iOOi;filter must be a (inclusive, "
+                              "filename_pattern, lineno, all_frames) tuple",
+                              &filter->inclusive, &filter->pattern,
+                              &lineno_obj, &filter->all_frames))
+            return NULL;
+
+        if (!STRING_CHECK(filter->pattern)) {
+            PyErr_SetString(PyExc_TypeError,
+                            "filename pattern must be a str");
+            return NULL;
+        }
+#ifdef PYTHON3
+        if (PyUnicode_READY(filter->pattern) < 0)
+            return NULL;
+#endif
+
+        if (lineno_obj == Py_None) {
+            filter->lineno = -1;
+        }
+        else {
+#ifdef PYTHON3
+            lineno = PyLong_AsLong(lineno_obj);
+#else
+            lineno = PyInt_AsLong(lineno_obj);
+#endif
+            if (lineno == -1 && PyErr_Occurred())
+                return NULL;
+            if (lineno < 0 || lineno > INT_MAX) {
+                PyErr_SetString(PyExc_ValueError,
+                                "invalid line number");
+                return NULL;
+            }
+            filter->lineno = (int)lineno;
+        }
+    }
+
+    tracemalloc_clear_filters();
+    for (i=0; i < nfilter; i++) {
+        filter = &filters[i];
+        Py_INCREF(filter->pattern);
+        tracemalloc_filters.filters[i] = *filter;
+
+        bit = 1UL << i;
+        if (filter->inclusive) {
+            if (filter->all_frames)
+                tracemalloc_filters.include_all |= bit;
+            else
+                tracemalloc_filters.include_first |= bit;
+        }
+        else {
+            if (filter->all_frames)
+                tracemalloc_filters.exclude_all |= bit;
+            else
+                tracemalloc_filters.exclude_first |= bit;
+        }
+        if (filter->lineno >= 0)
+            tracemalloc_filters.lineno |= bit;
+    }
+    tracemalloc_filters.nfilter = (int)nfilter;
+
+    /* invalidate filters_match of filename records */
+    tracemalloc_filters.generation++;
+    if (tracemalloc_filters.generation == 0)
+        tracemalloc_filters.generation = 1;
+
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(tracemalloc_get_trace_filters_doc,
+    "_get_trace_filters() -> list\n"
+    "\n"
+    "Get filters evaluated when memory blocks are allocated: list of\n"
+    "(inclusive: bool, filename_pattern: str, lineno: int or None,\n"
+    "all_frames: bool) tuples.");
+
+static PyObject*
+py_tracemalloc_get_trace_filters(PyObject *self)
+{
+    PyObject *list, *item, *lineno_obj;
+    trace_filter_t *filter;
+    int i;
+
+    list = PyList_New(tracemalloc_filters.nfilter);
+    if (list == NULL)
+        return NULL;
+
+    for (i=0; i < tracemalloc_filters.nfilter; i++) {
+        filter = &tracemalloc_filters.filters[i];
+        /* None if the filter matches any line number */
+        lineno_obj = lineno_as_obj(filter->lineno);
+        if (lineno_obj == NULL) {
+            Py_DECREF(list);
+            return NULL;
+        }
+        item = Py_BuildValue("(OONO)",
+                             filter->inclusive ? Py_True : Py_False,
+                             filter->pattern,
+                             lineno_obj,
+                             filter->all_frames ? Py_True : Py_False);
+        if (item == NULL) {
+            Py_DECREF(list);
+            return NULL;
+        }
+        PyList_SET_ITEM(list, i, item);
+    }
+    return list;
+}
+
+PyDoc_STRVAR(tracemalloc_start_event_log_doc,
+    "start_event_log(capacity: int)\n"
+    "\n"
+    "Start logging allocations and deallocations of traced memory blocks\n"
+    "in a buffer of capacity events. When the buffer is full, the oldest\n"
+    "event is overwritten.");
+
+static PyObject*
+py_tracemalloc_start_event_log(PyObject *self, PyObject *args)
+{
+    Py_ssize_t capacity;
+    event_t *events;
+
+    if (!PyArg_ParseTuple(args, "n:start_event_log", &capacity))
+        return NULL;
+
+    if (capacity < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "the capacity must be greater or equal to 1");
+        return NULL;
+    }
+    if ((size_t)capacity > (size_t)PY_SSIZE_T_MAX / sizeof(event_t))
+        return PyErr_NoMemory();
+
+    if (tracemalloc_init() < 0)
+        return NULL;
+
+    events = raw_malloc(capacity * sizeof(event_t));
+    if (events == NULL)
+        return PyErr_NoMemory();
+    event_log_set_buffer(events, (size_t)capacity);
+
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(tracemalloc_stop_event_log_doc,
+    "stop_event_log()\n"
+    "\n"
+    "Stop logging events and release the buffer of the event log.");
+
+static PyObject*
+py_tracemalloc_stop_event_log(PyObject *self)
+{
+    if (tracemalloc_event_log.capacity != 0)
+        event_log_set_buffer(NULL, 0);
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(tracemalloc_drain_events_doc,
+    "_drain_events() -> (bytes, dict, int)\n"
+    "\n"
+    "Remove all events from the event log. Return a tuple:\n"
+    "(events: bytes, tracebacks: dict, lost: int).\n"
+    "\n"
+    "Events are packed in the native byte order, tracebacks maps traceback\n"
+    "identifiers to tuples of (filename: str, lineno: int) tuples and lost\n"
+    "is the number of overwritten events.");
+
+static PyObject*
+py_tracemalloc_drain_events(PyObject *self)
+{
+    event_t *events = NULL;
+    size_t len = 0, lost = 0, first, i;
+    PyObject *data = NULL, *tracebacks = NULL, *result = NULL;
+    PyObject *key, *frames;
+    int reentrant = 0;
+    int res;
+
+    if (tracemalloc_config.tracing) {
+        set_reentrant(1);
+        reentrant = 1;
+    }
+
+    /* Allocate the bytes object without holding TABLES_LOCK(), to not block
+       other threads, for the current number of events. Events added in the
+       meantime are left in the log for the next call. */
+    if (tracemalloc_event_log.capacity != 0) {
+        TABLES_LOCK();
+        len = tracemalloc_event_log.len;
+        TABLES_UNLOCK();
+    }
+
+    data = PyBytes_FromStringAndSize(NULL, len * sizeof(event_t));
+    if (data == NULL) {
+        len = 0;
+        goto done;
+    }
+    events = (event_t *)PyBytes_AS_STRING(data);
+
+    if (tracemalloc_event_log.capacity != 0) {
+        /* Move the oldest events from the ring into the bytes object: the
+           two segments of the ring are copied directly, and the events
+           keep their reference to their traceback */
+        TABLES_LOCK();
+        /* only threads holding the GIL remove events from the log */
+        assert(tracemalloc_event_log.len >= len);
+        first = tracemalloc_event_log.capacity - tracemalloc_event_log.start;
+        if (first > len)
+            first = len;
+        memcpy(events,
+               &tracemalloc_event_log.events[tracemalloc_event_log.start],
+               first * sizeof(event_t));
+        memcpy(events + first, tracemalloc_event_log.events,
+               (len - first) * sizeof(event_t));
+        tracemalloc_event_log.start = ((tracemalloc_event_log.start + len)
+                                       % tracemalloc_event_log.capacity);
+        tracemalloc_event_log.len -= len;
+        lost = tracemalloc_event_log.lost;
+        tracemalloc_event_log.lost = 0;
+        TABLES_UNLOCK();
+    }
+
+    tracebacks = PyDict_New();
+    if (tracebacks == NULL)
+        goto done;
+
+    for (i=0; i < len; i++) {
+        key = PyLong_FromUnsignedLongLong(events[i].traceback);
+        if (key == NULL)
+            goto done;
+
+        res = PyDict_Contains(tracebacks, key);
+        if (res == 0) {
+            frames = traceback_to_pyobject(EVENT_TRACEBACK(&events[i]), NULL);
+            if (frames == NULL)
+                res = -1;
+            else {
+                res = PyDict_SetItem(tracebacks, key, frames);
+                Py_DECREF(frames);
+            }
+        }
+        Py_DECREF(key);
+        if (res < 0)
+            goto done;
+    }
+
+    result = Py_BuildValue("OON", data, tracebacks, INT_FROM_SIZE_T(lost));
+
+done:
+    if (len != 0) {
+        TABLES_LOCK();
+        for (i=0; i < len; i++)
+            traceback_decref(EVENT_TRACEBACK(&events[i]));
+        TABLES_UNLOCK();
+    }
+    if (reentrant)
+        set_reentrant(0);
+    Py_XDECREF(data);
+    Py_XDECREF(tracebacks);
+    return result;
+}
+
+PyDoc_STRVAR(tracemalloc_get_tracemalloc_memory_doc,
+    "get_tracemalloc_memory() -> int\n"
+    "\n"
+    "Get the memory usage in bytes of the tracemalloc module\n"
+    "used internally to trace memory allocations.");
+
+static PyObject*
+tracemalloc_get_tracemalloc_memory(PyObject *self)
+{
+    size_t size;
+    PyObject *size_obj;
+
+    size = _Py_hashtable_size(tracemalloc_filenames);
+    size += tracemalloc_filenames->entries * sizeof(filename_t);
+
+    TABLES_LOCK();
+    size += _Py_hashtable_size(tracemalloc_tracebacks);
+    size += tracemalloc_tracebacks->entries * sizeof(traceback_t);
+    size += traces_table_size(&tracemalloc_traces);
+    size += _Py_hashtable_size(tracemalloc_custom_traces);
+    size += _Py_hashtable_size(tracemalloc_allocation_stats);
+    TABLES_UNLOCK();
+
+    size_obj = INT_FROM_SIZE_T(size);
+    return Py_BuildValue("N", size_obj);
+}
+
+PyDoc_STRVAR(tracemalloc_get_traced_memory_doc,
+    "get_traced_memory(domain: int=None) -> (int, int)\n"
+    "\n"
+    "Get the current size and peak size of memory blocks traced\n"
+    "by the tracemalloc module as a tuple: (current: int, peak: int).\n"
+    "\n"
+    "If domain is set, only count memory blocks allocated in this domain.");
+
+static PyObject*
+tracemalloc_get_traced_memory(PyObject *self, PyObject *args)
+{
+    PyObject *domain_obj = Py_None;
+    long domain = -1;
+    Py_ssize_t size, peak_size;
+    PyObject *size_obj, *peak_size_obj;
+#ifdef TRACED_MEMORY_LOCK_FREE
+    unsigned long gen;
+#endif
+
+    if (!PyArg_ParseTuple(args, "|O:get_traced_memory", &domain_obj))
+        return NULL;
+
+    if (domain_obj != Py_None) {
+        domain = PyLong_AsLong(domain_obj);
+        if (domain == -1 && PyErr_Occurred())
+            return NULL;
+        if (domain < 0 || domain >= NDOMAIN) {
+            PyErr_Format(PyExc_ValueError, "unknown domain: %ld", domain);
+            return NULL;
+        }
+    }
+
+    if (!tracemalloc_config.tracing)
+        return Py_BuildValue("ii", 0, 0);
+
+#ifdef TRACED_MEMORY_LOCK_FREE
+    /* don't take TABLES_LOCK(): retry until the size and the peak size
+       are read between two modifications */
+    do {
+        gen = tracemalloc_traced_memory_gen;
+        MEMORY_BARRIER();
+#else
+    TABLES_LOCK();
+#endif
+    if (domain >= 0) {
+        size = tracemalloc_domain_traced_memory[domain];
+        peak_size = tracemalloc_domain_peak_traced_memory[domain];
+    }
+    else {
+        size = tracemalloc_traced_memory;
+        peak_size = tracemalloc_peak_traced_memory;
+    }
+#ifdef TRACED_MEMORY_LOCK_FREE
+        MEMORY_BARRIER();
+    } while ((gen & 1) || gen != tracemalloc_traced_memory_gen);
+#else
+    TABLES_UNLOCK();
+#endif
+
+    size_obj = INT_FROM_SIZE_T(size);
+    peak_size_obj = INT_FROM_SIZE_T(peak_size);
+    return Py_BuildValue("NN", size_obj, peak_size_obj);
+}
+
+PyDoc_STRVAR(tracemalloc_reset_peak_doc,
+    "reset_peak()\n"
+    "\n"
+    "Set the peak size of memory blocks traced by the tracemalloc module\n"
+    "to the current size.\n"
+    "\n"
+    "Do nothing if the tracemalloc module is not tracing memory allocations.");
+
+static PyObject*
+tracemalloc_reset_peak(PyObject *self)
+{
+    if (!tracemalloc_config.tracing)
+        Py_RETURN_NONE;
+
+    TABLES_LOCK();
+    TRACED_MEMORY_WRITE_BEGIN();
+    tracemalloc_peak_traced_memory = tracemalloc_traced_memory;
+    memcpy(tracemalloc_domain_peak_traced_memory,
+           tracemalloc_domain_traced_memory,
+           sizeof(tracemalloc_domain_traced_memory));
+    TRACED_MEMORY_WRITE_END();
+    TABLES_UNLOCK();
+
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(tracemalloc_get_untraced_memory_doc,
+    "get_untraced_memory() -> int\n"
+    "\n"
+    "Get the total size of memory blocks smaller than get_min_size()\n"
+    "allocated since traces were cleared. These memory blocks are not\n"
+    "traced: the size is not decreased when they are released.");
+
+static PyObject*
+tracemalloc_get_untraced_memory(PyObject *self)
+{
+    if (!tracemalloc_config.tracing)
+        return INT_FROM_LONG(0);
+
+    return PyLong_FromUnsignedLongLong(tracemalloc_untraced_memory);
+}
+
+static PyMethodDef module_methods[] = {
+    {"is_tracing", (PyCFunction)py_tracemalloc_is_tracing,
+     METH_NOARGS, tracemalloc_is_tracing_doc},
+    {"clear_traces", (PyCFunction)py_tracemalloc_clear_traces,
+     METH_NOARGS, tracemalloc_clear_traces_doc},
+    {"_get_traces", (PyCFunction)py_tracemalloc_get_traces,
+     METH_VARARGS, tracemalloc_get_traces_doc},
+    {"_get_object_traceback", (PyCFunction)py_tracemalloc_get_object_traceback,
+     METH_O, tracemalloc_get_object_traceback_doc},
+    {"_dump_traces", (PyCFunction)py_tracemalloc_dump_traces,
+     METH_VARARGS, tracemalloc_dump_traces_doc},
+    {"_get_statistics", (PyCFunction)py_tracemalloc_get_statistics,
+     METH_VARARGS, tracemalloc_get_statistics_doc},
+    {"_get_allocation_statistics",
+     (PyCFunction)py_tracemalloc_get_allocation_statistics,
+     METH_VARARGS, tracemalloc_get_allocation_statistics_doc},
+    {"_get_pymalloc_blocks", (PyCFunction)py_tracemalloc_get_pymalloc_blocks,
+     METH_NOARGS, tracemalloc_get_pymalloc_blocks_doc},
+    {"start", (PyCFunction)py_tracemalloc_start,
+      METH_VARARGS | METH_KEYWORDS, tracemalloc_start_doc},
+    {"stop", (PyCFunction)py_tracemalloc_stop,
+      METH_NOARGS, tracemalloc_stop_doc},
     {"get_traceback_limit", (PyCFunction)py_tracemalloc_get_traceback_limit,
      METH_NOARGS, tracemalloc_get_traceback_limit_doc},
+    {"get_sample_rate", (PyCFunction)py_tracemalloc_get_sample_rate,
+     METH_NOARGS, tracemalloc_get_sample_rate_doc},
+    {"get_min_size", (PyCFunction)py_tracemalloc_get_min_size,
+     METH_NOARGS, tracemalloc_get_min_size_doc},
+    {"_set_trace_filters", (PyCFunction)py_tracemalloc_set_trace_filters,
+     METH_O, tracemalloc_set_trace_filters_doc},
+    {"_get_trace_filters", (PyCFunction)py_tracemalloc_get_trace_filters,
+     METH_NOARGS, tracemalloc_get_trace_filters_doc},
     {"get_tracemalloc_memory", (PyCFunction)tracemalloc_get_tracemalloc_memory,
      METH_NOARGS, tracemalloc_get_tracemalloc_memory_doc},
     {"get_traced_memory", (PyCFunction)tracemalloc_get_traced_memory,
-     METH_NOARGS, tracemalloc_get_traced_memory_doc},
+     METH_VARARGS, tracemalloc_get_traced_memory_doc},
+    {"reset_peak", (PyCFunction)tracemalloc_reset_peak,
+     METH_NOARGS, tracemalloc_reset_peak_doc},
+    {"start_event_log", (PyCFunction)py_tracemalloc_start_event_log,
+     METH_VARARGS, tracemalloc_start_event_log_doc},
+    {"stop_event_log", (PyCFunction)py_tracemalloc_stop_event_log,
+     METH_NOARGS, tracemalloc_stop_event_log_doc},
+    {"_drain_events", (PyCFunction)py_tracemalloc_drain_events,
+     METH_NOARGS, tracemalloc_drain_events_doc},
+    {"get_untraced_memory", (PyCFunction)tracemalloc_get_untraced_memory,
+     METH_NOARGS, tracemalloc_get_untraced_memory_doc},
 
     /* private functions */
     {"_atexit", (PyCFunction)tracemalloc_atexit, METH_NOARGS},
@@ -1404,6 +4650,9 @@ init_tracemalloc(void)
 #endif
 {
     PyObject *m, *version;
+#if !(PY_MAJOR_VERSION == 2 && PY_MINOR_VERSION <= 6)
+    PyObject *capi;
+#endif
 
 #ifdef PYTHON3
     m = PyModule_Create(&module_def);
@@ -1421,6 +4670,20 @@ init_tracemalloc(void)
         goto error;
     PyModule_AddObject(m, "__version__", version);
 
+    if (PyModule_AddIntConstant(m, "DOMAIN_RAW", PYMEM_DOMAIN_RAW) < 0
+        || PyModule_AddIntConstant(m, "DOMAIN_MEM", PYMEM_DOMAIN_MEM) < 0
+        || PyModule_AddIntConstant(m, "DOMAIN_OBJ", PYMEM_DOMAIN_OBJ) < 0)
+        goto error;
+
+#if !(PY_MAJOR_VERSION == 2 && PY_MINOR_VERSION <= 6)
+    /* C API of C extensions: see tracemalloc.h */
+    capi = PyCapsule_New(&tracemalloc_capi, PyTraceMalloc_CAPSULE_NAME, NULL);
+    if (capi == NULL)
+        goto error;
+    if (PyModule_AddObject(m, "_C_API", capi) < 0)
+        goto error;
+#endif
+
     if (tracemalloc_atexit_register(m) < 0)
         goto error;
 
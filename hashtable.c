@@ -393,6 +393,40 @@ _Py_hashtable_foreach(_Py_hashtable_t *ht,
     return 0;
 }
 
+/* Call func for each entry and delete entries for which func returns a
+   non-zero value. Return the number of deleted entries. */
+size_t
+_Py_hashtable_foreach_delete(_Py_hashtable_t *ht,
+                             int (*func) (_Py_hashtable_entry_t *entry, void *arg),
+                             void *arg)
+{
+    _Py_hashtable_entry_t *entry, *previous, *next;
+    size_t hv, deleted = 0;
+
+    for (hv = 0; hv < ht->num_buckets; hv++) {
+        previous = NULL;
+        for (entry = TABLE_HEAD(ht, hv); entry != NULL; entry = next) {
+            next = ENTRY_NEXT(entry);
+            if (!func(entry, arg)) {
+                previous = entry;
+                continue;
+            }
+
+            _Py_slist_remove(&ht->buckets[hv], (_Py_slist_item_t *)previous,
+                             (_Py_slist_item_t *)entry);
+            if (ht->free_data_func)
+                ht->free_data_func(_Py_HASHTABLE_ENTRY_DATA_AS_VOID_P(entry));
+            ht->alloc.free(entry);
+            deleted++;
+        }
+    }
+
+    ht->entries -= deleted;
+    if ((float)ht->entries / (float)ht->num_buckets < HASHTABLE_LOW)
+        hashtable_rehash(ht);
+    return deleted;
+}
+
 static void
 hashtable_rehash(_Py_hashtable_t *ht)
 {
@@ -516,3 +550,351 @@ _Py_hashtable_copy(_Py_hashtable_t *src)
     return dst;
 }
 
+/* Hash table using open addressing (_Py_ptrtable_t): entries are stored
+   inline in a flat array of slots, collisions are resolved by linear probing
+   with Robin Hood hashing. A new entry takes the slot of an entry closer to
+   its ideal slot, so a lookup stops at the first entry closer to its ideal
+   slot than the key would be. Entries are removed using backward shift
+   deletion, without tombstone.
+
+   Three extra slots are allocated after the last slot: they are used as
+   temporary buffers to build a new entry and to swap entries. */
+
+#define PTRTABLE_HIGH 0.66
+#define PTRTABLE_LOW 0.10
+#define PTRTABLE_REHASH_FACTOR 2.0 / (PTRTABLE_LOW + PTRTABLE_HIGH)
+
+/* Fibonacci hashing: the index is the high bits of the key multiplied by
+   2^N / phi. All bits of the pointer are mixed, so memory blocks allocated
+   at consecutive addresses don't create long clusters. */
+#if SIZEOF_SIZE_T == 8
+#  define PTRTABLE_FIBONACCI ((size_t)0x9E3779B97F4A7C15ULL)
+#else
+#  define PTRTABLE_FIBONACCI ((size_t)0x9E3779B9UL)
+#endif
+
+#define PTRTABLE_INDEX(PT, KEY) \
+        (((size_t)(KEY) * PTRTABLE_FIBONACCI) >> (PT)->hash_shift)
+
+/* Distance between the slot INDEX of the entry KEY and its ideal slot */
+#define PTRTABLE_DISTANCE(PT, KEY, INDEX) \
+        (((INDEX) - PTRTABLE_INDEX(PT, KEY)) & ((PT)->num_slots - 1))
+
+#define PTRTABLE_SLOTS_SIZE(PT, NUM_SLOTS) \
+        (((NUM_SLOTS) + 3) * (PT)->slot_size)
+
+static void
+ptrtable_set_num_slots(_Py_ptrtable_t *pt, size_t num_slots)
+{
+    size_t size;
+
+    pt->num_slots = num_slots;
+    pt->hash_shift = (int)sizeof(size_t) * 8;
+    for (size = 1; size < num_slots; size <<= 1)
+        pt->hash_shift--;
+}
+
+/* Get the index of the slot storing key. Return -1 if the key does not
+   exist. */
+static Py_ssize_t
+ptrtable_lookup(_Py_ptrtable_t *pt, const void *key)
+{
+    size_t mask = pt->num_slots - 1;
+    size_t index, distance;
+    const void *slot_key;
+
+    index = PTRTABLE_INDEX(pt, key);
+    for (distance = 0; ; distance++) {
+        slot_key = _Py_PTRTABLE_SLOT_KEY(_Py_PTRTABLE_SLOT(pt, index));
+        if (slot_key == key)
+            return (Py_ssize_t)index;
+        if (slot_key == NULL
+            || PTRTABLE_DISTANCE(pt, slot_key, index) < distance)
+            return -1;
+        index = (index + 1) & mask;
+    }
+}
+
+/* Store an entry (a key followed by its data) into the table. The key must
+   not be present in the table and the table must have at least one empty
+   slot. entry must not be a slot of the table. */
+static void
+ptrtable_insert(_Py_ptrtable_t *pt, const char *entry)
+{
+    size_t mask = pt->num_slots - 1;
+    size_t index, distance, slot_distance;
+    char *slot, *carry, *spare;
+    const void *slot_key;
+
+    /* carry is the entry being inserted, spare is a free swap buffer */
+    carry = (char *)entry;
+    spare = _Py_PTRTABLE_SLOT(pt, pt->num_slots + 1);
+
+    index = PTRTABLE_INDEX(pt, _Py_PTRTABLE_SLOT_KEY(carry));
+    distance = 0;
+    while (1) {
+        slot = _Py_PTRTABLE_SLOT(pt, index);
+        slot_key = _Py_PTRTABLE_SLOT_KEY(slot);
+        if (slot_key == NULL) {
+            memcpy(slot, carry, pt->slot_size);
+            return;
+        }
+
+        slot_distance = PTRTABLE_DISTANCE(pt, slot_key, index);
+        if (slot_distance < distance) {
+            /* the stored entry is closer to its ideal slot: take its slot
+               and continue with the stored entry */
+            char *displaced = spare;
+
+            memcpy(displaced, slot, pt->slot_size);
+            memcpy(slot, carry, pt->slot_size);
+            if (carry == entry)
+                spare = _Py_PTRTABLE_SLOT(pt, pt->num_slots + 2);
+            else
+                spare = carry;
+            carry = displaced;
+            distance = slot_distance;
+        }
+        index = (index + 1) & mask;
+        distance++;
+    }
+}
+
+static int
+ptrtable_resize(_Py_ptrtable_t *pt, size_t new_size)
+{
+    char *old_slots, *slot;
+    size_t old_num_slots, slots_size, index;
+
+    if (new_size == pt->num_slots)
+        return 0;
+    assert(pt->entries < new_size);
+
+    slots_size = PTRTABLE_SLOTS_SIZE(pt, new_size);
+    old_slots = pt->slots;
+    old_num_slots = pt->num_slots;
+    pt->slots = pt->alloc.malloc(slots_size);
+    if (pt->slots == NULL) {
+        /* cancel resize on memory allocation failure */
+        pt->slots = old_slots;
+        return -1;
+    }
+    memset(pt->slots, 0, slots_size);
+    ptrtable_set_num_slots(pt, new_size);
+
+    for (index = 0; index < old_num_slots; index++) {
+        slot = old_slots + index * pt->slot_size;
+        if (_Py_PTRTABLE_SLOT_KEY(slot) != NULL)
+            ptrtable_insert(pt, slot);
+    }
+
+    pt->alloc.free(old_slots);
+    return 0;
+}
+
+_Py_ptrtable_t *
+_Py_ptrtable_new(size_t data_size, size_t init_size,
+                 _Py_hashtable_allocator_t *allocator)
+{
+    _Py_ptrtable_t *pt;
+    size_t slots_size;
+    _Py_hashtable_allocator_t alloc;
+
+    if (allocator == NULL) {
+        alloc.malloc = PyMem_RawMalloc;
+        alloc.free = PyMem_RawFree;
+    }
+    else
+        alloc = *allocator;
+
+    pt = (_Py_ptrtable_t *)alloc.malloc(sizeof(_Py_ptrtable_t));
+    if (pt == NULL)
+        return pt;
+
+    ptrtable_set_num_slots(pt, round_size(init_size));
+    pt->entries = 0;
+    pt->data_size = data_size;
+    /* a slot is the key followed by the data, aligned on a pointer */
+    pt->slot_size = sizeof(void *)
+                    + (data_size + sizeof(void *) - 1) / sizeof(void *) * sizeof(void *);
+
+    slots_size = PTRTABLE_SLOTS_SIZE(pt, pt->num_slots);
+    pt->slots = alloc.malloc(slots_size);
+    if (pt->slots == NULL) {
+        alloc.free(pt);
+        return NULL;
+    }
+    memset(pt->slots, 0, slots_size);
+
+    pt->alloc = alloc;
+    return pt;
+}
+
+size_t
+_Py_ptrtable_size(_Py_ptrtable_t *pt)
+{
+    return sizeof(_Py_ptrtable_t) + PTRTABLE_SLOTS_SIZE(pt, pt->num_slots);
+}
+
+/* Get a pointer to the data of an entry. Return NULL if the key does not
+   exist. The pointer is invalidated by the next modification of the table. */
+void *
+_Py_ptrtable_get_data(_Py_ptrtable_t *pt, const void *key)
+{
+    Py_ssize_t index;
+
+    assert(key != NULL);
+    index = ptrtable_lookup(pt, key);
+    if (index < 0)
+        return NULL;
+    return _Py_PTRTABLE_SLOT_DATA(_Py_PTRTABLE_SLOT(pt, index));
+}
+
+/* Add a new entry to the table. The key must not be present in the table.
+   Return 0 on success, -1 on memory error. */
+int
+_Py_ptrtable_set(_Py_ptrtable_t *pt, const void *key,
+                 void *data, size_t data_size)
+{
+    char *entry;
+
+    assert(key != NULL);
+    assert(data != NULL || data_size == 0);
+    assert(data_size == pt->data_size);
+    assert(ptrtable_lookup(pt, key) < 0);
+
+    if ((float)(pt->entries + 1) / (float)pt->num_slots > PTRTABLE_HIGH) {
+        size_t new_size;
+
+        new_size = round_size((size_t)((pt->entries + 1) * PTRTABLE_REHASH_FACTOR));
+        if (ptrtable_resize(pt, new_size) < 0
+            && pt->entries + 1 >= pt->num_slots) {
+            /* memory allocation failed and the table is full */
+            return -1;
+        }
+    }
+
+    entry = _Py_PTRTABLE_SLOT(pt, pt->num_slots);
+    _Py_PTRTABLE_SLOT_KEY(entry) = key;
+    memcpy(_Py_PTRTABLE_SLOT_DATA(entry), data, data_size);
+    ptrtable_insert(pt, entry);
+    pt->entries++;
+    return 0;
+}
+
+/* Get data from an entry. Copy entry data into data and return 1 if the entry
+   exists, return 0 if the entry does not exist. */
+int
+_Py_ptrtable_get(_Py_ptrtable_t *pt, const void *key,
+                 void *data, size_t data_size)
+{
+    void *entry_data;
+
+    assert(data != NULL);
+    assert(data_size == pt->data_size);
+
+    entry_data = _Py_ptrtable_get_data(pt, key);
+    if (entry_data == NULL)
+        return 0;
+    memcpy(data, entry_data, data_size);
+    return 1;
+}
+
+/* Remove an entry. Copy entry data into data (if data is not NULL) and return
+   1 if the entry existed, return 0 if the entry does not exist. */
+int
+_Py_ptrtable_pop(_Py_ptrtable_t *pt, const void *key,
+                 void *data, size_t data_size)
+{
+    size_t mask = pt->num_slots - 1;
+    Py_ssize_t found;
+    size_t hole, index;
+    char *slot;
+    const void *slot_key;
+
+    assert(key != NULL);
+
+    found = ptrtable_lookup(pt, key);
+    if (found < 0)
+        return 0;
+    hole = (size_t)found;
+
+    if (data != NULL) {
+        assert(data_size == pt->data_size);
+        memcpy(data, _Py_PTRTABLE_SLOT_DATA(_Py_PTRTABLE_SLOT(pt, hole)),
+               data_size);
+    }
+
+    /* backward shift deletion: move the next entries by one slot until an
+       empty slot or an entry stored in its ideal slot */
+    while (1) {
+        index = (hole + 1) & mask;
+        slot = _Py_PTRTABLE_SLOT(pt, index);
+        slot_key = _Py_PTRTABLE_SLOT_KEY(slot);
+        if (slot_key == NULL || PTRTABLE_DISTANCE(pt, slot_key, index) == 0)
+            break;
+        memcpy(_Py_PTRTABLE_SLOT(pt, hole), slot, pt->slot_size);
+        hole = index;
+    }
+    _Py_PTRTABLE_SLOT_KEY(_Py_PTRTABLE_SLOT(pt, hole)) = NULL;
+    pt->entries--;
+
+    if ((float)pt->entries / (float)pt->num_slots < PTRTABLE_LOW) {
+        /* ignore memory allocation failure: the table is just bigger
+           than needed */
+        (void)ptrtable_resize(pt, round_size((size_t)(pt->entries * PTRTABLE_REHASH_FACTOR)));
+    }
+    return 1;
+}
+
+/* Call func(key, data, arg) for each entry. Iteration stops if func returns
+   a non-zero value. func must not modify the table. */
+int
+_Py_ptrtable_foreach(_Py_ptrtable_t *pt,
+                     _Py_ptrtable_foreach_func func, void *arg)
+{
+    size_t index;
+    char *slot;
+
+    for (index = 0; index < pt->num_slots; index++) {
+        slot = _Py_PTRTABLE_SLOT(pt, index);
+        if (_Py_PTRTABLE_SLOT_KEY(slot) != NULL) {
+            int res = func(_Py_PTRTABLE_SLOT_KEY(slot),
+                           _Py_PTRTABLE_SLOT_DATA(slot), arg);
+            if (res)
+                return res;
+        }
+    }
+    return 0;
+}
+
+void
+_Py_ptrtable_clear(_Py_ptrtable_t *pt)
+{
+    memset(pt->slots, 0, PTRTABLE_SLOTS_SIZE(pt, pt->num_slots));
+    pt->entries = 0;
+    (void)ptrtable_resize(pt, round_size(0));
+}
+
+void
+_Py_ptrtable_destroy(_Py_ptrtable_t *pt)
+{
+    pt->alloc.free(pt->slots);
+    pt->alloc.free(pt);
+}
+
+/* Return a copy of the table */
+_Py_ptrtable_t *
+_Py_ptrtable_copy(_Py_ptrtable_t *src)
+{
+    _Py_ptrtable_t *dst;
+
+    dst = _Py_ptrtable_new(src->data_size, src->num_slots, &src->alloc);
+    if (dst == NULL)
+        return NULL;
+
+    assert(dst->num_slots == src->num_slots);
+    memcpy(dst->slots, src->slots, PTRTABLE_SLOTS_SIZE(src, src->num_slots));
+    dst->entries = src->entries;
+    return dst;
+}
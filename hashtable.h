@@ -99,6 +99,9 @@ typedef int (*_Py_hashtable_foreach_func) (_Py_hashtable_entry_t *entry, void *a
 PyAPI_FUNC(int) _Py_hashtable_foreach(
     _Py_hashtable_t *ht,
     _Py_hashtable_foreach_func func, void *arg);
+PyAPI_FUNC(size_t) _Py_hashtable_foreach_delete(
+    _Py_hashtable_t *ht,
+    _Py_hashtable_foreach_func func, void *arg);
 PyAPI_FUNC(size_t) _Py_hashtable_size(_Py_hashtable_t *ht);
 
 PyAPI_FUNC(_Py_hashtable_entry_t*) _Py_hashtable_get_entry(
@@ -123,12 +126,76 @@ PyAPI_FUNC(void) _Py_hashtable_delete(
     _Py_hashtable_t *ht,
     const void *key);
 
+/* Hash table using open addressing (linear probing) with pointer keys. The
+   data of an entry is stored inline in a flat array of slots, so adding or
+   removing an entry does not call the memory allocator, except to resize the
+   table. A slot is empty if its key is NULL: the NULL key is not supported. */
+
+typedef struct {
+    size_t num_slots;
+    /* number of bits of a hash not used to compute a slot index */
+    int hash_shift;
+    size_t entries; /* Total number of entries in the table. */
+    size_t data_size;
+    size_t slot_size;
+    char *slots;
+    _Py_hashtable_allocator_t alloc;
+} _Py_ptrtable_t;
+
+#define _Py_PTRTABLE_SLOT(TABLE, INDEX) \
+        ((TABLE)->slots + (INDEX) * (TABLE)->slot_size)
+
+#define _Py_PTRTABLE_SLOT_KEY(SLOT) \
+        (*(const void **)(SLOT))
+
+#define _Py_PTRTABLE_SLOT_DATA(SLOT) \
+        ((char *)(SLOT) + sizeof(void *))
+
+typedef int (*_Py_ptrtable_foreach_func) (const void *key, void *data, void *arg);
+
+PyAPI_FUNC(_Py_ptrtable_t *) _Py_ptrtable_new(
+    size_t data_size,
+    size_t init_size,
+    _Py_hashtable_allocator_t *allocator);
+PyAPI_FUNC(_Py_ptrtable_t *) _Py_ptrtable_copy(_Py_ptrtable_t *src);
+PyAPI_FUNC(void) _Py_ptrtable_clear(_Py_ptrtable_t *pt);
+PyAPI_FUNC(void) _Py_ptrtable_destroy(_Py_ptrtable_t *pt);
+PyAPI_FUNC(size_t) _Py_ptrtable_size(_Py_ptrtable_t *pt);
+PyAPI_FUNC(int) _Py_ptrtable_foreach(
+    _Py_ptrtable_t *pt,
+    _Py_ptrtable_foreach_func func, void *arg);
+
+PyAPI_FUNC(void*) _Py_ptrtable_get_data(
+    _Py_ptrtable_t *pt,
+    const void *key);
+PyAPI_FUNC(int) _Py_ptrtable_set(
+    _Py_ptrtable_t *pt,
+    const void *key,
+    void *data,
+    size_t data_size);
+PyAPI_FUNC(int) _Py_ptrtable_get(
+    _Py_ptrtable_t *pt,
+    const void *key,
+    void *data,
+    size_t data_size);
+PyAPI_FUNC(int) _Py_ptrtable_pop(
+    _Py_ptrtable_t *pt,
+    const void *key,
+    void *data,
+    size_t data_size);
+
 #define _Py_HASHTABLE_SET(TABLE, KEY, DATA) \
     _Py_hashtable_set(TABLE, KEY, &(DATA), sizeof(DATA))
 
 #define _Py_HASHTABLE_GET(TABLE, KEY, DATA) \
     _Py_hashtable_get(TABLE, KEY, &(DATA), sizeof(DATA))
 
+#define _Py_PTRTABLE_SET(TABLE, KEY, DATA) \
+    _Py_ptrtable_set(TABLE, KEY, &(DATA), sizeof(DATA))
+
+#define _Py_PTRTABLE_GET(TABLE, KEY, DATA) \
+    _Py_ptrtable_get(TABLE, KEY, &(DATA), sizeof(DATA))
+
 #endif   /* Py_LIMITED_API */
 
 #endif
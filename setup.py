@@ -80,6 +80,7 @@ def main():
         'ext_modules': [ext],
         'classifiers': CLASSIFIERS,
         'py_modules': ["tracemalloc"],
+        'headers': ["tracemalloc.h"],
     }
     setup(**options)
 
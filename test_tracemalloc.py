@@ -1,9 +1,14 @@
 import contextlib
+import gc
 import imp
 import linecache
 import os
+import pickle
+import shutil
 import sys
+import tempfile
 import tracemalloc
+import tracemalloc_runner
 try:
     import unittest2 as unittest
 except ImportError:
@@ -16,6 +21,10 @@ try:
     import threading
 except ImportError:
     threading = None
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
 try:
     from test.script_helper import assert_python_ok, assert_python_failure
 except ImportError:
@@ -106,6 +115,26 @@ def create_snapshots():
 
     return (snapshot, snapshot2)
 
+def get_c_api():
+    # Get the C API of the _tracemalloc module using ctypes
+    import _tracemalloc
+    if ctypes is None or not hasattr(_tracemalloc, '_C_API'):
+        return None
+
+    class CAPI(ctypes.Structure):
+        _fields_ = [
+            ('track', ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_uint,
+                                       ctypes.c_size_t, ctypes.c_size_t)),
+            ('untrack', ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_uint,
+                                         ctypes.c_size_t)),
+        ]
+
+    get_pointer = ctypes.pythonapi.PyCapsule_GetPointer
+    get_pointer.restype = ctypes.c_void_p
+    get_pointer.argtypes = [ctypes.py_object, ctypes.c_char_p]
+    address = get_pointer(_tracemalloc._C_API, b"_tracemalloc._C_API")
+    return CAPI.from_address(address)
+
 def frame(filename, lineno):
     return tracemalloc._Frame((filename, lineno))
 
@@ -139,6 +168,42 @@ class TestTracemallocEnabled(unittest.TestCase):
         self.assertGreaterEqual(size2, 0)
         self.assertLessEqual(size2, size)
 
+    def test_release_unused_tracebacks(self):
+        # allocate memory blocks from many different lines to create many
+        # different tracebacks
+        nline = 5000
+        code = compile("\n".join(["data.append(b'x' * 100)"] * nline),
+                       "<tracebacks>", "exec")
+        data = []
+        exec(code, {'data': data})
+        memory = tracemalloc.get_tracemalloc_memory()
+
+        # tracebacks must be released with their traces
+        data = None
+        memory2 = tracemalloc.get_tracemalloc_memory()
+        self.assertLess(memory2, memory // 2)
+
+    def test_release_unused_traceback_nodes(self):
+        # the memory blocks are allocated at the same line, called from many
+        # different lines: each traceback has its own parent node
+        nline = 5000
+        code = compile("def func(data):\n"
+                       "    data.append(b'x' * 100)\n"
+                       + "\n".join(["func(data)"] * nline),
+                       "<tracebacks>", "exec")
+        tracemalloc.stop()
+        tracemalloc.start(2)
+        data = []
+        exec(code, {'data': data})
+        memory = tracemalloc.get_tracemalloc_memory()
+
+        # parent nodes must be released with the tracebacks. func is part of
+        # a reference cycle through its globals which keeps data alive.
+        data = None
+        gc.collect()
+        memory2 = tracemalloc.get_tracemalloc_memory()
+        self.assertLess(memory2, memory // 2)
+
     def test_get_object_traceback(self):
         tracemalloc.clear_traces()
         obj_size = 12345
@@ -146,6 +211,20 @@ class TestTracemallocEnabled(unittest.TestCase):
         traceback = tracemalloc.get_object_traceback(obj)
         self.assertEqual(traceback, obj_traceback)
 
+    def test_get_object_traceback_filename(self):
+        # code objects are destroyed at each iteration, so a new code object
+        # with a different filename is likely allocated at the same address
+        for index in range(100):
+            filename = "<filename%s>" % index
+            code = compile("data = b'x' * 100", filename, "exec")
+            namespace = {}
+            exec(code, namespace)
+            traceback = tracemalloc.get_object_traceback(namespace['data'])
+            self.assertEqual(traceback[0].filename, filename)
+            code = None
+            if index % 10 == 0:
+                tracemalloc.clear_traces()
+
     def test_set_traceback_limit(self):
         obj_size = 10
 
@@ -166,6 +245,43 @@ class TestTracemallocEnabled(unittest.TestCase):
         self.assertEqual(len(traceback), 1)
         self.assertEqual(traceback, obj_traceback)
 
+    def test_traceback_shared_frames(self):
+        def recurse(depth, size):
+            if depth:
+                return recurse(depth - 1, size)
+            return allocate_bytes(size)
+
+        tracemalloc.stop()
+        tracemalloc.start(25)
+        # tracebacks share their oldest frames
+        objs = [recurse(depth, 100 + depth)
+                for depth in (10, 5, 10, 0, 3, 30, 10)]
+        for obj, obj_traceback in objs:
+            traceback = tracemalloc.get_object_traceback(obj)
+            self.assertEqual(traceback, obj_traceback)
+
+    def test_traces_table(self):
+        obj_size = 12345
+        for traces_table in ('chained', 'open'):
+            tracemalloc.stop()
+            tracemalloc.start(1, traces_table=traces_table)
+            objs = [allocate_bytes(obj_size) for count in range(100)]
+            for obj, obj_traceback in objs:
+                traceback = tracemalloc.get_object_traceback(obj)
+                self.assertEqual(traceback, obj_traceback)
+            trace = self.find_trace(tracemalloc._get_traces(),
+                                    objs[0][1])
+            self.assertEqual(trace[0], obj_size)
+
+            objs = None
+            size, peak_size = tracemalloc.get_traced_memory()
+            self.assertLess(size, obj_size * 10)
+            self.assertGreaterEqual(peak_size, obj_size * 100)
+
+        tracemalloc.stop()
+        self.assertRaises(ValueError,
+                          tracemalloc.start, 1, traces_table='list')
+
     def find_trace(self, traces, traceback):
         for trace in traces:
             if trace[1] == traceback._frames:
@@ -173,6 +289,91 @@ class TestTracemallocEnabled(unittest.TestCase):
 
         self.fail("trace not found")
 
+    def test_sample_rate(self):
+        self.assertEqual(tracemalloc.get_sample_rate(), 0)
+
+        sample_rate = 16 * 1024
+        tracemalloc.stop()
+        tracemalloc.start(1, sample_rate=sample_rate)
+        self.assertEqual(tracemalloc.get_sample_rate(), sample_rate)
+
+        obj_size = 4096
+        count = 2000
+        data = [allocate_bytes(obj_size) for index in range(count)]
+        obj_traceback = data[0][1]
+
+        # only a fraction of memory blocks are traced
+        traces = tracemalloc._get_traces()
+        self.assertLess(len(traces), count)
+
+        # but statistics are scaled up
+        snapshot = tracemalloc.take_snapshot()
+        self.assertEqual(snapshot.sample_rate, sample_rate)
+        stats = snapshot.statistics('lineno')
+        stat = [stat for stat in stats if stat.traceback == obj_traceback][0]
+        self.assertAlmostEqual(stat.count, count, delta=count * 0.3)
+        self.assertAlmostEqual(stat.size, count * obj_size,
+                               delta=count * obj_size * 0.3)
+
+        tracemalloc.stop()
+        with self.assertRaises(ValueError):
+            tracemalloc.start(1, sample_rate=-1)
+
+    def test_min_size(self):
+        self.assertEqual(tracemalloc.get_min_size(), 0)
+
+        min_size = 4096
+        tracemalloc.stop()
+        tracemalloc.start(1, min_size=min_size)
+        self.assertEqual(tracemalloc.get_min_size(), min_size)
+
+        # small memory blocks are not traced, but their size is accounted
+        untraced = tracemalloc.get_untraced_memory()
+        obj, obj_traceback = allocate_bytes(100)
+        self.assertIsNone(tracemalloc.get_object_traceback(obj))
+        self.assertGreaterEqual(tracemalloc.get_untraced_memory(),
+                                untraced + 100)
+
+        obj, obj_traceback = allocate_bytes(min_size)
+        self.assertEqual(tracemalloc.get_object_traceback(obj),
+                         obj_traceback)
+
+        tracemalloc.stop()
+        self.assertEqual(tracemalloc.get_untraced_memory(), 0)
+        with self.assertRaises(ValueError):
+            tracemalloc.start(1, min_size=-1)
+
+    def test_realloc_traceback(self):
+        size = 100000
+
+        def resize(data):
+            frames = get_frames(1, 1)
+            data.extend(b'x' * size)
+            return frames
+
+        for realloc_traceback in ('resize', 'allocation'):
+            tracemalloc.stop()
+            tracemalloc.start(1, realloc_traceback=realloc_traceback)
+
+            alloc_frames = get_frames(1, 1)
+            data = bytearray(b'abc')
+            resize_frames = resize(data)
+
+            # the buffer of the bytearray has been resized
+            traces = [trace for trace in tracemalloc._get_traces()
+                      if trace[0] >= size
+                      and trace[1] in (alloc_frames, resize_frames)]
+            self.assertEqual(len(traces), 1)
+            if realloc_traceback == 'resize':
+                self.assertEqual(traces[0][1], resize_frames)
+            else:
+                self.assertEqual(traces[0][1], alloc_frames)
+            data = None
+
+        tracemalloc.stop()
+        with self.assertRaises(ValueError):
+            tracemalloc.start(1, realloc_traceback='free')
+
     def test_get_traces(self):
         tracemalloc.clear_traces()
         obj_size = 12345
@@ -182,9 +383,11 @@ class TestTracemallocEnabled(unittest.TestCase):
         trace = self.find_trace(traces, obj_traceback)
 
         self.assertIsInstance(trace, tuple)
-        size, traceback = trace
+        size, traceback, domain = trace
         self.assertEqual(size, obj_size)
         self.assertEqual(traceback, obj_traceback._frames)
+        # bytes objects are allocated by the object allocator
+        self.assertEqual(domain, tracemalloc.DOMAIN_OBJ)
 
         tracemalloc.stop()
         self.assertEqual(tracemalloc._get_traces(), [])
@@ -209,11 +412,36 @@ class TestTracemallocEnabled(unittest.TestCase):
 
         trace1 = self.find_trace(traces, obj1_traceback)
         trace2 = self.find_trace(traces, obj2_traceback)
-        size1, traceback1 = trace1
-        size2, traceback2 = trace2
+        size1, traceback1, domain1 = trace1
+        size2, traceback2, domain2 = trace2
         self.assertEqual(traceback2, traceback1)
         self.assertIs(traceback2, traceback1)
 
+    def test_event_log(self):
+        self.addCleanup(tracemalloc.stop_event_log)
+        tracemalloc.start_event_log(1000)
+
+        obj_size = 12345
+        obj, obj_traceback = allocate_bytes(obj_size)
+        obj = None
+        log = tracemalloc.drain_events()
+        events = [event for event in log if event.traceback == obj_traceback]
+        self.assertEqual([(event.op, event.size) for event in events],
+                         [(tracemalloc.EVENT_ALLOC, obj_size),
+                          (tracemalloc.EVENT_FREE, obj_size)])
+        self.assertEqual(events[0].address, events[1].address)
+        self.assertLessEqual(events[0].timestamp, events[1].timestamp)
+
+        # when the buffer is full, the oldest events are overwritten
+        tracemalloc.start_event_log(2)
+        data = [allocate_bytes(obj_size) for index in range(5)]
+        log = tracemalloc.drain_events()
+        self.assertEqual(len(log), 2)
+        self.assertGreaterEqual(log.lost, 3)
+
+        with self.assertRaises(ValueError):
+            tracemalloc.start_event_log(0)
+
     def test_get_traced_memory(self):
         # Python allocates some internals objects, so the test must tolerate
         # a small difference between the expected size and the real usage
@@ -250,6 +478,137 @@ class TestTracemallocEnabled(unittest.TestCase):
         tracemalloc.stop()
         self.assertEqual(tracemalloc.get_traced_memory(), (0, 0))
 
+    def test_reset_peak(self):
+        tracemalloc.clear_traces()
+
+        # allocate a large piece of memory, temporarily
+        obj_size = 1024 * 1024
+        obj, obj_traceback = allocate_bytes(obj_size)
+        obj = None
+        size1, peak1 = tracemalloc.get_traced_memory()
+
+        # reset_peak() sets the peak to the current size
+        tracemalloc.reset_peak()
+        size2, peak2 = tracemalloc.get_traced_memory()
+        self.assertGreaterEqual(peak2, size2)
+        self.assertLess(peak2, peak1 - obj_size // 2)
+
+        # the peak is still updated when memory is allocated
+        obj, obj_traceback = allocate_bytes(obj_size)
+        size3, peak3 = tracemalloc.get_traced_memory()
+        self.assertGreaterEqual(peak3, size3)
+        self.assertGreaterEqual(peak3 - peak2, obj_size)
+
+        # do nothing if tracemalloc is not tracing
+        tracemalloc.stop()
+        tracemalloc.reset_peak()
+        self.assertEqual(tracemalloc.get_traced_memory(), (0, 0))
+
+    def test_get_traced_memory_domain(self):
+        tracemalloc.clear_traces()
+        obj_size = 1024 * 1024
+        obj, obj_traceback = allocate_bytes(obj_size)
+
+        domains = (tracemalloc.DOMAIN_RAW, tracemalloc.DOMAIN_MEM,
+                   tracemalloc.DOMAIN_OBJ)
+        sizes = [tracemalloc.get_traced_memory(domain) for domain in domains]
+        size, peak = tracemalloc.get_traced_memory()
+        # each call reads the counters at a different time: small
+        # allocations can happen between two calls
+        self.assertAlmostEqual(sum(domain_size for domain_size, domain_peak
+                                   in sizes), size, delta=64 * 1024)
+        obj_size2, obj_peak = tracemalloc.get_traced_memory(
+            tracemalloc.DOMAIN_OBJ)
+        self.assertGreaterEqual(obj_size2, obj_size)
+        self.assertGreaterEqual(obj_peak, obj_size2)
+
+        stats = tracemalloc.get_statistics('domain')
+        stat = [stat for stat in stats
+                if stat.traceback == traceback_filename('<obj>')][0]
+        self.assertAlmostEqual(stat.size, obj_size2, delta=64 * 1024)
+
+        self.assertRaises(ValueError, tracemalloc.get_traced_memory, 3)
+        self.assertRaises(ValueError, tracemalloc.get_statistics,
+                          'domain', True)
+        with self.assertRaises(TypeError):
+            tracemalloc.set_trace_filters(
+                [tracemalloc.DomainFilter(True, tracemalloc.DOMAIN_OBJ)])
+
+        tracemalloc.stop()
+        self.assertEqual(tracemalloc.get_traced_memory(tracemalloc.DOMAIN_OBJ),
+                         (0, 0))
+
+    def test_take_snapshot_object_types(self):
+        class ObjectTypeTest(object):
+            pass
+
+        tracemalloc.clear_traces()
+        objs = [ObjectTypeTest() for index in range(100)]
+        obj, obj_traceback = allocate_bytes(1000)
+
+        snapshot = tracemalloc.take_snapshot(object_types=True)
+        traces = [trace for trace in snapshot.traces
+                  if trace.traceback == obj_traceback]
+        self.assertIn(type(obj).__name__, [trace.type for trace in traces])
+
+        # ObjectTypeTest instances are tracked by the garbage collector
+        stats = snapshot.statistics('type')
+        stat = [stat for stat in stats
+                if stat.traceback == traceback_filename(
+                    '<type ObjectTypeTest>')][0]
+        self.assertGreaterEqual(stat.count, len(objs))
+
+        # types are not resolved by default
+        snapshot = tracemalloc.take_snapshot()
+        self.assertIsNone(snapshot.traces[0].type)
+
+        self.assertRaises(ValueError, tracemalloc.get_statistics, 'type')
+        self.assertRaises(TypeError, tracemalloc._get_traces, [1])
+
+    def test_c_api(self):
+        api = get_c_api()
+        if api is None:
+            self.skipTest("need ctypes and the C API")
+
+        def find_custom_traces():
+            return sorted((trace[0], trace[2])
+                          for trace in tracemalloc._get_traces()
+                          if trace[2] >= 3)
+
+        size1, peak1 = tracemalloc.get_traced_memory()
+        self.assertEqual(api.track(5, 0x1000, 1000), 0)
+        self.assertEqual(api.track(7, 0x2000, 3000), 0)
+        self.assertEqual(find_custom_traces(), [(1000, 5), (3000, 7)])
+        size2, peak2 = tracemalloc.get_traced_memory()
+        self.assertGreaterEqual(size2 - size1, 4000)
+
+        # domains of Python memory allocators cannot be used
+        self.assertEqual(api.track(tracemalloc.DOMAIN_OBJ, 0x3000, 10), -1)
+
+        stats = tracemalloc.get_statistics('domain')
+        self.assertIn(
+            tracemalloc.Statistic(traceback_filename('<domain 7>'), 3000, 1),
+            stats)
+        snapshot = tracemalloc.take_snapshot()
+        snapshot2 = snapshot.filter_traces([tracemalloc.DomainFilter(True, 5)])
+        self.assertEqual([trace.size for trace in snapshot2.traces], [1000])
+
+        # an address is only tracked in one domain
+        self.assertEqual(api.untrack(7, 0x1000), 0)
+        self.assertEqual(api.track(7, 0x1000, 2000), 0)
+        self.assertEqual(find_custom_traces(), [(2000, 7), (3000, 7)])
+        self.assertEqual(api.untrack(7, 0x1000), 0)
+        self.assertEqual(api.untrack(7, 0x2000), 0)
+        self.assertEqual(find_custom_traces(), [])
+
+        self.assertEqual(api.track(5, 0x1000, 1000), 0)
+        tracemalloc.clear_traces()
+        self.assertEqual(find_custom_traces(), [])
+
+        tracemalloc.stop()
+        self.assertEqual(api.track(5, 0x1000, 1000), -2)
+        self.assertEqual(api.untrack(5, 0x1000), -2)
+
     def test_clear_traces(self):
         obj, obj_traceback = allocate_bytes(123)
         traceback = tracemalloc.get_object_traceback(obj)
@@ -299,6 +658,187 @@ class TestTracemallocEnabled(unittest.TestCase):
         snapshot2 = tracemalloc.Snapshot.load(support.TESTFN)
         self.assertEqual(snapshot2.test_attr, "new")
 
+    def test_dump_snapshot(self):
+        obj_size = 12345
+        obj, obj_traceback = allocate_bytes(obj_size)
+        traceback = tracemalloc.get_object_traceback(obj)
+
+        tracemalloc.dump_snapshot(support.TESTFN)
+        self.addCleanup(support.unlink, support.TESTFN)
+        snapshot = tracemalloc.Snapshot.load(support.TESTFN)
+        self.assertEqual(snapshot.traceback_limit,
+                         tracemalloc.get_traceback_limit())
+        stats = snapshot.statistics('traceback')
+        self.assertIn(traceback, [stat.traceback for stat in stats])
+
+        # write into a file descriptor
+        with open(support.TESTFN, "wb") as fp:
+            tracemalloc.dump_snapshot(fp.fileno())
+        snapshot2 = tracemalloc.Snapshot.load(support.TESTFN)
+        stats = snapshot2.statistics('traceback')
+        self.assertIn(traceback, [stat.traceback for stat in stats])
+
+        if sys.version_info < (3,):
+            # file descriptor of type long
+            with open(support.TESTFN, "wb") as fp:
+                tracemalloc.dump_snapshot(long(fp.fileno()))
+            snapshot3 = tracemalloc.Snapshot.load(support.TESTFN)
+            stats = snapshot3.statistics('traceback')
+            self.assertIn(traceback, [stat.traceback for stat in stats])
+
+        # tracemalloc must be tracing memory allocations to dump a snapshot
+        tracemalloc.stop()
+        with self.assertRaises(RuntimeError) as cm:
+            tracemalloc.dump_snapshot(support.TESTFN)
+        self.assertEqual(str(cm.exception),
+                         "the tracemalloc module must be tracing memory "
+                         "allocations to dump a snapshot")
+
+    def test_get_statistics(self):
+        obj_size = 12345
+        obj, obj_traceback = allocate_bytes(obj_size)
+        traceback = tracemalloc.get_object_traceback(obj)
+
+        stats = tracemalloc.get_statistics('traceback')
+        self.assertIn(traceback, [stat.traceback for stat in stats])
+        self.assertEqual(stats, sorted(stats, reverse=True,
+                                       key=tracemalloc.Statistic._sort_key))
+
+        lineno = tracemalloc.Traceback(traceback._frames[:1])
+        stats = tracemalloc.get_statistics('lineno')
+        stat = [stat for stat in stats if stat.traceback == lineno][0]
+        self.assertGreaterEqual(stat.size, obj_size)
+        self.assertGreaterEqual(stat.count, 1)
+
+        filename = tracemalloc.Traceback(((traceback[0].filename, 0),))
+        for cumulative in (False, True):
+            stats = tracemalloc.get_statistics('filename', cumulative)
+            stat = [stat for stat in stats if stat.traceback == filename][0]
+            self.assertGreaterEqual(stat.size, obj_size)
+
+        self.assertRaises(ValueError,
+                          tracemalloc.get_statistics, 'traceback', True)
+        self.assertRaises(ValueError, tracemalloc.get_statistics, 'xxx')
+
+        # tracemalloc must be tracing memory allocations to get statistics
+        tracemalloc.stop()
+        with self.assertRaises(RuntimeError) as cm:
+            tracemalloc.get_statistics('lineno')
+        self.assertEqual(str(cm.exception),
+                         "the tracemalloc module must be tracing memory "
+                         "allocations to get statistics")
+
+    def test_get_allocation_statistics(self):
+        obj_size = 1000
+        loops = 100
+
+        # allocation statistics are disabled by default
+        self.assertRaises(RuntimeError,
+                          tracemalloc.get_allocation_statistics, 'lineno')
+
+        tracemalloc.stop()
+        tracemalloc.start(1, allocation_stats=True)
+        old_stats = tracemalloc.get_allocation_statistics('traceback')
+        for loop in range(loops):
+            obj, obj_traceback = allocate_bytes(obj_size)
+        obj = None
+        stats = tracemalloc.get_allocation_statistics('traceback')
+        self.assertEqual(stats, sorted(stats, reverse=True,
+                         key=tracemalloc.AllocationStatistic._sort_key))
+
+        # memory blocks released since the first call are counted
+        diff = tracemalloc.compare_allocation_statistics(stats, old_stats)
+        stat = [stat for stat in diff if stat.traceback == obj_traceback][0]
+        self.assertEqual(stat.size, obj_size * loops)
+        self.assertEqual(stat.count, loops)
+        self.assertEqual(stat.free_count, loops)
+
+        filename = tracemalloc.Traceback(((obj_traceback[0].filename, 0),))
+        for cumulative in (False, True):
+            stats = tracemalloc.get_allocation_statistics('filename',
+                                                          cumulative)
+            stat = [stat for stat in stats if stat.traceback == filename][0]
+            self.assertGreaterEqual(stat.size, obj_size * loops)
+
+        self.assertRaises(ValueError,
+                          tracemalloc.get_allocation_statistics,
+                          'traceback', True)
+
+        # clear_traces() resets counters
+        tracemalloc.clear_traces()
+        stats = tracemalloc.get_allocation_statistics('traceback')
+        self.assertNotIn(obj_traceback, [stat.traceback for stat in stats])
+
+        tracemalloc.stop()
+        self.assertRaises(RuntimeError,
+                          tracemalloc.get_allocation_statistics, 'lineno')
+
+    def test_get_arena_statistics(self):
+        obj_size = 100
+        objs = []
+        for loop in range(1000):
+            obj, obj_traceback = allocate_bytes(obj_size)
+            objs.append(obj)
+
+        stats = tracemalloc.get_arena_statistics()
+        if not stats:
+            self.skipTest("no traced memory block allocated by pymalloc")
+        self.assertEqual(stats, sorted(stats,
+                         key=tracemalloc.ArenaStatistic._sort_key))
+        for stat in stats:
+            self.assertGreaterEqual(stat.pool_count, 1)
+            self.assertGreaterEqual(stat.used_size,
+                                    sum(trace.size
+                                        for trace in stat.snapshot.traces))
+            self.assertGreaterEqual(stat.free_size, 0)
+
+        # the snapshot of arenas gives the tracebacks of memory blocks
+        stats = [stat for stat in stats
+                 if obj_traceback in [trace.traceback
+                                      for trace in stat.snapshot.traces]]
+        self.assertNotEqual(stats, [])
+        traceback_stats = stats[0].snapshot.statistics('traceback')
+        self.assertIn(obj_traceback,
+                      [stat.traceback for stat in traceback_stats])
+
+        tracemalloc.stop()
+        self.assertRaises(RuntimeError, tracemalloc.get_arena_statistics)
+
+    def test_trace_filters(self):
+        self.addCleanup(tracemalloc.set_trace_filters, [])
+        obj_size = 1234
+        obj, obj_traceback = allocate_bytes(obj_size)
+        filename = obj_traceback[0].filename
+        lineno = obj_traceback[0].lineno
+
+        # memory blocks allocated in filename are not traced
+        tracemalloc.set_trace_filters([tracemalloc.Filter(False, filename)])
+        obj, obj_traceback = allocate_bytes(obj_size)
+        self.assertIsNone(tracemalloc.get_object_traceback(obj))
+
+        # only trace memory blocks allocated at filename:lineno
+        tracemalloc.set_trace_filters([
+            tracemalloc.Filter(True, filename, lineno)])
+        filters = tracemalloc.get_trace_filters()
+        self.assertEqual(len(filters), 1)
+        self.assertEqual((filters[0].inclusive, filters[0].lineno,
+                          filters[0].all_frames),
+                         (True, lineno, False))
+        obj, obj_traceback = allocate_bytes(obj_size)
+        self.assertEqual(tracemalloc.get_object_traceback(obj),
+                         obj_traceback)
+        obj2 = b'x' * obj_size
+        self.assertIsNone(tracemalloc.get_object_traceback(obj2))
+
+        tracemalloc.set_trace_filters([])
+        self.assertEqual(tracemalloc.get_trace_filters(), [])
+        obj2 = b'x' * obj_size
+        self.assertIsNotNone(tracemalloc.get_object_traceback(obj2))
+
+        self.assertRaises(ValueError, tracemalloc.set_trace_filters,
+                          [tracemalloc.Filter(True, filename)] * 33)
+        self.assertRaises(TypeError, tracemalloc.set_trace_filters, 3)
+
     def fork_child(self):
         if not tracemalloc.is_tracing():
             return 2
@@ -527,6 +1067,299 @@ class TestSnapshot(unittest.TestCase):
             tracemalloc.Statistic(tb_a_5, 2, 1),
         ])
 
+    def test_snapshot_sample_rate(self):
+        raw_traces = [
+            (1000, (('a.py', 2),)),
+            (1000, (('a.py', 2),)),
+            (1000, (('b.py', 4),)),
+        ]
+        snapshot = tracemalloc.Snapshot(raw_traces, 1, sample_rate=1000)
+
+        # a block of sample_rate bytes is sampled with a probability of
+        # 1 - exp(-1)
+        stats = snapshot.statistics('lineno')
+        self.assertEqual(stats, [
+            tracemalloc.Statistic(traceback_lineno('a.py', 2), 3164, 3),
+            tracemalloc.Statistic(traceback_lineno('b.py', 4), 1582, 2),
+        ])
+
+        snapshot2 = snapshot.filter_traces([])
+        self.assertEqual(snapshot2.sample_rate, 1000)
+
+        stats = snapshot2.compare_to(snapshot, 'filename')
+        self.assertEqual(stats, [
+            tracemalloc.StatisticDiff(traceback_filename('a.py'),
+                                      3164, 0, 3, 0),
+            tracemalloc.StatisticDiff(traceback_filename('b.py'),
+                                      1582, 0, 2, 0),
+        ])
+
+    def test_dump_load(self):
+        snapshot, snapshot2 = create_snapshots()
+        snapshot.sample_rate = 512
+        snapshot.test_attr = "new"
+        snapshot.dump(support.TESTFN)
+        self.addCleanup(support.unlink, support.TESTFN)
+
+        with open(support.TESTFN, "rb") as fp:
+            self.assertEqual(fp.read(len(tracemalloc._SNAPSHOT_MAGIC)),
+                             tracemalloc._SNAPSHOT_MAGIC)
+
+        snapshot3 = tracemalloc.Snapshot.load(support.TESTFN)
+        self.assertEqual(snapshot3.traces, snapshot.traces)
+        self.assertEqual(snapshot3.traceback_limit, 2)
+        self.assertEqual(snapshot3.sample_rate, 512)
+        self.assertEqual(snapshot3.test_attr, "new")
+
+        # empty snapshot
+        snapshot4 = tracemalloc.Snapshot([], 1)
+        snapshot4.dump(support.TESTFN)
+        snapshot5 = tracemalloc.Snapshot.load(support.TESTFN)
+        self.assertEqual(len(snapshot5.traces), 0)
+        self.assertEqual(snapshot5.traceback_limit, 1)
+
+    def test_load_lazy(self):
+        snapshot, snapshot2 = create_snapshots()
+        snapshot.dump(support.TESTFN)
+        self.addCleanup(support.unlink, support.TESTFN)
+
+        snapshot3 = tracemalloc.Snapshot.load(support.TESTFN, lazy=True)
+        self.assertIsInstance(snapshot3.traces._traces,
+                              tracemalloc._MappedTraces)
+        self.assertEqual(snapshot3.traces, snapshot.traces)
+        self.assertEqual(snapshot3.traces[-1], snapshot.traces[-1])
+        self.assertEqual(snapshot3.traces[1:4], snapshot.traces[1:4])
+        self.assertEqual(snapshot3.traces[::2], snapshot.traces[::2])
+        self.assertRaises(IndexError, snapshot3.traces.__getitem__, 6)
+        self.assertEqual(snapshot3.statistics('lineno'),
+                         snapshot.statistics('lineno'))
+        self.assertEqual(snapshot3.statistics('filename', cumulative=True),
+                         snapshot.statistics('filename', cumulative=True))
+
+        snapshot4 = snapshot3.filter_traces([tracemalloc.Filter(True, 'a.py')])
+        self.assertEqual(len(snapshot4.traces), 4)
+
+        # release the memory map before overwriting the file
+        snapshot3 = None
+
+        # lazy has no effect on pickled snapshots
+        with open(support.TESTFN, "wb") as fp:
+            pickle.dump(snapshot, fp, pickle.HIGHEST_PROTOCOL)
+        snapshot5 = tracemalloc.Snapshot.load(support.TESTFN, lazy=True)
+        self.assertEqual(snapshot5.traces, snapshot.traces)
+
+    def test_load_columnar(self):
+        snapshot, snapshot2 = create_snapshots()
+        snapshot.dump(support.TESTFN)
+        self.addCleanup(support.unlink, support.TESTFN)
+        self.addCleanup(setattr, tracemalloc, '_numpy', tracemalloc._numpy)
+
+        # group traces using NumPy if available, and using array.array
+        for numpy in (tracemalloc._import_numpy(), False):
+            tracemalloc._numpy = numpy
+            snapshot3 = tracemalloc.Snapshot.load(support.TESTFN)
+            self.assertIsInstance(snapshot3.traces._traces,
+                                  tracemalloc._ColumnarTraces)
+            self.assertEqual(snapshot3.traces, snapshot.traces)
+            self.assertEqual(snapshot3.traces[-1], snapshot.traces[-1])
+            self.assertEqual(snapshot3.traces[1:4], snapshot.traces[1:4])
+
+            for key_type, cumulative in (('traceback', False),
+                                         ('lineno', False),
+                                         ('lineno', True),
+                                         ('filename', True)):
+                self.assertEqual(snapshot3.statistics(key_type, cumulative),
+                                 snapshot.statistics(key_type, cumulative))
+            self.assertEqual(snapshot3.compare_to(snapshot2, 'lineno'),
+                             snapshot.compare_to(snapshot2, 'lineno'))
+
+            filters = [tracemalloc.Filter(True, 'a.py'),
+                       tracemalloc.Filter(False, 'b.py', 4, True)]
+            for trace_filters in (filters[:1], filters[1:], []):
+                snapshot4 = snapshot3.filter_traces(trace_filters)
+                snapshot5 = snapshot.filter_traces(trace_filters)
+                self.assertEqual(snapshot4.traces, snapshot5.traces)
+                self.assertEqual(snapshot4.statistics('filename'),
+                                 snapshot5.statistics('filename'))
+
+            snapshot3.sample_rate = snapshot.sample_rate = 512
+            self.assertEqual(snapshot3.statistics('lineno'),
+                             snapshot.statistics('lineno'))
+            snapshot.sample_rate = 0
+
+    def test_domains(self):
+        raw_traces = [
+            (10, (('a.py', 2),), tracemalloc.DOMAIN_OBJ),
+            (10, (('a.py', 2),), tracemalloc.DOMAIN_OBJ),
+            (20, (('a.py', 2),), tracemalloc.DOMAIN_MEM),
+            (30, (('b.py', 4),), tracemalloc.DOMAIN_RAW),
+            (40, (('b.py', 4),), 5),
+        ]
+        snapshot = tracemalloc.Snapshot(raw_traces, 1)
+        self.assertEqual([trace.domain for trace in snapshot.traces],
+                         [2, 2, 1, 0, 5])
+        # traces created by older versions have no domain
+        snapshot2, snapshot3 = create_snapshots()
+        self.assertIsNone(snapshot2.traces[0].domain)
+
+        self.assertEqual(snapshot.statistics('domain'), [
+            tracemalloc.Statistic(traceback_filename('<domain 5>'), 40, 1),
+            tracemalloc.Statistic(traceback_filename('<raw>'), 30, 1),
+            tracemalloc.Statistic(traceback_filename('<obj>'), 20, 2),
+            tracemalloc.Statistic(traceback_filename('<mem>'), 20, 1),
+        ])
+        self.assertEqual(snapshot2.statistics('domain'), [
+            tracemalloc.Statistic(traceback_filename('<unknown domain>'),
+                                  105, 6),
+        ])
+
+        filters_list = (
+            [tracemalloc.DomainFilter(True, tracemalloc.DOMAIN_OBJ)],
+            [tracemalloc.DomainFilter(False, tracemalloc.DOMAIN_OBJ)],
+            # traces matching any inclusive filter are kept
+            [tracemalloc.DomainFilter(True, tracemalloc.DOMAIN_RAW),
+             tracemalloc.Filter(True, 'a.py')],
+            [tracemalloc.Filter(True, 'a.py'),
+             tracemalloc.DomainFilter(False, tracemalloc.DOMAIN_MEM)],
+        )
+        expected_list = (
+            raw_traces[:2],
+            raw_traces[2:],
+            raw_traces[:4],
+            raw_traces[:2],
+        )
+        for filters, expected in zip(filters_list, expected_list):
+            snapshot4 = snapshot.filter_traces(filters)
+            self.assertEqual(list(snapshot4.traces._traces), expected)
+
+        # domains are written since the version 2 of the format
+        snapshot.dump(support.TESTFN)
+        self.addCleanup(support.unlink, support.TESTFN)
+        self.addCleanup(setattr, tracemalloc, '_numpy', tracemalloc._numpy)
+        for numpy in (tracemalloc._import_numpy(), False):
+            tracemalloc._numpy = numpy
+            for lazy in (False, True):
+                snapshot5 = tracemalloc.Snapshot.load(support.TESTFN, lazy)
+                self.assertEqual(snapshot5.traces, snapshot.traces)
+                self.assertEqual(snapshot5.traces[1:3], snapshot.traces[1:3])
+                self.assertEqual(snapshot5.statistics('domain'),
+                                 snapshot.statistics('domain'))
+                for filters, expected in zip(filters_list, expected_list):
+                    snapshot6 = snapshot5.filter_traces(filters)
+                    self.assertEqual(list(snapshot6.traces._traces), expected)
+                snapshot5 = snapshot6 = None
+
+        # traces without domain are written with the version 1
+        snapshot2.dump(support.TESTFN)
+        with open(support.TESTFN, "rb") as fp:
+            header = fp.read(tracemalloc._SNAPSHOT_HEADER.size)
+        self.assertEqual(tracemalloc._SNAPSHOT_HEADER.unpack(header)[1], 1)
+        snapshot5 = tracemalloc.Snapshot.load(support.TESTFN)
+        self.assertEqual(snapshot5.traces, snapshot2.traces)
+        self.assertIsNone(snapshot5.traces[0].domain)
+
+    def test_types(self):
+        raw_traces = [
+            (10, (('a.py', 2),), tracemalloc.DOMAIN_OBJ, 'dict'),
+            (20, (('a.py', 2),), tracemalloc.DOMAIN_OBJ, 'dict'),
+            (30, (('a.py', 2),), tracemalloc.DOMAIN_OBJ, 'list'),
+            (40, (('b.py', 4),), tracemalloc.DOMAIN_MEM, None),
+        ]
+        snapshot = tracemalloc.Snapshot(raw_traces, 1)
+        self.assertEqual([trace.type for trace in snapshot.traces],
+                         ['dict', 'dict', 'list', None])
+        # only snapshots taken with object types have types
+        snapshot2, snapshot3 = create_snapshots()
+        self.assertIsNone(snapshot2.traces[0].type)
+
+        expected = [
+            tracemalloc.Statistic(traceback_filename('<unknown type>'),
+                                  40, 1),
+            tracemalloc.Statistic(traceback_filename('<type dict>'), 30, 2),
+            tracemalloc.Statistic(traceback_filename('<type list>'), 30, 1),
+        ]
+        self.assertEqual(snapshot.statistics('type'), expected)
+        self.assertEqual(snapshot2.statistics('type'), [
+            tracemalloc.Statistic(traceback_filename('<unknown type>'),
+                                  105, 6),
+        ])
+        self.assertRaises(ValueError, snapshot.statistics, 'type', True)
+
+        filters = [tracemalloc.Filter(True, 'a.py')]
+
+        # types are written since the version 3 of the format
+        snapshot.dump(support.TESTFN)
+        self.addCleanup(support.unlink, support.TESTFN)
+        with open(support.TESTFN, "rb") as fp:
+            header = fp.read(tracemalloc._SNAPSHOT_HEADER.size)
+        self.assertEqual(tracemalloc._SNAPSHOT_HEADER.unpack(header)[1], 3)
+        self.addCleanup(setattr, tracemalloc, '_numpy', tracemalloc._numpy)
+        for numpy in (tracemalloc._import_numpy(), False):
+            tracemalloc._numpy = numpy
+            for lazy in (False, True):
+                snapshot4 = tracemalloc.Snapshot.load(support.TESTFN, lazy)
+                self.assertEqual(snapshot4.traces, snapshot.traces)
+                self.assertEqual(snapshot4.traces[1:3], snapshot.traces[1:3])
+                self.assertEqual(snapshot4.statistics('type'), expected)
+                snapshot5 = snapshot4.filter_traces(filters)
+                self.assertEqual(list(snapshot5.traces._traces),
+                                 raw_traces[:3])
+                snapshot4 = snapshot5 = None
+
+        # traces without type are written with the version 2
+        snapshot = tracemalloc.Snapshot([trace[:3] for trace in raw_traces],
+                                        1)
+        snapshot.dump(support.TESTFN)
+        with open(support.TESTFN, "rb") as fp:
+            header = fp.read(tracemalloc._SNAPSHOT_HEADER.size)
+        self.assertEqual(tracemalloc._SNAPSHOT_HEADER.unpack(header)[1], 2)
+        snapshot4 = tracemalloc.Snapshot.load(support.TESTFN)
+        self.assertEqual(snapshot4.traces, snapshot.traces)
+        self.assertIsNone(snapshot4.traces[0].type)
+
+    def test_event_log_allocation_rates(self):
+        self.addCleanup(setattr, tracemalloc, '_numpy', tracemalloc._numpy)
+        pack = tracemalloc._EVENT_STRUCT.pack
+        alloc, free = tracemalloc.EVENT_ALLOC, tracemalloc.EVENT_FREE
+        data = b''.join([
+            # timestamp (us), address, size, traceback, operation, padding
+            pack(1000000, 0x10, 10, 1, alloc, 0),
+            pack(1200000, 0x20, 20, 1, alloc, 0),
+            pack(1300000, 0x10, 10, 1, free, 0),
+            pack(1400000, 0x30, 30, 2, alloc, 0),
+            pack(3500000, 0x40, 40, 1, alloc, 0),
+        ])
+        tracebacks = {1: (('a.py', 2),), 2: (('b.py', 4),)}
+        log = tracemalloc.EventLog(data, tracebacks, 3)
+        self.assertEqual(len(log), 5)
+        self.assertEqual(log.lost, 3)
+        event = log[2]
+        self.assertEqual((event.timestamp, event.op, event.address,
+                          event.size, event.traceback),
+                         (1.3, free, 0x10, 10, traceback_lineno('a.py', 2)))
+
+        for numpy in (tracemalloc._import_numpy(), False):
+            tracemalloc._numpy = numpy
+            rates = log.allocation_rates(1.0)
+            self.assertEqual(rates, {
+                traceback_lineno('a.py', 2): [(1.0, 2, 30), (3.0, 1, 40)],
+                traceback_lineno('b.py', 4): [(1.0, 1, 30)],
+            })
+            self.assertEqual(tracemalloc.EventLog(b'', {}).allocation_rates(),
+                             {})
+        self.assertRaises(ValueError, log.allocation_rates, 0)
+
+    def test_load_pickle(self):
+        # snapshots pickled by older versions can still be loaded
+        snapshot, snapshot2 = create_snapshots()
+        with open(support.TESTFN, "wb") as fp:
+            pickle.dump(snapshot, fp, pickle.HIGHEST_PROTOCOL)
+        self.addCleanup(support.unlink, support.TESTFN)
+
+        snapshot3 = tracemalloc.Snapshot.load(support.TESTFN)
+        self.assertEqual(snapshot3.traces, snapshot.traces)
+        self.assertEqual(snapshot3.traceback_limit, snapshot.traceback_limit)
+
     def test_trace_format(self):
         snapshot, snapshot2 = create_snapshots()
         trace = snapshot.traces[0]
@@ -550,6 +1383,65 @@ class TestSnapshot(unittest.TestCase):
         self.assertEqual(str(stat),
                          'a.py:5: size=5002 B (+5000 B), count=2 (+1), average=2501 B')
 
+    def test_snapshot_series(self):
+        snapshot, snapshot2 = create_snapshots()
+        raw_traces3 = list(snapshot2.traces._traces) + [
+            (10, (('a.py', 2), ('b.py', 4))),
+            (300, (('c.py', 578),)),
+        ]
+        snapshot3 = tracemalloc.Snapshot(raw_traces3, 2)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for index, snapshot4 in enumerate((snapshot, snapshot2, snapshot3)):
+            snapshot4.dump(os.path.join(directory, 'snapshot-%02d' % index))
+
+        for workers in (1, 2):
+            series = tracemalloc.SnapshotSeries.load(directory, 'snapshot-*',
+                                                     workers=workers)
+            self.assertEqual(len(series), 3)
+            self.assertEqual(series[1].traces, snapshot2.traces)
+            self.assertEqual(series.statistics(0, 'lineno'),
+                             snapshot.statistics('lineno'))
+            self.assertEqual(series.statistics(-1, 'filename', True),
+                             snapshot3.statistics('filename', True))
+            self.assertEqual(series.compare(0, 2, 'lineno'),
+                             snapshot3.compare_to(snapshot, 'lineno'))
+            self.assertEqual(series.compare_consecutive('traceback'), [
+                snapshot2.compare_to(snapshot, 'traceback'),
+                snapshot3.compare_to(snapshot2, 'traceback'),
+            ])
+
+            # b.py:1 is removed, a.py:5 only grows in the second snapshot
+            self.assertEqual(series.growing('lineno'), [
+                tracemalloc.StatisticDiff(traceback_lineno('a.py', 5),
+                                          5002, 5000, 2, 1),
+                tracemalloc.StatisticDiff(traceback_lineno('c.py', 578),
+                                          700, 700, 2, 2),
+                tracemalloc.StatisticDiff(traceback_lineno('a.py', 2),
+                                          40, 10, 4, 1),
+            ])
+            self.assertEqual(series[2:].growing('lineno'), [])
+            self.assertRaises(ValueError, series.growing, 'traceback', True)
+
+    def test_compare_allocation_statistics(self):
+        a = tracemalloc.Traceback((('a.py', 2),))
+        b = tracemalloc.Traceback((('b.py', 4),))
+        c = tracemalloc.Traceback((('c.py', 1),))
+        AllocationStatistic = tracemalloc.AllocationStatistic
+        old_stats = [AllocationStatistic(a, 100, 10, 5),
+                     AllocationStatistic(b, 50, 5, 5),
+                     AllocationStatistic(c, 30, 3, 2)]
+        stats = [AllocationStatistic(a, 250, 20, 18),
+                 AllocationStatistic(b, 50, 5, 5),
+                 # counters reset by clear_traces()
+                 AllocationStatistic(c, 10, 1, 0)]
+        diff = tracemalloc.compare_allocation_statistics(stats, old_stats)
+        self.assertEqual(diff, [AllocationStatistic(a, 150, 10, 13),
+                                AllocationStatistic(c, 10, 1, 0)])
+        self.assertEqual(str(diff[0]),
+                         'a.py:2: allocated=150 B, count=10, freed=13, '
+                         'average=15 B')
+
     def test_slices(self):
         snapshot, snapshot2 = create_snapshots()
         self.assertEqual(snapshot.traces[:2],
@@ -797,6 +1689,121 @@ class TestFilters(unittest.TestCase):
         self.assertFalse(f._match_traceback(t3))
         self.assertFalse(f._match_traceback(unknown))
 
+    def test_filter_set(self):
+        tracebacks = [
+            (("a.py", 2), ("b.py", 3)),
+            (("b.py", 4), ("b.py", 5)),
+            (("c.pyc", 5), ('<unknown>', 0)),
+            (('<unknown>', 0),),
+        ]
+        filters = []
+        for inclusive in (True, False):
+            for all_frames in (False, True):
+                filters.append(tracemalloc.Filter(inclusive, "b.py",
+                                                  all_frames=all_frames))
+                filters.append(tracemalloc.Filter(inclusive, "*.py", 5,
+                                                  all_frames=all_frames))
+
+        def match(filters, traceback):
+            include = [f for f in filters if f.inclusive]
+            exclude = [f for f in filters if not f.inclusive]
+            if include and not any(f._match_traceback(traceback)
+                                   for f in include):
+                return False
+            return all(f._match_traceback(traceback) for f in exclude)
+
+        for filter1 in filters:
+            for filter2 in filters:
+                filter_set = tracemalloc._FilterSet([filter1, filter2])
+                for traceback in tracebacks:
+                    expected = match([filter1, filter2], traceback)
+                    self.assertEqual(filter_set.match(traceback), expected)
+                    # memoized result
+                    self.assertEqual(filter_set.match(traceback), expected)
+
+        self.assertTrue(tracemalloc._FilterSet([]).match(tracebacks[0]))
+
+
+class TestRunner(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def delta_filename(self, index):
+        return os.path.join(self.directory, 'test-%04d.delta' % index)
+
+    def check_snapshot(self, snapshot, traces):
+        expected = []
+        for key, count in traces.items():
+            traceback, size, domain = key
+            expected.extend([(size, traceback, domain)] * count)
+        loaded = [(trace.size, trace.traceback._frames, trace.domain)
+                  for trace in snapshot.traces]
+        self.assertEqual(sorted(loaded), sorted(expected))
+
+    def test_load_snapshot(self):
+        a = (('a.py', 2),)
+        b = (('b.py', 4), ('a.py', 2))
+        c = (('c.py', 578),)
+        # grouped traces: (traceback, size, domain) => number of traces
+        states = [
+            {(a, 10, 0): 2, (b, 20, 1): 1},
+            # a grows, b is removed, c is added
+            {(a, 10, 0): 5, (c, 30, 2): 1},
+            # b is used again, a shrinks
+            {(a, 10, 0): 1, (b, 20, 1): 3, (c, 30, 2): 1},
+            {},
+        ]
+        thread = tracemalloc_runner.TakeSnapshot()
+        for index, traces in enumerate(states):
+            thread.write_delta(traces, self.delta_filename(index))
+
+        for index, traces in enumerate(states):
+            snapshot = tracemalloc_runner.load_snapshot(
+                self.delta_filename(index))
+            self.check_snapshot(snapshot, traces)
+
+    def test_write_delta_error(self):
+        a = (('a.py', 2),)
+        b = (('b.py', 4),)
+        states = [{(a, 10, 0): 2}, {(a, 10, 0): 1, (b, 20, 0): 1}]
+        thread = tracemalloc_runner.TakeSnapshot()
+        thread.write_delta(states[0], self.delta_filename(0))
+
+        # a delta which cannot be written must not change the state
+        # of the thread: the next delta is relative to the last written
+        # snapshot
+        filename = os.path.join(self.directory, 'missing', 'test.delta')
+        self.assertRaises(IOError, thread.write_delta, states[1], filename)
+        unpicklable = (('c.py', lambda: None),)
+        unpicklable = {(a, 10, 0): 1, (unpicklable, 30, 0): 1}
+        self.assertRaises(Exception, thread.write_delta, unpicklable,
+                          self.delta_filename(1))
+        self.assertFalse(os.path.exists(self.delta_filename(1)))
+
+        thread.write_delta(states[1], self.delta_filename(1))
+        for index, traces in enumerate(states):
+            snapshot = tracemalloc_runner.load_snapshot(
+                self.delta_filename(index))
+            self.check_snapshot(snapshot, traces)
+
+    def test_load_command(self):
+        a = (('a.py', 2),)
+        states = [{(a, 10, 0): 2}, {(a, 10, 0): 3}]
+        thread = tracemalloc_runner.TakeSnapshot()
+        for index, traces in enumerate(states):
+            thread.write_delta(traces, self.delta_filename(index))
+
+        output = os.path.join(self.directory, 'snapshot')
+        self.addCleanup(setattr, sys, 'argv', sys.argv)
+        sys.argv = ['tracemalloc_runner.py', '--load',
+                    self.delta_filename(1), output]
+        with support.captured_stdout() as stdout:
+            tracemalloc_runner.main()
+        self.assertIn('(3 traces)', stdout.getvalue())
+        snapshot = tracemalloc.Snapshot.load(output)
+        self.check_snapshot(snapshot, states[1])
+
 
 class TestVersion(unittest.TestCase):
     def test_version(self):
@@ -815,6 +1822,7 @@ def test_main():
         TestTracemallocEnabled,
         TestSnapshot,
         TestFilters,
+        TestRunner,
         TestVersion,
     )
 
@@ -31,6 +31,15 @@ def alloc_objects():
         objs = [alloc_object() for index in range(NOBJECTS)]
         objs = None
 
+def append_lists():
+    # growing lists resize their items array with PyMem_Realloc()
+    for loop in range(ALLOC_LOOPS):
+        lists = [[] for index in range(NOBJECTS // 100)]
+        for item in range(100):
+            for obj in lists:
+                obj.append(item)
+        lists = None
+
 def take_snapshots():
     all_snapshots = []
     for loop in range(NGET_SNAPSHOT):
@@ -41,10 +50,27 @@ def take_snapshots():
         snapshots = None
     all_snapshots = None
 
-def bench(func, trace=True, nframe=1):
+def snapshot_statistics():
+    for loop in range(NGET_SNAPSHOT):
+        objs = [alloc_object() for index in range(NOBJECTS)]
+        stats = tracemalloc.take_snapshot().statistics('lineno')
+        objs = None
+        stats = None
+
+def get_statistics():
+    for loop in range(NGET_SNAPSHOT):
+        objs = [alloc_object() for index in range(NOBJECTS)]
+        stats = tracemalloc.get_statistics('lineno')
+        objs = None
+        stats = None
+
+def bench(func, trace=True, nframe=1, traces_table='chained', sample_rate=0,
+          min_size=0, realloc_traceback='resize'):
     if trace:
         tracemalloc.stop()
-        tracemalloc.start(nframe)
+        tracemalloc.start(nframe, traces_table=traces_table,
+                          sample_rate=sample_rate, min_size=min_size,
+                          realloc_traceback=realloc_traceback)
     gc.collect()
     best = None
     for run in range(BENCH_RUNS):
@@ -70,18 +96,42 @@ def main():
     base, mem, ntrace = bench(alloc_objects, False)
     print("no tracing: %.1f ms" % base)
 
-    def run(what, nframe=1):
-        dt, mem, ntrace = bench(alloc_objects, nframe=nframe)
+    def run(what, nframe=1, traces_table='chained', sample_rate=0,
+            min_size=0):
+        dt, mem, ntrace = bench(alloc_objects, nframe=nframe,
+                                traces_table=traces_table,
+                                sample_rate=sample_rate, min_size=min_size)
         print("%s: %.1f ms, %.1fx slower (%s traces, %.1f kB)"
               % (what, dt, dt / base, ntrace, mem / 1024))
 
     run("trace")
+    run("trace, open addressing traces table", traces_table='open')
+    run("trace, sample 1 block per 512 kB", sample_rate=512 * 1024)
+    run("trace, only blocks of 512 bytes or more", min_size=512)
 
-    for nframe in (5, 10, 25, 100):
+    # tracemalloc_runner.py uses 50 frames by default
+    for nframe in (5, 10, 25, 50, 100):
         run("trace, %s frames" % nframe, nframe=nframe)
     print("")
 
+    base, mem, ntrace = bench(append_lists, False)
+    print("append to lists, no tracing: %.1f ms" % base)
+    for nframe in (1, 10):
+        for realloc_traceback in ('resize', 'allocation'):
+            dt, mem, ntrace = bench(append_lists, nframe=nframe,
+                                    realloc_traceback=realloc_traceback)
+            print("append to lists, trace %s frame(s), %s traceback: "
+                  "%.1f ms, %.1fx slower"
+                  % (nframe, realloc_traceback, dt, dt / base))
+    print("")
+
     dt, mem, ntrace = bench(take_snapshots)
     print("take %s snapshots: %.1f ms" % (NGET_SNAPSHOT, dt))
 
+    dt, mem, ntrace = bench(snapshot_statistics)
+    print("take %s snapshots and statistics: %.1f ms" % (NGET_SNAPSHOT, dt))
+
+    dt, mem, ntrace = bench(get_statistics)
+    print("get %s statistics: %.1f ms" % (NGET_SNAPSHOT, dt))
+
 main()
@@ -0,0 +1,56 @@
+#ifndef PYTRACEMALLOC_H
+#define PYTRACEMALLOC_H
+
+/* C API of the _tracemalloc module to trace memory blocks allocated by
+   custom memory allocators of C extensions.
+
+   Usage:
+
+       PyTraceMalloc_CAPI *tracemalloc_api = PyTraceMalloc_IMPORT();
+       if (tracemalloc_api == NULL)
+           ... error, or PyErr_Clear() to run without tracemalloc ...
+
+       ptr = my_malloc(size);
+       tracemalloc_api->track(MY_DOMAIN, (Py_uintptr_t)ptr, size);
+       ...
+       tracemalloc_api->untrack(MY_DOMAIN, (Py_uintptr_t)ptr);
+       my_free(ptr);
+
+   Custom domains must be greater than or equal to
+   PyTraceMalloc_FIRST_CUSTOM_DOMAIN: smaller domains are the domains of
+   Python memory allocators (DOMAIN_RAW, DOMAIN_MEM and DOMAIN_OBJ of the
+   tracemalloc module).
+
+   The API requires Python 2.7 or newer (PyCapsule). */
+
+#define PyTraceMalloc_CAPSULE_NAME "_tracemalloc._C_API"
+
+#define PyTraceMalloc_FIRST_CUSTOM_DOMAIN 3
+
+typedef struct {
+    /* Track an allocated memory block of size bytes at the address ptr in the
+       domain: store the current Python traceback. If ptr is already tracked,
+       its trace is replaced. The memory block may not be traced depending
+       on the sample rate, the minimum size and filters of tracemalloc.
+
+       The function can be called without holding the GIL.
+
+       Return 0 on success, -1 on error (invalid domain or memory allocation
+       failure), or -2 if tracemalloc is not tracing memory allocations. */
+    int (*track)(unsigned int domain, Py_uintptr_t ptr, size_t size);
+
+    /* Untrack the memory block at the address ptr in the domain. Do nothing
+       if the memory block is not tracked.
+
+       The function can be called without holding the GIL.
+
+       Return 0 on success, or -2 if tracemalloc is not tracing memory
+       allocations. */
+    int (*untrack)(unsigned int domain, Py_uintptr_t ptr);
+} PyTraceMalloc_CAPI;
+
+/* Import the C API: return NULL and raise an exception on error */
+#define PyTraceMalloc_IMPORT() \
+        ((PyTraceMalloc_CAPI *)PyCapsule_Import(PyTraceMalloc_CAPSULE_NAME, 0))
+
+#endif   /* !PYTRACEMALLOC_H */
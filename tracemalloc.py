@@ -1,12 +1,24 @@
 from collections import Sequence, Iterable
+import array
 import fnmatch
+import glob
 import linecache
+import math
+import mmap
+import numbers
 import os.path
 import pickle
+import re
+import struct
+import sys
 
 # Import types and functions implemented in C
 from _tracemalloc import *
-from _tracemalloc import _get_object_traceback, _get_traces, __version__
+from _tracemalloc import (_get_object_traceback, _get_traces, _dump_traces,
+                          _get_statistics, _set_trace_filters,
+                          _get_trace_filters, _drain_events,
+                          _get_allocation_statistics, _get_pymalloc_blocks)
+from _tracemalloc import __version__
 
 
 try:
@@ -164,6 +176,88 @@ def _compare_grouped_stats(old_group, new_group):
     return statistics
 
 
+class AllocationStatistic(object):
+    """
+    Cumulative number and size of memory blocks allocated by a traceback,
+    and number of these memory blocks released.
+    """
+
+    __slots__ = ('traceback', 'size', 'count', 'free_count')
+
+    def __init__(self, traceback, size, count, free_count):
+        self.traceback = traceback
+        self.size = size
+        self.count = count
+        self.free_count = free_count
+
+    def __hash__(self):
+        return hash((self.traceback, self.size, self.count, self.free_count))
+
+    def __eq__(self, other):
+        return (self.traceback == other.traceback
+                and self.size == other.size
+                and self.count == other.count
+                and self.free_count == other.free_count)
+
+    def __str__(self):
+        text = ("%s: allocated=%s, count=%i, freed=%i"
+                % (self.traceback,
+                   _format_size(self.size, False),
+                   self.count,
+                   self.free_count))
+        if self.count:
+            average = self.size / self.count
+            text += ", average=%s" % _format_size(average, False)
+        return text
+
+    def __repr__(self):
+        return ('<AllocationStatistic traceback=%r size=%i count=%i '
+                'free_count=%i>'
+                % (self.traceback, self.size, self.count, self.free_count))
+
+    def _sort_key(self):
+        return (self.size, self.count, self.free_count, self.traceback)
+
+
+class ArenaStatistic(object):
+    """
+    Memory usage of a pymalloc arena and snapshot of the traced memory blocks
+    stored in the arena.
+    """
+
+    __slots__ = ('arena', 'pool_count', 'used_size', 'free_size', 'snapshot')
+
+    def __init__(self, arena, pool_count, used_size, free_size, snapshot):
+        self.arena = arena
+        self.pool_count = pool_count
+        self.used_size = used_size
+        self.free_size = free_size
+        self.snapshot = snapshot
+
+    def __eq__(self, other):
+        return (self.arena == other.arena
+                and self.pool_count == other.pool_count
+                and self.used_size == other.used_size
+                and self.free_size == other.free_size
+                and self.snapshot.traces == other.snapshot.traces)
+
+    def __str__(self):
+        return ("arena #%i: %i pools, used=%s, free=%s, traces=%i"
+                % (self.arena, self.pool_count,
+                   _format_size(self.used_size, False),
+                   _format_size(self.free_size, False),
+                   len(self.snapshot.traces)))
+
+    def __repr__(self):
+        return ('<ArenaStatistic arena=%i pool_count=%i used_size=%i '
+                'free_size=%i traces=%i>'
+                % (self.arena, self.pool_count, self.used_size,
+                   self.free_size, len(self.snapshot.traces)))
+
+    def _sort_key(self):
+        return (self.used_size, -self.free_size, self.arena)
+
+
 @total_ordering
 class Frame(object):
     """
@@ -268,6 +362,22 @@ def get_object_traceback(obj):
         return None
 
 
+def _trace_domain(trace):
+    # traces of snapshots created by older versions have no domain
+    if len(trace) > 2:
+        return trace[2]
+    else:
+        return None
+
+
+def _trace_type(trace):
+    # only traces of snapshots taken with object types have a type
+    if len(trace) > 3:
+        return trace[3]
+    else:
+        return None
+
+
 class Trace(object):
     """
     Trace of a memory block.
@@ -275,8 +385,10 @@ class Trace(object):
     __slots__ = ("_trace",)
 
     def __init__(self, trace):
-        # trace is a tuple: (size, traceback), see Traceback constructor
-        # for the format of the traceback tuple
+        # trace is a tuple: (size, traceback, domain) or (size, traceback,
+        # domain, type_name), see Traceback constructor for the format of
+        # the traceback tuple. Traces of snapshots created by older versions
+        # have no domain.
         self._trace = trace
 
     @property
@@ -287,6 +399,14 @@ class Trace(object):
     def traceback(self):
         return Traceback(self._trace[1])
 
+    @property
+    def domain(self):
+        return _trace_domain(self._trace)
+
+    @property
+    def type(self):
+        return _trace_type(self._trace)
+
     def __eq__(self, other):
         return (self._trace == other._trace)
 
@@ -369,43 +489,926 @@ class Filter(object):
             return self._match_frame(filename, lineno)
 
 
+class DomainFilter(object):
+    def __init__(self, inclusive, domain):
+        self.inclusive = inclusive
+        self.domain = domain
+
+
+_DOMAIN_NAMES = {DOMAIN_RAW: 'raw', DOMAIN_MEM: 'mem', DOMAIN_OBJ: 'obj'}
+
+
+def _domain_frames(domain):
+    # Traceback tuple of the statistics on the domain of memory blocks
+    if domain is None:
+        return (('<unknown domain>', 0),)
+    return (('<%s>' % _DOMAIN_NAMES.get(domain, 'domain %s' % domain), 0),)
+
+
+def _type_frames(type_name):
+    # Traceback tuple of the statistics on the type of objects
+    if type_name is None:
+        return (('<unknown type>', 0),)
+    return (('<type %s>' % type_name, 0),)
+
+
+def _get_types():
+    # Get all types: subclasses of object, recursively
+    types = {}
+    pending = [object]
+    while pending:
+        cls = pending.pop()
+        if id(cls) in types:
+            continue
+        types[id(cls)] = cls
+        # type.__subclasses__() also works on metaclasses
+        pending.extend(type.__subclasses__(cls))
+    return list(types.values())
+
+
+class _FilterSet(object):
+    """
+    Filters compiled to filter many tracebacks: the filename pattern of each
+    filter is compiled once to a regular expression, each filename is matched
+    once against all patterns and each traceback is only evaluated once.
+    """
+
+    def __init__(self, filters):
+        filters = list(filters)
+        # domain filters are evaluated on each trace
+        self._include_domains = set()
+        self._exclude_domains = set()
+        for trace_filter in filters:
+            if isinstance(trace_filter, DomainFilter):
+                if trace_filter.inclusive:
+                    self._include_domains.add(trace_filter.domain)
+                else:
+                    self._exclude_domains.add(trace_filter.domain)
+        self._has_include = any(trace_filter.inclusive
+                                for trace_filter in filters)
+        self.has_domain_filters = bool(self._include_domains
+                                       or self._exclude_domains)
+        filters = [trace_filter for trace_filter in filters
+                   if not isinstance(trace_filter, DomainFilter)]
+        self._patterns = [
+            re.compile(fnmatch.translate(trace_filter.filename_pattern)).match
+            for trace_filter in filters]
+        self._linenos = [trace_filter.lineno for trace_filter in filters]
+        # indexes of filters matching the most recent frame or all frames
+        self._include_first = []
+        self._include_all = []
+        self._exclude_first = []
+        self._exclude_all = []
+        for index, trace_filter in enumerate(filters):
+            if trace_filter.inclusive:
+                if trace_filter.all_frames:
+                    self._include_all.append(index)
+                else:
+                    self._include_first.append(index)
+            else:
+                if trace_filter.all_frames:
+                    self._exclude_all.append(index)
+                else:
+                    self._exclude_first.append(index)
+        # filename => tuple of booleans: does the filename match the pattern
+        # of each filter?
+        self._filename_matches = {}
+        # traceback tuple => (included: bool, excluded: bool)
+        self._traceback_matches = {}
+
+    def _match_filename(self, filename):
+        try:
+            return self._filename_matches[filename]
+        except KeyError:
+            normalized = _normalize_filename(filename)
+            matches = tuple(bool(pattern(normalized))
+                            for pattern in self._patterns)
+            self._filename_matches[filename] = matches
+            return matches
+
+    def _match_frames(self, frames, indexes):
+        # Does a frame match one of the filters? indexes is a list of filter
+        # indexes.
+        if not indexes:
+            return False
+        linenos = self._linenos
+        for filename, lineno in frames:
+            matches = self._match_filename(filename)
+            for index in indexes:
+                if not matches[index]:
+                    continue
+                if linenos[index] is None or linenos[index] == lineno:
+                    return True
+        return False
+
+    def _match_traceback(self, traceback):
+        # Does the traceback tuple match an inclusive filter? Does it match
+        # an exclusive filter?
+        try:
+            return self._traceback_matches[traceback]
+        except KeyError:
+            pass
+
+        included = (self._match_frames(traceback[:1], self._include_first)
+                    or self._match_frames(traceback, self._include_all))
+        excluded = (self._match_frames(traceback[:1], self._exclude_first)
+                    or self._match_frames(traceback, self._exclude_all))
+        result = (included, excluded)
+        self._traceback_matches[traceback] = result
+        return result
+
+    def match(self, traceback, domain=None):
+        """
+        Return True if the trace of the traceback tuple allocated in domain
+        must be kept.
+        """
+        included, excluded = self._match_traceback(traceback)
+        if (self._has_include and not included
+                and domain not in self._include_domains):
+            return False
+        return not (excluded or domain in self._exclude_domains)
+
+
+def set_trace_filters(filters):
+    """
+    Set filters evaluated when memory blocks are allocated: memory blocks
+    filtered out by the list of Filter instances are not traced. Filters are
+    evaluated as Snapshot.filter_traces() evaluates them.
+    """
+    if not isinstance(filters, Iterable):
+        raise TypeError("filters must be a list of filters, not %s"
+                        % type(filters).__name__)
+    filters = list(filters)
+    if any(isinstance(trace_filter, DomainFilter) for trace_filter in filters):
+        raise TypeError("DomainFilter is not supported by set_trace_filters()")
+    _set_trace_filters([(trace_filter.inclusive,
+                         trace_filter.filename_pattern,
+                         trace_filter.lineno,
+                         trace_filter.all_frames)
+                        for trace_filter in filters])
+
+
+def get_trace_filters():
+    """
+    Get filters evaluated when memory blocks are allocated as a list of
+    Filter instances.
+    """
+    return [Filter(inclusive, filename_pattern, lineno, all_frames)
+            for inclusive, filename_pattern, lineno, all_frames
+            in _get_trace_filters()]
+
+
+def _check_key_type(key_type, cumulative):
+    if key_type not in ('traceback', 'filename', 'lineno', 'domain', 'type'):
+        raise ValueError("unknown key_type: %r" % (key_type,))
+    if cumulative and key_type not in ('lineno', 'filename'):
+        raise ValueError("cumulative mode cannot by used "
+                         "with key type %r" % key_type)
+
+
+def _check_live_key_type(key_type, cumulative):
+    # types of objects are only resolved by take_snapshot()
+    _check_key_type(key_type, cumulative)
+    if key_type == 'type':
+        raise ValueError("key type 'type' requires a snapshot: "
+                         "use take_snapshot(object_types=True)")
+
+
+def _sampled_estimate(size, sample_rate):
+    # A memory block of size bytes is sampled with the probability
+    # 1 - exp(-size / sample_rate): weight it by the inverse probability
+    # to get unbiased estimates of the size and the number of memory blocks
+    weight = 1.0 / (1.0 - math.exp(-float(size) / sample_rate))
+    return (size * weight, weight)
+
+
+# Binary format of snapshot files written by Snapshot.dump(), all integers
+# are little endian:
+#
+# - header: magic, version, traceback_limit, sample_rate
+# - filenames: number of filenames (uint32), then for each filename its length
+#   (uint32) and its UTF-8 encoded bytes
+# - tracebacks: number of tracebacks (uint32), the number of frames of each
+#   traceback (uint32 array) and then the frames of all tracebacks, the most
+#   recent frame first: (filename index, lineno) (uint32 array)
+# - type names (since version 3): number of type names (uint32), then for
+#   each type name its length (uint32) and its UTF-8 encoded bytes
+# - traces: number of traces (uint64), the size of each trace (uint64 array),
+#   the traceback index of each trace (uint32 array), the domain of each
+#   trace (uint32 array, since version 2) and then the type of each trace
+#   (uint32 array, since version 3): 0 for an unknown type, or the index
+#   plus one of the type name
+# - attributes: length (uint64) of the pickled dictionary of other attributes
+#   of the snapshot, then the pickled dictionary (if the length is non-zero)
+#
+# Snapshots without domains, created by older versions, are written with the
+# version 1 of the format. Snapshots without types are written with the
+# version 2.
+_SNAPSHOT_MAGIC = b'tracemalloc\0'
+_SNAPSHOT_VERSION = 3
+_SNAPSHOT_HEADER = struct.Struct('<%ssIIQ' % len(_SNAPSHOT_MAGIC))
+_UINT32 = struct.Struct('<I')
+_UINT64 = struct.Struct('<Q')
+# number of integers packed at once
+_ARRAY_CHUNK = 64 * 1024
+
+if sys.version_info >= (3,):
+    _FILENAME_ERRORS = 'surrogateescape'
+else:
+    _FILENAME_ERRORS = 'strict'
+
+
+def _encode_filename(filename):
+    if isinstance(filename, bytes):
+        # Python 2 str
+        return filename
+    return filename.encode('utf-8', _FILENAME_ERRORS)
+
+
+def _decode_filename(data):
+    if str is bytes:
+        # Python 2
+        return data
+    return data.decode('utf-8', _FILENAME_ERRORS)
+
+
+def _read_exactly(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise ValueError("truncated snapshot file")
+    return data
+
+
+def _write_array(fp, fmt, values):
+    for start in range(0, len(values), _ARRAY_CHUNK):
+        chunk = values[start:start + _ARRAY_CHUNK]
+        fp.write(struct.pack('<%s%s' % (len(chunk), fmt), *chunk))
+
+
+def _read_array(fp, fmt, count):
+    itemsize = struct.calcsize('<' + fmt)
+    values = []
+    for start in range(0, count, _ARRAY_CHUNK):
+        chunk = min(count - start, _ARRAY_CHUNK)
+        data = _read_exactly(fp, chunk * itemsize)
+        values.extend(struct.unpack('<%s%s' % (chunk, fmt), data))
+    return values
+
+
+# NumPy module, False if it is not available, None if it was not imported yet
+_numpy = None
+
+
+def _import_numpy():
+    # NumPy is only imported to analyze traces: importing it at startup would
+    # allocate memory in the traced program
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy
+
+
+def _array_typecode(itemsize):
+    for typecode in ('I', 'L', 'Q'):
+        try:
+            if array.array(typecode).itemsize == itemsize:
+                return typecode
+        except ValueError:
+            # 'Q' requires Python 3.3
+            pass
+    return None
+
+
+def _unpack_column(data, fmt, count, offset=0):
+    # Unpack count little endian integers of the format fmt ('I' or 'Q') as
+    # a NumPy array, or as an array.array if NumPy is not available. Return
+    # None if no array type can store the integers.
+    itemsize = struct.calcsize('<' + fmt)
+    numpy = _import_numpy()
+    if numpy:
+        dtype = numpy.dtype('<u%s' % itemsize)
+        if not count:
+            return numpy.zeros(0, dtype)
+        return numpy.frombuffer(data, dtype, count, offset)
+    typecode = _array_typecode(itemsize)
+    if typecode is None:
+        return None
+    column = array.array(typecode)
+    data = data[offset:offset + count * itemsize]
+    if hasattr(column, 'frombytes'):
+        column.frombytes(data)
+    else:
+        # Python 2
+        column.fromstring(data)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def _dump_snapshot(snapshot, fp):
+    filenames = {}
+    # traceback tuple => traceback index
+    tracebacks = {}
+    # traces of a snapshot taken by take_snapshot() share traceback tuples:
+    # id(traceback tuple) => traceback index
+    traceback_ids = {}
+    traceback_nframes = []
+    frames = []
+    sizes = []
+    traceback_indexes = []
+    domains = []
+    # type name => type identifier, 0 is the unknown type
+    type_ids = {None: 0}
+    types = []
+    for trace in snapshot.traces._traces:
+        size = trace[0]
+        traceback = trace[1]
+        if domains is not None:
+            if len(trace) > 2:
+                domains.append(trace[2])
+            else:
+                domains = None
+        if types is not None:
+            if len(trace) > 3:
+                try:
+                    type_id = type_ids[trace[3]]
+                except KeyError:
+                    type_id = len(type_ids)
+                    type_ids[trace[3]] = type_id
+                types.append(type_id)
+            else:
+                types = None
+        try:
+            index = traceback_ids[id(traceback)]
+        except KeyError:
+            index = tracebacks.get(traceback)
+            if index is None:
+                index = len(traceback_nframes)
+                tracebacks[traceback] = index
+                traceback_nframes.append(len(traceback))
+                for filename, lineno in traceback:
+                    try:
+                        filename_index = filenames[filename]
+                    except KeyError:
+                        filename_index = len(filenames)
+                        filenames[filename] = filename_index
+                    frames.append(filename_index)
+                    frames.append(lineno)
+            traceback_ids[id(traceback)] = index
+        sizes.append(size)
+        traceback_indexes.append(index)
+
+    if domains is None:
+        version = 1
+    elif types is None:
+        version = 2
+    else:
+        version = _SNAPSHOT_VERSION
+    fp.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, version,
+                                   snapshot.traceback_limit,
+                                   snapshot.sample_rate))
+
+    fp.write(_UINT32.pack(len(filenames)))
+    for filename in sorted(filenames, key=filenames.__getitem__):
+        data = _encode_filename(filename)
+        fp.write(_UINT32.pack(len(data)))
+        fp.write(data)
+
+    fp.write(_UINT32.pack(len(traceback_nframes)))
+    _write_array(fp, 'I', traceback_nframes)
+    _write_array(fp, 'I', frames)
+
+    if version >= 3:
+        fp.write(_UINT32.pack(len(type_ids) - 1))
+        for type_name in sorted(type_ids, key=type_ids.__getitem__)[1:]:
+            data = _encode_filename(type_name)
+            fp.write(_UINT32.pack(len(data)))
+            fp.write(data)
+
+    fp.write(_UINT64.pack(len(sizes)))
+    _write_array(fp, 'Q', sizes)
+    _write_array(fp, 'I', traceback_indexes)
+    if domains is not None:
+        _write_array(fp, 'I', domains)
+    if version >= 3:
+        _write_array(fp, 'I', types)
+
+    attrs = dict((name, value) for name, value in vars(snapshot).items()
+                 if name not in ('traces', 'traceback_limit', 'sample_rate'))
+    if attrs:
+        data = pickle.dumps(attrs, pickle.HIGHEST_PROTOCOL)
+    else:
+        data = b''
+    fp.write(_UINT64.pack(len(data)))
+    fp.write(data)
+
+
+class _PackedTraces(Sequence):
+    """
+    Base class of sequences of trace tuples which are not stored as trace
+    tuples: trace tuples are created when they are accessed.
+    """
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return (len(self) == len(other)
+                and all(trace1 == trace2
+                        for trace1, trace2 in zip(self, other)))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+
+class _ColumnarTraces(_PackedTraces):
+    """
+    Sequence of trace tuples stored as columns: an array of sizes, an array
+    of traceback identifiers, indexes in a list of traceback tuples, an
+    array of domains (None if traces have no domain) and an array of type
+    identifiers, indexes in a list of type names (None if traces have no
+    type). Traces with a type also have a domain.
+
+    Arrays are NumPy arrays if NumPy is available, array.array otherwise.
+    """
+
+    def __init__(self, sizes, traceback_ids, tracebacks, domains=None,
+                 types=None, type_names=None):
+        _PackedTraces.__init__(self)
+        self.sizes = sizes
+        self.traceback_ids = traceback_ids
+        self.tracebacks = tracebacks
+        self.domains = domains
+        self.types = types
+        # the first type name is None: unknown type
+        self.type_names = type_names
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, index):
+        tracebacks = self.tracebacks
+        if isinstance(index, slice):
+            sizes = self.sizes[index].tolist()
+            traceback_ids = self.traceback_ids[index].tolist()
+            if self.domains is None:
+                return [(size, tracebacks[traceback_id])
+                        for size, traceback_id in zip(sizes, traceback_ids)]
+            domains = self.domains[index].tolist()
+            if self.types is None:
+                return [(size, tracebacks[traceback_id], domain)
+                        for size, traceback_id, domain
+                        in zip(sizes, traceback_ids, domains)]
+            type_names = self.type_names
+            types = self.types[index].tolist()
+            return [(size, tracebacks[traceback_id], domain,
+                     type_names[type_id])
+                    for size, traceback_id, domain, type_id
+                    in zip(sizes, traceback_ids, domains, types)]
+        else:
+            trace = (int(self.sizes[index]),
+                     tracebacks[self.traceback_ids[index]])
+            if self.domains is not None:
+                trace += (int(self.domains[index]),)
+            if self.types is not None:
+                trace += (self.type_names[self.types[index]],)
+            return trace
+
+    def __iter__(self):
+        # convert NumPy integers to Python integers by chunks
+        for start in range(0, len(self), _ARRAY_CHUNK):
+            for trace in self[start:start + _ARRAY_CHUNK]:
+                yield trace
+
+    def _group_by_traceback(self, sample_rate):
+        # Return a list of (traceback, size, count) tuples: one per traceback
+        # used by traces
+        ntraceback = len(self.tracebacks)
+        numpy = _import_numpy()
+        if numpy:
+            traceback_ids = numpy.asarray(self.traceback_ids)
+            sizes = numpy.asarray(self.sizes, numpy.float64)
+            if sample_rate:
+                weights = 1.0 / (1.0 - numpy.exp(-sizes / sample_rate))
+                counts = numpy.bincount(traceback_ids, weights, ntraceback)
+                sizes = numpy.bincount(traceback_ids, sizes * weights,
+                                       ntraceback)
+                counts = counts.tolist()
+                sizes = sizes.tolist()
+            else:
+                counts = numpy.bincount(traceback_ids, None, ntraceback)
+                # sums of sizes are exact up to 2**53 bytes
+                sizes = numpy.bincount(traceback_ids, sizes, ntraceback)
+                counts = counts.tolist()
+                sizes = [int(size) for size in sizes.tolist()]
+        else:
+            counts = [0] * ntraceback
+            sizes = [0] * ntraceback
+            if sample_rate:
+                for size, traceback_id in zip(self.sizes, self.traceback_ids):
+                    size, count = _sampled_estimate(size, sample_rate)
+                    sizes[traceback_id] += size
+                    counts[traceback_id] += count
+            else:
+                for size, traceback_id in zip(self.sizes, self.traceback_ids):
+                    sizes[traceback_id] += size
+                    counts[traceback_id] += 1
+        return [(traceback, size, count)
+                for traceback, size, count in zip(self.tracebacks, sizes,
+                                                  counts)
+                if count]
+
+    def _group_by_column(self, column, sample_rate):
+        # Return a list of (value, size, count) tuples: one per value of the
+        # column used by traces. If column is None, the value is None.
+        if column is None:
+            values = [None] * len(self)
+        else:
+            values = column
+        numpy = _import_numpy()
+        if numpy and column is not None:
+            # custom domains can be large integers: number the values used by
+            # traces to group them with bincount()
+            values, value_ids = numpy.unique(numpy.asarray(values),
+                                             return_inverse=True)
+            nvalue = len(values)
+            sizes = numpy.asarray(self.sizes, numpy.float64)
+            if sample_rate:
+                weights = 1.0 / (1.0 - numpy.exp(-sizes / sample_rate))
+                counts = numpy.bincount(value_ids, weights, nvalue)
+                sizes = numpy.bincount(value_ids, sizes * weights, nvalue)
+                counts = counts.tolist()
+                sizes = sizes.tolist()
+            else:
+                counts = numpy.bincount(value_ids, None, nvalue)
+                # sums of sizes are exact up to 2**53 bytes
+                sizes = numpy.bincount(value_ids, sizes, nvalue)
+                counts = counts.tolist()
+                sizes = [int(size) for size in sizes.tolist()]
+            return list(zip(values.tolist(), sizes, counts))
+        stats = {}
+        for size, value in zip(self.sizes, values):
+            if sample_rate:
+                size, count = _sampled_estimate(size, sample_rate)
+            else:
+                count = 1
+            try:
+                stat = stats[value]
+                stat[0] += size
+                stat[1] += count
+            except KeyError:
+                stats[value] = [size, count]
+        return [(value, size, count)
+                for value, (size, count) in stats.items()]
+
+    def _group_by_domain(self, sample_rate):
+        # Return a list of (domain, size, count) tuples: one per domain used
+        # by traces
+        return self._group_by_column(self.domains, sample_rate)
+
+    def _group_by_type(self, sample_rate):
+        # Return a list of (type_name, size, count) tuples: one per type used
+        # by traces
+        result = self._group_by_column(self.types, sample_rate)
+        if self.types is None:
+            return result
+        type_names = self.type_names
+        return [(type_names[type_id], size, count)
+                for type_id, size, count in result]
+
+    def _select(self, mask):
+        # Get a new _ColumnarTraces with the traces of the tracebacks selected
+        # by mask: list of booleans indexed by traceback identifiers
+        numpy = _import_numpy()
+        if numpy:
+            selected = numpy.asarray(mask, bool)[
+                numpy.asarray(self.traceback_ids)]
+        else:
+            selected = [mask[traceback_id]
+                        for traceback_id in self.traceback_ids]
+        return self._compress(selected)
+
+    def _filter(self, filter_set):
+        # Get a new _ColumnarTraces with the traces kept by a _FilterSet
+        if self.domains is None or not filter_set.has_domain_filters:
+            return self._select([filter_set.match(traceback)
+                                 for traceback in self.tracebacks])
+
+        # evaluate filters once per traceback and per domain
+        numpy = _import_numpy()
+        if numpy:
+            traceback_ids = numpy.asarray(self.traceback_ids)
+            domains = numpy.asarray(self.domains)
+            selected = numpy.zeros(len(self), bool)
+            for domain in numpy.unique(domains).tolist():
+                mask = numpy.asarray([filter_set.match(traceback, domain)
+                                      for traceback in self.tracebacks],
+                                     bool)
+                in_domain = (domains == domain)
+                selected[in_domain] = mask[traceback_ids[in_domain]]
+        else:
+            masks = {}
+            selected = []
+            for traceback_id, domain in zip(self.traceback_ids,
+                                            self.domains):
+                try:
+                    mask = masks[domain]
+                except KeyError:
+                    mask = [filter_set.match(traceback, domain)
+                            for traceback in self.tracebacks]
+                    masks[domain] = mask
+                selected.append(mask[traceback_id])
+        return self._compress(selected)
+
+    def _compress(self, selected):
+        # Get a new _ColumnarTraces with the selected traces: sequence of
+        # booleans indexed by trace indexes
+        numpy = _import_numpy()
+
+        def compress(column):
+            if column is None:
+                return None
+            if numpy:
+                return numpy.asarray(column)[selected]
+            return array.array(column.typecode,
+                               [value
+                                for value, keep in zip(column, selected)
+                                if keep])
+
+        return _ColumnarTraces(compress(self.sizes),
+                               compress(self.traceback_ids),
+                               self.tracebacks,
+                               compress(self.domains),
+                               compress(self.types),
+                               self.type_names)
+
+
+class _MappedTraces(_PackedTraces):
+    """
+    Sequence of trace tuples decoded on demand from the packed arrays of a
+    memory mapped snapshot file.
+    """
+
+    def __init__(self, data, offset, count, tracebacks, has_domains=False,
+                 type_names=None):
+        _PackedTraces.__init__(self)
+        self._data = data
+        self._sizes_offset = offset
+        self._indexes_offset = offset + count * _UINT64.size
+        if has_domains:
+            self._domains_offset = self._indexes_offset + count * _UINT32.size
+        else:
+            self._domains_offset = None
+        if type_names is not None:
+            # traces with a type also have a domain
+            self._types_offset = self._domains_offset + count * _UINT32.size
+        else:
+            self._types_offset = None
+        self._count = count
+        # tracebacks is a list of traceback tuples
+        self._tracebacks = tracebacks
+        # type_names is a list of type names, or None if traces have no type
+        self._type_names = type_names
+
+    def __len__(self):
+        return self._count
+
+    def _decode(self, start, stop):
+        count = stop - start
+        sizes = struct.unpack_from('<%sQ' % count, self._data,
+                                   self._sizes_offset + start * _UINT64.size)
+        indexes = struct.unpack_from('<%sI' % count, self._data,
+                                     self._indexes_offset
+                                     + start * _UINT32.size)
+        tracebacks = self._tracebacks
+        if self._domains_offset is None:
+            return [(size, tracebacks[index])
+                    for size, index in zip(sizes, indexes)]
+        domains = struct.unpack_from('<%sI' % count, self._data,
+                                     self._domains_offset
+                                     + start * _UINT32.size)
+        if self._types_offset is None:
+            return [(size, tracebacks[index], domain)
+                    for size, index, domain in zip(sizes, indexes, domains)]
+        types = struct.unpack_from('<%sI' % count, self._data,
+                                   self._types_offset + start * _UINT32.size)
+        type_names = self._type_names
+        return [(size, tracebacks[index], domain, type_names[type_id])
+                for size, index, domain, type_id
+                in zip(sizes, indexes, domains, types)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._count)
+            if step == 1:
+                return self._decode(start, max(start, stop))
+            else:
+                return [self[index] for index in range(start, stop, step)]
+        else:
+            if index < 0:
+                index += self._count
+            if not (0 <= index < self._count):
+                raise IndexError("trace index out of range")
+            return self._decode(index, index + 1)[0]
+
+    def __iter__(self):
+        # decode traces by chunks to use a bounded amount of memory
+        for start in range(0, self._count, _ARRAY_CHUNK):
+            stop = min(start + _ARRAY_CHUNK, self._count)
+            for trace in self._decode(start, stop):
+                yield trace
+
+    def _columns(self):
+        # Get the traces as a _ColumnarTraces sharing the memory of the file,
+        # or None if NumPy is not available: array.array copies the memory
+        if not _import_numpy():
+            return None
+        sizes = _unpack_column(self._data, 'Q', self._count,
+                               self._sizes_offset)
+        traceback_ids = _unpack_column(self._data, 'I', self._count,
+                                       self._indexes_offset)
+        if self._domains_offset is not None:
+            domains = _unpack_column(self._data, 'I', self._count,
+                                     self._domains_offset)
+        else:
+            domains = None
+        if self._types_offset is not None:
+            types = _unpack_column(self._data, 'I', self._count,
+                                   self._types_offset)
+        else:
+            types = None
+        return _ColumnarTraces(sizes, traceback_ids, self._tracebacks,
+                               domains, types, self._type_names)
+
+
+def _get_columns(traces):
+    # Get traces as a _ColumnarTraces, or None if they are not stored in
+    # arrays
+    if isinstance(traces, _ColumnarTraces):
+        return traces
+    if isinstance(traces, _MappedTraces):
+        return traces._columns()
+    return None
+
+
+def _load_snapshot(fp, lazy=False):
+    header = _read_exactly(fp, _SNAPSHOT_HEADER.size)
+    magic, version, traceback_limit, sample_rate = \
+        _SNAPSHOT_HEADER.unpack(header)
+    if magic != _SNAPSHOT_MAGIC:
+        raise ValueError("not a snapshot file")
+    if version not in (1, 2, _SNAPSHOT_VERSION):
+        raise ValueError("unsupported snapshot version: %s" % version)
+
+    count = _UINT32.unpack(_read_exactly(fp, _UINT32.size))[0]
+    filenames = []
+    for index in range(count):
+        length = _UINT32.unpack(_read_exactly(fp, _UINT32.size))[0]
+        filenames.append(_decode_filename(_read_exactly(fp, length)))
+
+    count = _UINT32.unpack(_read_exactly(fp, _UINT32.size))[0]
+    traceback_nframes = _read_array(fp, 'I', count)
+    frames = _read_array(fp, 'I', sum(traceback_nframes) * 2)
+    # frame tuples are shared by tracebacks
+    frame_tuples = {}
+    tracebacks = []
+    pos = 0
+    for nframe in traceback_nframes:
+        traceback = []
+        end = pos + nframe * 2
+        while pos < end:
+            key = (frames[pos], frames[pos + 1])
+            try:
+                frame = frame_tuples[key]
+            except KeyError:
+                frame = (filenames[key[0]], key[1])
+                frame_tuples[key] = frame
+            traceback.append(frame)
+            pos += 2
+        tracebacks.append(tuple(traceback))
+    del frames, frame_tuples
+
+    # versions 1 and 2 have no type column
+    if version >= 3:
+        type_names = [None]
+        count = _UINT32.unpack(_read_exactly(fp, _UINT32.size))[0]
+        for index in range(count):
+            length = _UINT32.unpack(_read_exactly(fp, _UINT32.size))[0]
+            type_names.append(_decode_filename(_read_exactly(fp, length)))
+    else:
+        type_names = None
+
+    # version 1 has no domain column
+    has_domains = (version >= 2)
+    count = _UINT64.unpack(_read_exactly(fp, _UINT64.size))[0]
+    if lazy:
+        # fp is a memory map
+        traces = _MappedTraces(fp, fp.tell(), count, tracebacks, has_domains,
+                               type_names)
+        length = count * (_UINT64.size + _UINT32.size)
+        if has_domains:
+            length += count * _UINT32.size
+        if type_names is not None:
+            length += count * _UINT32.size
+        fp.seek(length, os.SEEK_CUR)
+    else:
+        sizes = _read_exactly(fp, count * _UINT64.size)
+        traceback_ids = _read_exactly(fp, count * _UINT32.size)
+        if has_domains:
+            domains = _read_exactly(fp, count * _UINT32.size)
+        else:
+            domains = None
+        if type_names is not None:
+            types = _read_exactly(fp, count * _UINT32.size)
+        else:
+            types = None
+        size_column = _unpack_column(sizes, 'Q', count)
+        if size_column is not None:
+            traceback_ids = _unpack_column(traceback_ids, 'I', count)
+            if domains is not None:
+                domains = _unpack_column(domains, 'I', count)
+            if types is not None:
+                types = _unpack_column(types, 'I', count)
+            traces = _ColumnarTraces(size_column, traceback_ids, tracebacks,
+                                     domains, types, type_names)
+        else:
+            # no array type can store 64-bit integers
+            sizes = struct.unpack('<%sQ' % count, sizes)
+            traceback_ids = struct.unpack('<%sI' % count, traceback_ids)
+            if types is not None:
+                domains = struct.unpack('<%sI' % count, domains)
+                types = struct.unpack('<%sI' % count, types)
+                traces = [(size, tracebacks[index], domain,
+                           type_names[type_id])
+                          for size, index, domain, type_id
+                          in zip(sizes, traceback_ids, domains, types)]
+            elif domains is not None:
+                domains = struct.unpack('<%sI' % count, domains)
+                traces = [(size, tracebacks[index], domain)
+                          for size, index, domain
+                          in zip(sizes, traceback_ids, domains)]
+            else:
+                traces = [(size, tracebacks[index])
+                          for size, index in zip(sizes, traceback_ids)]
+        del sizes, traceback_ids, domains, types
+
+    snapshot = Snapshot(traces, traceback_limit, sample_rate)
+
+    length = _UINT64.unpack(_read_exactly(fp, _UINT64.size))[0]
+    if length:
+        attrs = pickle.loads(_read_exactly(fp, length))
+        snapshot.__dict__.update(attrs)
+    return snapshot
+
+
 class Snapshot(object):
     """
     Snapshot of traces of memory blocks allocated by Python.
     """
 
-    def __init__(self, traces, traceback_limit):
-        # traces is a tuple of trace tuples: see _Traces constructor for
+    # Snapshots serialized by older versions have no sample_rate attribute
+    sample_rate = 0
+
+    def __init__(self, traces, traceback_limit, sample_rate=0):
+        # traces is a sequence of trace tuples: see _Traces constructor for
         # the exact format
         self.traces = _Traces(traces)
         self.traceback_limit = traceback_limit
+        self.sample_rate = sample_rate
 
     def dump(self, filename):
         """
-        Write the snapshot into a file.
+        Write the snapshot into a file using a compact binary format.
         """
         with open(filename, "wb") as fp:
-            pickle.dump(self, fp, pickle.HIGHEST_PROTOCOL)
+            _dump_snapshot(self, fp)
 
     @staticmethod
-    def load(filename):
+    def load(filename, lazy=False):
         """
-        Load a snapshot from a file.
+        Load a snapshot from a file. Snapshots pickled by older versions
+        are also supported.
+
+        If lazy is true, the file is memory mapped and traces are only
+        decoded when they are accessed.
         """
         with open(filename, "rb") as fp:
-            return pickle.load(fp)
-
-    def _filter_trace(self, include_filters, exclude_filters, trace):
-        traceback = trace[1]
-        if include_filters:
-            if not any(trace_filter._match_traceback(traceback)
-                       for trace_filter in include_filters):
-                return False
-        if exclude_filters:
-            if any(not trace_filter._match_traceback(traceback)
-                   for trace_filter in exclude_filters):
-                return False
-        return True
+            magic = fp.read(len(_SNAPSHOT_MAGIC))
+            fp.seek(0)
+            if magic != _SNAPSHOT_MAGIC:
+                return pickle.load(fp)
+            if not lazy:
+                return _load_snapshot(fp)
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return _load_snapshot(data, lazy=True)
 
     def filter_traces(self, filters):
         """
@@ -417,33 +1420,60 @@ class Snapshot(object):
             raise TypeError("filters must be a list of filters, not %s"
                             % type(filters).__name__)
         if filters:
-            include_filters = []
-            exclude_filters = []
-            for trace_filter in filters:
-                if trace_filter.inclusive:
-                    include_filters.append(trace_filter)
-                else:
-                    exclude_filters.append(trace_filter)
-            new_traces = [trace for trace in self.traces._traces
-                          if self._filter_trace(include_filters,
-                                                exclude_filters,
-                                                trace)]
+            filter_set = _FilterSet(filters)
+            columns = _get_columns(self.traces._traces)
+            if columns is not None:
+                new_traces = columns._filter(filter_set)
+            else:
+                match = filter_set.match
+                new_traces = [trace for trace in self.traces._traces
+                              if match(trace[1], _trace_domain(trace))]
+        elif isinstance(self.traces._traces, _ColumnarTraces):
+            # columns are not modified: share them
+            new_traces = self.traces._traces
         else:
             new_traces = self.traces._traces[:]
-        return Snapshot(new_traces, self.traceback_limit)
+        return Snapshot(new_traces, self.traceback_limit, self.sample_rate)
 
     def _group_by(self, key_type, cumulative):
-        if key_type not in ('traceback', 'filename', 'lineno'):
-            raise ValueError("unknown key_type: %r" % (key_type,))
-        if cumulative and key_type not in ('lineno', 'filename'):
-            raise ValueError("cumulative mode cannot by used "
-                             "with key type %r" % key_type)
+        _check_key_type(key_type, cumulative)
+
+        columns = _get_columns(self.traces._traces)
+        if columns is not None:
+            return self._group_by_columns(columns, key_type, cumulative)
 
+        sample_rate = self.sample_rate
+        count = 1
         stats = {}
         tracebacks = {}
-        if not cumulative:
+        if key_type in ('domain', 'type'):
+            if key_type == 'domain':
+                get_key = _trace_domain
+                get_frames = _domain_frames
+            else:
+                get_key = _trace_type
+                get_frames = _type_frames
             for trace in self.traces._traces:
-                size, trace_traceback = trace
+                size = trace[0]
+                if sample_rate:
+                    size, count = _sampled_estimate(size, sample_rate)
+                key = get_key(trace)
+                try:
+                    traceback = tracebacks[key]
+                except KeyError:
+                    traceback = Traceback(get_frames(key))
+                    tracebacks[key] = traceback
+                try:
+                    stat = stats[traceback]
+                    stat.size += size
+                    stat.count += count
+                except KeyError:
+                    stats[traceback] = Statistic(traceback, size, count)
+        elif not cumulative:
+            for trace in self.traces._traces:
+                size, trace_traceback = trace[:2]
+                if sample_rate:
+                    size, count = _sampled_estimate(size, sample_rate)
                 try:
                     traceback = tracebacks[trace_traceback]
                 except KeyError:
@@ -458,13 +1488,15 @@ class Snapshot(object):
                 try:
                     stat = stats[traceback]
                     stat.size += size
-                    stat.count += 1
+                    stat.count += count
                 except KeyError:
-                    stats[traceback] = Statistic(traceback, size, 1)
+                    stats[traceback] = Statistic(traceback, size, count)
         else:
             # cumulative statistics
             for trace in self.traces._traces:
-                size, trace_traceback = trace
+                size, trace_traceback = trace[:2]
+                if sample_rate:
+                    size, count = _sampled_estimate(size, sample_rate)
                 for frame in trace_traceback:
                     try:
                         traceback = tracebacks[frame]
@@ -478,9 +1510,60 @@ class Snapshot(object):
                     try:
                         stat = stats[traceback]
                         stat.size += size
-                        stat.count += 1
+                        stat.count += count
                     except KeyError:
-                        stats[traceback] = Statistic(traceback, size, 1)
+                        stats[traceback] = Statistic(traceback, size, count)
+        if sample_rate:
+            for stat in stats.values():
+                stat.size = int(round(stat.size))
+                stat.count = int(round(stat.count))
+        return stats
+
+    def _group_by_columns(self, columns, key_type, cumulative):
+        # group traces by traceback using array reductions, and then group
+        # tracebacks by key_type
+        stats = {}
+        if key_type in ('domain', 'type'):
+            if key_type == 'domain':
+                grouped = columns._group_by_domain(self.sample_rate)
+                get_frames = _domain_frames
+            else:
+                grouped = columns._group_by_type(self.sample_rate)
+                get_frames = _type_frames
+            for key, size, count in grouped:
+                traceback = Traceback(get_frames(key))
+                stats[traceback] = Statistic(traceback, size, count)
+            if self.sample_rate:
+                for stat in stats.values():
+                    stat.size = int(round(stat.size))
+                    stat.count = int(round(stat.count))
+            return stats
+
+        for trace_traceback, size, count in \
+                columns._group_by_traceback(self.sample_rate):
+            if not cumulative:
+                if key_type == 'traceback':
+                    keys = (trace_traceback,)
+                elif key_type == 'lineno':
+                    keys = (trace_traceback[:1],)
+                else: # key_type == 'filename':
+                    keys = (((trace_traceback[0][0], 0),),)
+            elif key_type == 'lineno':
+                keys = [(frame,) for frame in trace_traceback]
+            else: # key_type == 'filename':
+                keys = [((frame[0], 0),) for frame in trace_traceback]
+            for frames in keys:
+                traceback = Traceback(frames)
+                try:
+                    stat = stats[traceback]
+                    stat.size += size
+                    stat.count += count
+                except KeyError:
+                    stats[traceback] = Statistic(traceback, size, count)
+        if self.sample_rate:
+            for stat in stats.values():
+                stat.size = int(round(stat.size))
+                stat.count = int(round(stat.count))
         return stats
 
     def statistics(self, key_type, cumulative=False):
@@ -506,13 +1589,437 @@ class Snapshot(object):
         return statistics
 
 
-def take_snapshot():
+def _load_snapshot_file(filename):
+    # Default loader of SnapshotSeries: memory map the snapshot file
+    return Snapshot.load(filename, lazy=True)
+
+
+def _group_snapshot_file(loader, filename, key_type, cumulative):
+    # Load a snapshot and group its traces, called in a worker process of
+    # SnapshotSeries. Return a list of (traceback tuple, size, count) tuples:
+    # tuples are cheaper to pickle than Statistic instances.
+    if loader is None:
+        loader = _load_snapshot_file
+    snapshot = loader(filename)
+    grouped = snapshot._group_by(key_type, cumulative)
+    return [(stat.traceback._frames, stat.size, stat.count)
+            for stat in grouped.values()]
+
+
+class SnapshotSeries(Sequence):
+    """
+    Series of snapshots stored in files, ordered from the oldest to the most
+    recent. Traces of each snapshot are grouped once per key type in worker
+    processes, and then cached.
+    """
+
+    def __init__(self, filenames, loader=None, workers=None):
+        Sequence.__init__(self)
+        self.filenames = list(filenames)
+        # loader(filename) loads a snapshot: it must be picklable to be
+        # called in worker processes. None means Snapshot.load().
+        self.loader = loader
+        self.workers = workers
+        # (key_type, cumulative) => list of {Traceback: Statistic} dicts,
+        # one per snapshot
+        self._groups = {}
+
+    @classmethod
+    def load(cls, directory, pattern='*', loader=None, workers=None):
+        """
+        Create a series from the snapshot files of directory matching
+        pattern, sorted by filename.
+        """
+        filenames = sorted(glob.glob(os.path.join(directory, pattern)))
+        return cls(filenames, loader, workers)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SnapshotSeries(self.filenames[index],
+                                  self.loader, self.workers)
+        filename = self.filenames[index]
+        if self.loader is not None:
+            return self.loader(filename)
+        return Snapshot.load(filename)
+
+    def _group_all(self, key_type, cumulative):
+        count = len(self.filenames)
+        args = ([self.loader] * count, self.filenames,
+                [key_type] * count, [cumulative] * count)
+        if self.workers != 1:
+            try:
+                from concurrent.futures import ProcessPoolExecutor
+            except ImportError:
+                # Python 2 without the futures backport
+                pass
+            else:
+                with ProcessPoolExecutor(self.workers) as executor:
+                    return list(executor.map(_group_snapshot_file, *args))
+        return list(map(_group_snapshot_file, *args))
+
+    def _group_by(self, key_type, cumulative):
+        _check_key_type(key_type, cumulative)
+        cumulative = bool(cumulative)
+        try:
+            return self._groups[(key_type, cumulative)]
+        except KeyError:
+            pass
+
+        groups = []
+        for stats in self._group_all(key_type, cumulative):
+            group = {}
+            for frames, size, count in stats:
+                traceback = Traceback(frames)
+                group[traceback] = Statistic(traceback, size, count)
+            groups.append(group)
+        self._groups[(key_type, cumulative)] = groups
+        return groups
+
+    def statistics(self, index, key_type, cumulative=False):
+        """
+        Group statistics of the snapshot index by key_type, as
+        Snapshot.statistics(). Return a sorted list of Statistic instances.
+        """
+        grouped = self._group_by(key_type, cumulative)[index]
+        statistics = list(grouped.values())
+        statistics.sort(reverse=True, key=Statistic._sort_key)
+        return statistics
+
+    def compare(self, old_index, new_index, key_type, cumulative=False):
+        """
+        Compute the differences between the snapshots old_index and
+        new_index, as Snapshot.compare_to(). Return a sorted list of
+        StatisticDiff instances.
+        """
+        groups = self._group_by(key_type, cumulative)
+        # _compare_grouped_stats() removes items of the old group
+        old_group = dict(groups[old_index])
+        statistics = _compare_grouped_stats(old_group, groups[new_index])
+        statistics.sort(reverse=True, key=StatisticDiff._sort_key)
+        return statistics
+
+    def compare_consecutive(self, key_type, cumulative=False):
+        """
+        Compute the differences between each snapshot and the previous
+        snapshot. Return a list of sorted lists of StatisticDiff instances.
+        """
+        return [self.compare(index - 1, index, key_type, cumulative)
+                for index in range(1, len(self))]
+
+    def growing(self, key_type, cumulative=False):
+        """
+        Get the statistics whose size grows in each snapshot of the series:
+        the size never decreases and the size of the last snapshot is bigger
+        than the size of the first snapshot. Return a sorted list of
+        StatisticDiff instances between the first and the last snapshots.
+        """
+        groups = self._group_by(key_type, cumulative)
+        if len(groups) < 2:
+            return []
+
+        # a traceback missing in a snapshot has a size of zero
+        sizes = {}
+        for traceback in groups[-1]:
+            sizes[traceback] = 0
+        for group in groups:
+            for traceback, previous in list(sizes.items()):
+                stat = group.get(traceback)
+                size = stat.size if stat is not None else 0
+                if size < previous:
+                    del sizes[traceback]
+                else:
+                    sizes[traceback] = size
+
+        first = groups[0]
+        statistics = []
+        for traceback in sizes:
+            stat = groups[-1][traceback]
+            previous = first.get(traceback)
+            if previous is not None:
+                old_size, old_count = previous.size, previous.count
+            else:
+                old_size = old_count = 0
+            if stat.size <= old_size:
+                continue
+            statistics.append(StatisticDiff(traceback,
+                                            stat.size, stat.size - old_size,
+                                            stat.count,
+                                            stat.count - old_count))
+        statistics.sort(reverse=True, key=StatisticDiff._sort_key)
+        return statistics
+
+
+def take_snapshot(object_types=False):
     """
     Take a snapshot of traces of memory blocks allocated by Python.
+
+    If object_types is true, get also the type of objects stored in memory
+    blocks.
     """
     if not is_tracing():
         raise RuntimeError("the tracemalloc module must be tracing memory "
                            "allocations to take a snapshot")
-    traces = _get_traces()
+    if object_types:
+        traces = _get_traces(_get_types())
+    else:
+        traces = _get_traces()
+    traceback_limit = get_traceback_limit()
+    sample_rate = get_sample_rate()
+    return Snapshot(traces, traceback_limit, sample_rate)
+
+
+def get_statistics(key_type, cumulative=False):
+    """
+    Group traces of memory blocks allocated by Python by key_type without
+    taking a snapshot. Return a sorted list of Statistic instances, as
+    take_snapshot().statistics(key_type, cumulative).
+    """
+    if not is_tracing():
+        raise RuntimeError("the tracemalloc module must be tracing memory "
+                           "allocations to get statistics")
+    _check_live_key_type(key_type, cumulative)
+    sample_rate = get_sample_rate()
+    statistics = []
+    for frames, size, count in _get_statistics(key_type, bool(cumulative)):
+        if key_type == 'domain':
+            # frames is the domain number
+            frames = _domain_frames(frames)
+        if sample_rate:
+            size = int(round(size))
+            count = int(round(count))
+        statistics.append(Statistic(Traceback(frames), size, count))
+    statistics.sort(reverse=True, key=Statistic._sort_key)
+    return statistics
+
+
+def get_allocation_statistics(key_type, cumulative=False):
+    """
+    Group cumulative allocation statistics of tracebacks by key_type.
+    Return a sorted list of AllocationStatistic instances.
+    """
+    if not is_tracing():
+        raise RuntimeError("the tracemalloc module must be tracing memory "
+                           "allocations to get allocation statistics")
+    _check_live_key_type(key_type, cumulative)
+    statistics = [AllocationStatistic(Traceback(frames),
+                                      size, count, free_count)
+                  for frames, size, count, free_count
+                  in _get_allocation_statistics(key_type, bool(cumulative))]
+    statistics.sort(reverse=True, key=AllocationStatistic._sort_key)
+    return statistics
+
+
+def compare_allocation_statistics(statistics, old_statistics):
+    """
+    Compute the allocations between two calls to get_allocation_statistics()
+    with the same key type. Return a sorted list of AllocationStatistic
+    instances, tracebacks without new allocation or deallocation are
+    ignored.
+    """
+    old_group = dict((stat.traceback, stat) for stat in old_statistics)
+    diff = []
+    for stat in statistics:
+        previous = old_group.get(stat.traceback)
+        # counters are reset by clear_traces()
+        if (previous is not None and stat.count >= previous.count
+                and stat.free_count >= previous.free_count):
+            stat = AllocationStatistic(stat.traceback,
+                                       stat.size - previous.size,
+                                       stat.count - previous.count,
+                                       stat.free_count - previous.free_count)
+        if stat.count or stat.free_count:
+            diff.append(stat)
+    diff.sort(reverse=True, key=AllocationStatistic._sort_key)
+    return diff
+
+
+def get_arena_statistics():
+    """
+    Map traced memory blocks allocated by pymalloc to their arena. Return a
+    list of ArenaStatistic instances sorted by used size: arenas pinned by
+    the fewest memory blocks come first.
+    """
+    if not is_tracing():
+        raise RuntimeError("the tracemalloc module must be tracing memory "
+                           "allocations to get arena statistics")
     traceback_limit = get_traceback_limit()
-    return Snapshot(traces, traceback_limit)
+    sample_rate = get_sample_rate()
+    arenas = {}
+    for trace, pool, arena, block_size, nblock, maxnblock \
+            in _get_pymalloc_blocks():
+        try:
+            pools, traces = arenas[arena]
+        except KeyError:
+            pools = {}
+            traces = []
+            arenas[arena] = (pools, traces)
+        # nblock also counts memory blocks which are not traced
+        pools[pool] = (block_size, nblock, maxnblock)
+        traces.append(trace)
+
+    statistics = []
+    for arena, (pools, traces) in arenas.items():
+        used_size = 0
+        free_size = 0
+        for block_size, nblock, maxnblock in pools.values():
+            used_size += nblock * block_size
+            free_size += (maxnblock - nblock) * block_size
+        snapshot = Snapshot(traces, traceback_limit, sample_rate)
+        statistics.append(ArenaStatistic(arena, len(pools),
+                                         used_size, free_size, snapshot))
+    statistics.sort(key=ArenaStatistic._sort_key)
+    return statistics
+
+
+def dump_snapshot(filename):
+    """
+    Write a snapshot of traces of memory blocks allocated by Python into a
+    file without creating Python objects for traces. filename can also be
+    a file descriptor. Use Snapshot.load() to load the snapshot.
+    """
+    if not is_tracing():
+        raise RuntimeError("the tracemalloc module must be tracing memory "
+                           "allocations to dump a snapshot")
+    if isinstance(filename, numbers.Integral):
+        _dump_traces(filename)
+        return
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(filename, flags, 0o666)
+    try:
+        _dump_traces(fd)
+    finally:
+        os.close(fd)
+
+
+# Event of the event log, see event_t in _tracemalloc.c: timestamp in
+# microseconds since the Epoch, address, size, traceback identifier,
+# operation and padding, in the native byte order
+_EVENT_STRUCT = struct.Struct('=QQQQII')
+EVENT_ALLOC = 1
+EVENT_FREE = 2
+
+
+class Event(object):
+    """
+    Allocation (EVENT_ALLOC) or deallocation (EVENT_FREE) of a traced
+    memory block.
+    """
+    __slots__ = ('timestamp', 'op', 'address', 'size', 'traceback')
+
+    def __init__(self, timestamp, op, address, size, traceback):
+        self.timestamp = timestamp
+        self.op = op
+        self.address = address
+        self.size = size
+        self.traceback = traceback
+
+    def __repr__(self):
+        op = 'alloc' if self.op == EVENT_ALLOC else 'free'
+        return ("<Event %s timestamp=%.6f address=0x%x size=%s traceback=%r>"
+                % (op, self.timestamp, self.address,
+                   _format_size(self.size, False), self.traceback))
+
+
+class EventLog(Sequence):
+    """
+    Events removed from the event log by drain_events(), sorted by time.
+    """
+
+    def __init__(self, data, tracebacks, lost=0):
+        # events packed by _tracemalloc._drain_events(), see _EVENT_STRUCT
+        self._data = data
+        # traceback identifier => tuple of (filename, lineno) tuples
+        self._tracebacks = tracebacks
+        # number of events lost because the buffer of the event log was full
+        self.lost = lost
+
+    def __len__(self):
+        return len(self._data) // _EVENT_STRUCT.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[index] for index in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not(0 <= index < len(self)):
+            raise IndexError("event index out of range")
+        record = _EVENT_STRUCT.unpack_from(self._data,
+                                           index * _EVENT_STRUCT.size)
+        timestamp, address, size, traceback_id, op, reserved = record
+        traceback = Traceback(self._tracebacks[traceback_id])
+        return Event(timestamp * 1e-6, op, address, size, traceback)
+
+    def _group_allocations(self, step):
+        # Return a list of (traceback_id, interval, count, size) tuples
+        numpy = _import_numpy()
+        if numpy:
+            dtype = numpy.dtype([('timestamp', '=u8'), ('address', '=u8'),
+                                 ('size', '=u8'), ('traceback', '=u8'),
+                                 ('op', '=u4'), ('reserved', '=u4')])
+            events = numpy.frombuffer(self._data, dtype=dtype)
+            events = events[events['op'] == EVENT_ALLOC]
+            if not len(events):
+                return []
+            intervals = events['timestamp'] // step
+            first = intervals.min()
+            nintervals = int(intervals.max() - first) + 1
+            traceback_ids, indexes = numpy.unique(events['traceback'],
+                                                  return_inverse=True)
+            keys = indexes.astype(numpy.uint64) * nintervals + (intervals - first)
+            keys, indexes = numpy.unique(keys, return_inverse=True)
+            counts = numpy.bincount(indexes)
+            sizes = numpy.bincount(indexes, weights=events['size'])
+            traceback_ids = traceback_ids.tolist()
+            first = int(first)
+            return [(traceback_ids[key // nintervals],
+                     first + key % nintervals, count, int(size))
+                    for key, count, size in zip(keys.tolist(),
+                                                counts.tolist(),
+                                                sizes.tolist())]
+
+        groups = {}
+        unpack_from = _EVENT_STRUCT.unpack_from
+        for offset in range(0, len(self._data), _EVENT_STRUCT.size):
+            record = unpack_from(self._data, offset)
+            timestamp, address, size, traceback_id, op, reserved = record
+            if op != EVENT_ALLOC:
+                continue
+            key = (traceback_id, timestamp // step)
+            if key in groups:
+                count, total = groups[key]
+                groups[key] = (count + 1, total + size)
+            else:
+                groups[key] = (1, size)
+        return [(traceback_id, interval, count, size)
+                for (traceback_id, interval), (count, size) in groups.items()]
+
+    def allocation_rates(self, interval=1.0):
+        """
+        Group allocations by traceback and by time intervals of interval
+        seconds. Return a dictionary mapping Traceback instances to lists of
+        (time: float, count: int, size: int) tuples sorted by time, where
+        time is the start of the interval in seconds since the Epoch.
+        """
+        step = int(interval * 1e6)
+        if step < 1:
+            raise ValueError("interval must be at least 1 microsecond")
+        rates = {}
+        for traceback_id, index, count, size in self._group_allocations(step):
+            traceback = Traceback(self._tracebacks[traceback_id])
+            rates.setdefault(traceback, []).append(
+                (index * step * 1e-6, count, size))
+        for rate in rates.values():
+            rate.sort()
+        return rates
+
+
+def drain_events():
+    """
+    Remove all events from the event log started by start_event_log().
+    Return an EventLog instance.
+    """
+    data, tracebacks, lost = _drain_events()
+    return EventLog(data, tracebacks, lost)
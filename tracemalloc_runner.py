@@ -3,22 +3,29 @@
 Script to trace Python memory allocations when running a Python program.
 
 Usage: python tracemalloc_runner.py /path/to/program [arg1 arg2 ...]
+
+The first snapshot is written in full, next snapshots only store traces
+added and removed since the previous snapshot. To reconstruct a snapshot and
+write it into a file which can be loaded by Snapshot.load():
+
+    python tracemalloc_runner.py --load /tmp/tracemalloc-PID-NNNN.delta output
+
+To compare all snapshots written by a process:
+
+    series = tracemalloc.SnapshotSeries.load(
+        '/tmp', 'tracemalloc-PID-*.delta',
+        loader=tracemalloc_runner.load_snapshot)
+    for stat in series.growing('lineno')[:10]:
+        print(stat)
 """
 from __future__ import print_function
-filename_pattern = "/tmp/tracemalloc-%d-%04d.pickle"  # % (pid, counter)
+filename_pattern = "/tmp/tracemalloc-%d-%04d.delta"  # % (pid, counter)
 init_delay = 10
 snapshot_delay = 30
 nframes = 50
 
-# Cleanup sys.argv and sys.path
-import os.path
-del sys.argv[0]
-if sys.path[0] == os.path.dirname(__file__):
-    del sys.path[0]
-
-# The first step is to start tracing memory allocations
-import tracemalloc
-tracemalloc.start(nframes)
+# Version of the format of delta files
+DELTA_VERSION = 2
 
 import atexit
 import gc
@@ -26,8 +33,24 @@ import os
 import pickle
 import runpy
 import signal
+import sys
 import threading
 import time
+import tracemalloc
+
+
+def group_traces(traces):
+    """
+    Group traces returned by tracemalloc._get_traces() by traceback, size
+    and domain. Return a dictionary: (traceback, size, domain) => number of
+    traces.
+    """
+    grouped = {}
+    for trace in traces:
+        key = (trace[1], trace[0], tracemalloc._trace_domain(trace))
+        grouped[key] = grouped.get(key, 0) + 1
+    return grouped
+
 
 class TakeSnapshot(threading.Thread):
     daemon = True
@@ -35,22 +58,94 @@ class TakeSnapshot(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
         self.counter = 1
+        # take_snapshot() is also called by atexit
+        self.lock = threading.Lock()
+        # (traceback, size, domain) => number of traces of the previous
+        # snapshot
+        self.traces = {}
+        # traceback => identifier, for tracebacks of the previous snapshot
+        self.traceback_ids = {}
+        self.next_traceback_id = 1
+        self.previous = None
+
+    def compute_delta(self, traces):
+        """
+        Compute the delta between the previous snapshot and traces grouped
+        by group_traces(). Return (delta, state): write_delta() only saves the
+        state once the delta is written, so the next delta is relative to
+        the last written snapshot.
+        """
+        new_tracebacks = {}
+        traceback_ids = {}
+        next_traceback_id = self.next_traceback_id
+        added = []
+        for key, count in traces.items():
+            traceback, size, domain = key
+            traceback_id = traceback_ids.get(traceback)
+            if traceback_id is None:
+                traceback_id = self.traceback_ids.get(traceback)
+                if traceback_id is None:
+                    traceback_id = next_traceback_id
+                    next_traceback_id += 1
+                    new_tracebacks[traceback_id] = traceback
+                traceback_ids[traceback] = traceback_id
+            count -= self.traces.get(key, 0)
+            if count > 0:
+                added.append((traceback_id, size, domain, count))
+        removed = []
+        for key, count in self.traces.items():
+            traceback, size, domain = key
+            count -= traces.get(key, 0)
+            if count > 0:
+                traceback_id = self.traceback_ids[traceback]
+                removed.append((traceback_id, size, domain, count))
+
+        delta = {
+            'version': DELTA_VERSION,
+            'previous': self.previous,
+            'timestamp': time.time(),
+            'traceback_limit': tracemalloc.get_traceback_limit(),
+            'sample_rate': tracemalloc.get_sample_rate(),
+            'tracebacks': new_tracebacks,
+            'added': added,
+            'removed': removed,
+        }
+        # forget tracebacks which are no more used: they get a new
+        # identifier if they are used again
+        return delta, (traces, traceback_ids, next_traceback_id)
+
+    def write_delta(self, traces, filename):
+        """
+        Write the delta between the previous snapshot and traces grouped by
+        group_traces() into filename.
+        """
+        delta, state = self.compute_delta(traces)
+        fp = open(filename, "wb")
+        try:
+            with fp:
+                # Pickle version 2 can be read by Python 2 and Python 3
+                pickle.dump(delta, fp, 2)
+        except BaseException:
+            # don't leave a truncated delta behind
+            os.unlink(filename)
+            raise
+        (self.traces, self.traceback_ids, self.next_traceback_id) = state
+        self.previous = os.path.basename(filename)
 
     def take_snapshot(self):
-        filename = (filename_pattern
-                    % (os.getpid(), self.counter))
-        t0 = time.time()
-        print("Write snapshot into %s..." % filename, file=sys.__stderr__)
-        gc.collect()
-        snapshot = tracemalloc.take_snapshot()
-        with open(filename, "wb") as fp:
-            # Pickle version 2 can be read by Python 2 and Python 3
-            pickle.dump(snapshot, fp, 2)
-        snapshot = None
-        dt = time.time() - t0
-        print("Snapshot written into %s (%.1f sec)" % (filename, dt),
-              file=sys.__stderr__)
-        self.counter += 1
+        with self.lock:
+            filename = (filename_pattern
+                        % (os.getpid(), self.counter))
+            t0 = time.time()
+            print("Write snapshot into %s..." % filename, file=sys.__stderr__)
+            gc.collect()
+            traces = group_traces(tracemalloc._get_traces())
+            self.write_delta(traces, filename)
+            traces = None
+            dt = time.time() - t0
+            print("Snapshot written into %s (%.1f sec)" % (filename, dt),
+                  file=sys.__stderr__)
+            self.counter += 1
 
     def run(self):
         self.take_snapshot()
@@ -62,13 +157,85 @@ class TakeSnapshot(threading.Thread):
             self.take_snapshot()
             time.sleep(snapshot_delay)
 
-print("Start thread taking snapshots every %.1f seconds" % snapshot_delay)
-print("Filename pattern: %s" % filename_pattern)
-print("")
-print("Run:", sys.path)
 
-thread = TakeSnapshot()
-thread.start()
-atexit.register(thread.take_snapshot)
+def load_snapshot(filename):
+    """
+    Reconstruct the snapshot written into filename: load the full snapshot
+    and apply deltas until filename. Files must be in the same directory.
+    Return a tracemalloc.Snapshot instance.
+    """
+    deltas = []
+    while True:
+        with open(filename, "rb") as fp:
+            delta = pickle.load(fp)
+        if delta.get('version') not in (1, DELTA_VERSION):
+            raise ValueError("%s: unsupported delta version: %r"
+                             % (filename, delta.get('version')))
+        deltas.append(delta)
+        if delta['previous'] is None:
+            break
+        filename = os.path.join(os.path.dirname(filename), delta['previous'])
+
+    tracebacks = {}
+    traces = {}
+    for delta in reversed(deltas):
+        tracebacks.update(delta['tracebacks'])
+        for entry in delta['added']:
+            # version 1 entries have no domain: (traceback_id, size, count)
+            key = entry[:-1]
+            traces[key] = traces.get(key, 0) + entry[-1]
+        for entry in delta['removed']:
+            key = entry[:-1]
+            count = traces[key] - entry[-1]
+            if count:
+                traces[key] = count
+            else:
+                del traces[key]
+
+    raw_traces = []
+    for key, count in traces.items():
+        traceback_id, size = key[:2]
+        domain = key[2] if len(key) > 2 else None
+        if domain is not None:
+            trace = (size, tracebacks[traceback_id], domain)
+        else:
+            trace = (size, tracebacks[traceback_id])
+        raw_traces.extend([trace] * count)
+    delta = deltas[0]
+    return tracemalloc.Snapshot(raw_traces, delta['traceback_limit'],
+                                delta['sample_rate'])
+
+
+def main():
+    if sys.argv[1:2] == ['--load']:
+        if len(sys.argv) != 4:
+            print(__doc__.strip(), file=sys.stderr)
+            sys.exit(1)
+        snapshot = load_snapshot(sys.argv[2])
+        snapshot.dump(sys.argv[3])
+        print("Snapshot written into %s (%s traces)"
+              % (sys.argv[3], len(snapshot.traces)))
+        return
+
+    # The first step is to start tracing memory allocations
+    tracemalloc.start(nframes)
+
+    # Cleanup sys.argv and sys.path
+    del sys.argv[0]
+    if sys.path[0] == os.path.dirname(__file__):
+        del sys.path[0]
+
+    print("Start thread taking snapshots every %.1f seconds" % snapshot_delay)
+    print("Filename pattern: %s" % filename_pattern)
+    print("")
+    print("Run:", sys.path)
+
+    thread = TakeSnapshot()
+    thread.start()
+    atexit.register(thread.take_snapshot)
+
+    runpy.run_path(sys.argv[0])
+
 
-runpy.run_path(sys.argv[0])
+if __name__ == "__main__":
+    main()